@@ -0,0 +1,122 @@
+# analytics.py — воронка конверсии по объявлениям
+# Хендлеры только увеличивают счётчик в памяти (без БД); раз в flush_interval
+# секунд накопленное уходит в listing_stats одним батчевым UPSERT. Таблица уже
+# агрегирована по дням, поэтому /stats читает сотни строк, а не миллионы событий.
+# Несколько воркеров пишут в одну таблицу: UPSERT прибавляет, а не перезаписывает.
+
+import asyncio
+import logging
+import sqlite3
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import db
+
+EVENTS = ("lookup", "confirm", "pay", "pre_checkout", "paid")
+
+SQL_FLUSH = """
+    INSERT INTO listing_stats (day, listing_id, event, count) VALUES (?, ?, ?, ?)
+    ON CONFLICT(day, listing_id, event) DO UPDATE SET count = count + excluded.count
+"""
+SQL_TOTALS = """
+    SELECT event, SUM(count) FROM listing_stats WHERE day >= ? GROUP BY event
+"""
+SQL_TOP = """
+    SELECT listing_id,
+           SUM(CASE WHEN event='lookup' THEN count ELSE 0 END) AS lookups,
+           SUM(CASE WHEN event='paid'   THEN count ELSE 0 END) AS paid
+    FROM listing_stats WHERE day >= ?
+    GROUP BY listing_id ORDER BY paid DESC, lookups DESC LIMIT ?
+"""
+SQL_LISTING = """
+    SELECT day, event, count FROM listing_stats
+    WHERE listing_id = ? AND day >= ? ORDER BY day DESC
+"""
+
+Key = Tuple[str, str, str]   # (день, ID, событие)
+
+
+def _flush(conn: sqlite3.Connection, rows: List[tuple]) -> None:
+    conn.executemany(SQL_FLUSH, rows)
+
+def _totals(conn: sqlite3.Connection, since: str) -> Dict[str, int]:
+    return dict(conn.execute(SQL_TOTALS, (since,)).fetchall())
+
+def _top(conn: sqlite3.Connection, since: str, limit: int) -> List[Tuple[str, int, int]]:
+    return conn.execute(SQL_TOP, (since, limit)).fetchall()
+
+def _listing(conn: sqlite3.Connection, listing_id: str, since: str) -> Dict[str, Dict[str, int]]:
+    days: Dict[str, Dict[str, int]] = {}
+    for day, event, count in conn.execute(SQL_LISTING, (listing_id, since)):
+        days.setdefault(day, {})[event] = count
+    return days
+
+
+class FunnelStats:
+    def __init__(self, flush_interval: float = 5.0):
+        self.flush_interval = flush_interval
+        self._pending: Dict[Key, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.recorded = 0
+        self.flushes = 0
+
+    def record(self, listing_id: str, event: str) -> None:
+        """Учесть событие воронки. Только память — безопасно звать из любого хендлера."""
+        key = (date.today().isoformat(), listing_id, event)
+        self._pending[key] = self._pending.get(key, 0) + 1
+        self.recorded += 1
+        if self._flush_task is None and not self._closing:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+        finally:
+            self._flush_task = None
+            if self._pending and not self._closing:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await db.write(_flush, [(*key, n) for key, n in batch.items()])
+        except BaseException as e:
+            # вернём счётчики обратно — сложим с тем, что накопилось за время записи
+            for key, n in batch.items():
+                self._pending[key] = self._pending.get(key, 0) + n
+            if not isinstance(e, Exception):
+                raise
+            logging.exception("analytics: flush failed, will retry")
+            return
+        self.flushes += 1
+
+    async def close(self) -> None:
+        self._closing = True
+        task = self._flush_task
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+
+    # ── отчёты (читают только агрегаты) ──
+    @staticmethod
+    def since(days: int) -> str:
+        """Первый день периода из days дней, включая сегодня."""
+        return (date.today() - timedelta(days=days - 1)).isoformat()
+
+    async def totals(self, days: int) -> Dict[str, int]:
+        return await db.read(_totals, self.since(days))
+
+    async def top(self, days: int, limit: int = 10) -> List[Tuple[str, int, int]]:
+        return await db.read(_top, self.since(days), limit)
+
+    async def listing(self, listing_id: str, days: int = 30) -> Dict[str, Dict[str, int]]:
+        return await db.read(_listing, listing_id, self.since(days))
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "recorded": self.recorded, "flushes": self.flushes}
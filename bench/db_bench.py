@@ -0,0 +1,358 @@
+# bench/db_bench.py — микро-бенчмарк слоя db.py под конкурентной нагрузкой
+#
+# Засевает базу синтетическими объявлениями (10k–1M) и меряет db_get, db_upsert,
+# db_set_status, db_delete, страницу /listings и полный проход по таблице:
+#   single     — одна задача, операции подряд (чистая латентность);
+#   concurrent — много asyncio-задач со смесью чтений и записей.
+# Сравнивает режимы журнала (DB_JOURNAL_MODE читается при импорте db.py, поэтому
+# каждый прогон — отдельный процесс на своей копии засеянной базы) и способы
+# работы с соединениями:
+#   pool    — как в боте: db_* хелперы, пул читателей + поток-писатель;
+#   connect — новое соединение на каждый вызов, в потоке по умолчанию;
+#   inline  — одно соединение прямо в event loop (без перехода в поток).
+# Кэш объявлений db.py выключен (TTL 0), если не передан --cache: меряем SQLite.
+# Итог — JSON: ops/sec и p50/p95/p99/max по каждой операции; для concurrent —
+# ещё задержка event loop (сколько остальные задачи бота ждали бы своей очереди).
+#
+#   python bench/db_bench.py --rows 10000,100000 --json bench_db.json
+#   python bench/db_bench.py --rows 1000000 --journal-modes WAL --strategies pool
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import subprocess
+import tempfile
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+OPS = ("get", "upsert", "set_status", "delete", "page", "list_all")
+DEFAULT_MIX = "get=80,page=5,upsert=7,set_status=5,delete=3"
+WORDS = ("byt", "pokoj", "2+kk", "3+1", "Praha", "Brno", "Vinohrady", "Smíchov", "Žižkov", "balkon",
+         "metro", "tramvaj", "zařízený", "квартира", "комната", "рядом", "парк", "без", "залога",
+         "животные", "можно", "новостройка", "этаж", "лифт", "кухня", "студия", "Kč", "měsíc")
+
+# так выглядел /listings до пагинации — весь список одним запросом
+SQL_LIST_ALL = "SELECT id, text, status FROM listings ORDER BY id COLLATE NOCASE"
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summarize(samples: List[float], elapsed: float) -> Dict[str, Any]:
+    return {
+        "ops": len(samples),
+        "ops_per_sec": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3) if samples else 0.0,
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3) if samples else 0.0,
+    }
+
+def parse_mix(mix: str) -> List[Tuple[str, int]]:
+    pairs = []
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPS:
+            raise SystemExit(f"unknown op in --mix: {op}")
+        pairs.append((op, int(weight or 1)))
+    return pairs
+
+
+# ── засев ────────────────────────────────────────────────────────────────────
+def seed(path: str, rows: int, rng: random.Random, batch: int = 10000) -> None:
+    """Создать базу со схемой и rows объявлениями (половина — опубликованы)."""
+    import db
+    import migrations
+
+    conn = db.connect(path)
+    migrations.migrate(conn)
+    for start in range(1, rows + 1, batch):
+        chunk = []
+        for i in range(start, min(start + batch, rows + 1)):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(15, 40)))
+            photos = [f"photo-{i}-{n}" for n in range(rng.randint(0, 3))]
+            chunk.append(db.listing_row(f"A{i}", text, f"https://t.me/owner{i}", "", "TEXT",
+                                        f"Оригинал {i}: {text}", photos,
+                                        "PUBLISHED" if i % 2 else "DRAFT"))
+        with conn:
+            db.upsert_rows(conn, chunk)
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("PRAGMA journal_mode=DELETE")   # шаблон — один файл, его можно копировать
+    conn.close()
+
+
+# ── стратегии соединений ─────────────────────────────────────────────────────
+class Runner:
+    """Выполняет операции db.py выбранной стратегией. Все стратегии гоняют один и тот же SQL."""
+
+    def __init__(self, strategy: str, rows: int, rng: random.Random):
+        import db
+        self.db = db
+        self.strategy = strategy
+        self.rng = rng
+        self.ids = [f"A{i}" for i in range(1, rows + 1)]
+        self.deletable = self.ids[:]
+        rng.shuffle(self.deletable)
+        self._inline = db.connect() if strategy == "inline" else None
+
+    def _pick(self) -> str:
+        return self.rng.choice(self.ids)
+
+    def _row(self, listing_id: str) -> tuple:
+        text = " ".join(self.rng.choice(WORDS) for _ in range(20))
+        return self.db.listing_row(listing_id, text, "https://t.me/owner", "", "TEXT", text, ["photo-x"], "PUBLISHED")
+
+    async def _read(self, fn: Callable, *args: Any) -> Any:
+        if self.strategy == "pool":
+            return await self.db.read(fn, *args)
+        return await self._call(fn, args)
+
+    async def _write(self, fn: Callable, *args: Any) -> Any:
+        if self.strategy == "pool":
+            return await self.db.write(fn, *args)
+        return await self._call(fn, args, write=True)
+
+    async def _call(self, fn: Callable, args: tuple, write: bool = False) -> Any:
+        if self.strategy == "inline":
+            conn = self._inline
+            if write:
+                with conn:
+                    return fn(conn, *args)
+            return fn(conn, *args)
+
+        def fresh() -> Any:
+            conn = self.db.connect()
+            try:
+                with conn:
+                    return fn(conn, *args)
+            finally:
+                conn.close()
+        return await asyncio.to_thread(fresh)
+
+    # операции: в pool — публичные хелперы (как их зовёт бот), иначе — те же _-функции
+    async def get(self) -> None:
+        listing_id = self._pick()
+        if self.strategy == "pool":
+            await self.db.db_get(listing_id)
+        else:
+            await self._read(self.db._get, listing_id)
+
+    async def upsert(self) -> None:
+        listing_id = self._pick()
+        if self.strategy == "pool":
+            text = " ".join(self.rng.choice(WORDS) for _ in range(20))
+            await self.db.db_upsert(listing_id, text, "https://t.me/owner", "", "TEXT", text, ["photo-x"], "PUBLISHED")
+        else:
+            await self._write(self.db._upsert, self._row(listing_id))
+
+    async def set_status(self) -> None:
+        listing_id = self._pick()
+        status = self.rng.choice(("DRAFT", "PUBLISHED"))
+        if self.strategy == "pool":
+            await self.db.db_set_status(listing_id, status)
+        else:
+            await self._write(self.db._set_status, listing_id, status)
+
+    async def delete(self) -> None:
+        listing_id = self.deletable.pop() if self.deletable else self._pick()
+        if self.strategy == "pool":
+            await self.db.db_delete(listing_id)
+        else:
+            await self._write(self.db._delete, listing_id)
+
+    async def page(self) -> None:
+        cursor = self._pick()
+        if self.strategy == "pool":
+            await self.db.db_page(after=cursor)
+        else:
+            await self._read(self.db._page, "", cursor, False, 21)
+
+    async def list_all(self) -> None:
+        await self._read(_list_all)
+
+def _list_all(conn: Any) -> int:
+    return len(conn.execute(SQL_LIST_ALL).fetchall())
+
+
+async def timed(op: Callable[[], Awaitable[None]], samples: List[float]) -> None:
+    started = time.perf_counter()
+    await op()
+    samples.append(time.perf_counter() - started)
+
+async def run_single(runner: Runner, ops: int, scan_ops: int) -> Dict[str, Any]:
+    result = {}
+    for name in OPS:
+        n = scan_ops if name == "list_all" else ops
+        samples: List[float] = []
+        op = getattr(runner, name)
+        started = time.perf_counter()
+        for _ in range(n):
+            await timed(op, samples)
+        result[name] = summarize(samples, time.perf_counter() - started)
+    return result
+
+async def run_concurrent(runner: Runner, ops: int, tasks: int, mix: List[Tuple[str, int]],
+                         rng: random.Random) -> Dict[str, Any]:
+    names = [op for op, _ in mix]
+    weights = [w for _, w in mix]
+    plan = rng.choices(names, weights, k=ops)
+    samples: Dict[str, List[float]] = defaultdict(list)
+    everything: List[float] = []
+
+    async def worker(k: int) -> None:
+        for name in plan[k::tasks]:
+            started = time.perf_counter()
+            await getattr(runner, name)()
+            took = time.perf_counter() - started
+            samples[name].append(took)
+            everything.append(took)
+
+    # задержка event loop: у inline латентность операций мала, зато loop стоит во время SQL
+    lag: List[float] = []
+    running = True
+
+    async def ticker() -> None:
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag.append(max(0.0, time.perf_counter() - started - 0.001))
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(k) for k in range(tasks)))
+    elapsed = time.perf_counter() - started
+    running = False
+    await tick
+    return {
+        "tasks": tasks,
+        "mix": dict(mix),
+        "loop_lag_p99_ms": round(percentile(lag, 0.99) * 1000, 3),
+        "loop_lag_max_ms": round(max(lag, default=0.0) * 1000, 3),
+        "total": summarize(everything, elapsed),
+        "ops": {name: summarize(v, elapsed) for name, v in sorted(samples.items())},
+    }
+
+
+# ── дочерний процесс: один режим журнала × одна стратегия ────────────────────
+async def child(args: argparse.Namespace) -> Dict[str, Any]:
+    import db
+    rng = random.Random(args.seed)
+    runner = Runner(args.strategy, args.rows, rng)
+    mode = db.connect().execute("PRAGMA journal_mode").fetchone()[0]
+    single = await run_single(runner, args.ops, args.scan_ops)
+    concurrent = await run_concurrent(runner, args.ops, args.tasks, parse_mix(args.mix), rng)
+    return {"journal_mode": mode.upper(), "strategy": args.strategy, "rows": args.rows,
+            "cache": args.cache, "single": single, "concurrent": concurrent}
+
+def run_child(args: argparse.Namespace, template: str, mode: str, strategy: str, rows: int) -> Dict[str, Any]:
+    path = os.path.join(args.workdir, f"run-{rows}-{mode}-{strategy}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+    shutil.copyfile(template, path)
+    env = dict(os.environ, DB_FILE=path, DB_JOURNAL_MODE=mode, DB_READERS=str(args.readers))
+    if not args.cache:
+        env.update(LISTING_CACHE_TTL="0", LISTING_NEG_TTL="0")
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", "--strategy", strategy,
+           "--rows", str(rows), "--ops", str(args.ops), "--scan-ops", str(args.scan_ops),
+           "--tasks", str(args.tasks), "--mix", args.mix, "--seed", str(args.seed)]
+    if args.cache:
+        cmd.append("--cache")
+    out = subprocess.run(cmd, env=env, cwd=ROOT, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(f"child {mode}/{strategy}/{rows} failed:\n{out.stderr}")
+    try:
+        return json.loads(out.stdout.strip().splitlines()[-1])
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Micro-benchmark of the db.py helpers")
+    ap.add_argument("--rows", default="10000", help="объявлений в базе, через запятую: 10000,100000,1000000")
+    ap.add_argument("--journal-modes", default="WAL,DELETE", help="режимы журнала через запятую")
+    ap.add_argument("--strategies", default="pool,connect,inline", help="pool | connect | inline через запятую")
+    ap.add_argument("--ops", type=int, default=2000, help="операций каждого вида (single) и всего (concurrent)")
+    ap.add_argument("--scan-ops", type=int, default=5, help="полных проходов по таблице (list_all)")
+    ap.add_argument("--tasks", type=int, default=64, help="одновременных задач в concurrent")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="веса операций в concurrent: op=вес,…")
+    ap.add_argument("--readers", type=int, default=4, help="DB_READERS для стратегии pool")
+    ap.add_argument("--cache", action="store_true", help="не выключать кэш объявлений db.py")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--workdir", help="куда класть базы (засеянные шаблоны переиспользуются)")
+    ap.add_argument("--json", help="записать результат в файл")
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--strategy", default="pool", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        args.rows = int(args.rows)
+        print(json.dumps(asyncio.run(child(args))))
+        return
+
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="rentbot-dbbench-")
+    os.makedirs(args.workdir, exist_ok=True)
+    modes = [m.strip().upper() for m in args.journal_modes.split(",") if m.strip()]
+    strategies = [s.strip() for s in args.strategies.split(",") if s.strip()]
+    parse_mix(args.mix)
+
+    runs = []
+    for rows in (int(r) for r in args.rows.split(",")):
+        template = os.path.join(args.workdir, f"seed-{rows}.db")
+        if not os.path.exists(template):
+            started = time.perf_counter()
+            seed(template + ".tmp", rows, random.Random(args.seed))
+            os.replace(template + ".tmp", template)
+            print(f"seeded {rows} listings in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        for mode in modes:
+            for strategy in strategies:
+                print(f"run rows={rows} journal={mode} strategy={strategy}", file=sys.stderr)
+                runs.append(run_child(args, template, mode, strategy, rows))
+
+    import sqlite3
+    result = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "ops": args.ops,
+            "tasks": args.tasks,
+            "readers": args.readers,
+            "cache": args.cache,
+        },
+        "runs": runs,
+    }
+    out = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(out)
+    print(out)
+
+if __name__ == "__main__":
+    main()
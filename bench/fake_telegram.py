@@ -0,0 +1,119 @@
+# bench/fake_telegram.py — локальная замена Bot API для нагрузочных прогонов
+# Отвечает на методы, которые дёргает бот, и записывает каждый вызов.
+# getUpdates отдаёт апдейты из очереди (для режима поллинга).
+#
+#   python bench/fake_telegram.py --port 8081      # отдельным процессом
+#   BOT_API_URL=http://127.0.0.1:8081 python bot.py
+
+import json
+import time
+import asyncio
+import argparse
+import itertools
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+CHANNEL_CHAT_ID = -1001000000000
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency                 # искусственная задержка ответа, сек
+        self.calls: Counter = Counter()        # метод → число вызовов
+        self.log: List[Dict[str, Any]] = []    # (метод, chat_id, время) — для проверок сценариев
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self._msg_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self._handle)
+        self.app.router.add_get("/bot{token}/{method}", self._handle)
+
+    # ── ответы ──
+    def _chat(self, chat_id: Any) -> Dict[str, Any]:
+        if isinstance(chat_id, str) and not chat_id.lstrip("-").isdigit():
+            return {"id": CHANNEL_CHAT_ID, "type": "channel", "title": chat_id}
+        cid = int(chat_id or 0)
+        return {"id": cid, "type": "private" if cid > 0 else "channel", "first_name": "u"}
+
+    def _message(self, params: Dict[str, Any], **extra: Any) -> Dict[str, Any]:
+        msg = {
+            "message_id": next(self._msg_ids),
+            "date": int(time.time()),
+            "chat": self._chat(params.get("chat_id")),
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            msg["text"] = params["text"]
+        msg.update(extra)
+        return msg
+
+    async def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        timeout = float(params.get("timeout") or 0)
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        while not self.updates.empty() and len(batch) < 100:
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params: Dict[str, Any] = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.calls[method] += 1
+        self.log.append({"method": method, "chat_id": params.get("chat_id"), "t": time.monotonic()})
+        if self.latency and method != "getUpdates":
+            await asyncio.sleep(self.latency)
+
+        m = method.lower()
+        if m == "getme":
+            result: Any = BOT_USER
+        elif m == "getupdates":
+            result = await self._get_updates(params)
+        elif m == "sendmediagroup":
+            media = json.loads(params.get("media") or "[]")
+            result = [self._message(params, photo=[]) for _ in media]
+        elif m in ("sendmessage", "sendinvoice", "sendphoto", "senddocument", "editmessagetext",
+                   "editmessagereplymarkup", "copymessage", "forwardmessage"):
+            result = self._message(params)
+        else:
+            # answerCallbackQuery, answerPreCheckoutQuery, setWebhook, deleteWebhook, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    # ── управление ──
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]   # type: ignore[union-attr]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+async def _serve(port: int, latency: float) -> None:
+    fake = FakeTelegram(latency)
+    url = await fake.start(port=port)
+    print(f"fake Bot API on {url}  (BOT_API_URL={url})")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(dict(fake.calls))
+    finally:
+        await fake.stop()
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Fake Telegram Bot API for load tests")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency-ms", type=float, default=0)
+    args = ap.parse_args()
+    asyncio.run(_serve(args.port, args.latency_ms / 1000))
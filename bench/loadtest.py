@@ -0,0 +1,272 @@
+# bench/loadtest.py — сквозной нагрузочный прогон бота против фейкового Bot API
+#
+# Поднимает bench/fake_telegram.py в этом же процессе, направляет на него бота
+# (BOT_API_URL) и проигрывает синтетические сессии:
+#   покупатель: ID → confirm: → pay: → pre_checkout → successful_payment
+#   админ:      /add → текст → chantext:ok → haslink:no → оригинал → контакт → photos:no
+# Режимы: webhook (FastAPI-приложение webhook.py) и polling (bot.main()).
+# Итог — пропускная способность и p50/p95/p99 по каждому хендлеру.
+#
+#   python bench/loadtest.py --mode webhook --buyers 500 --concurrency 50
+#   python bench/loadtest.py --mode polling --json bench_output.json
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import itertools
+import tempfile
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH"
+ADMIN = 1
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Recorder:
+    """Outer-middleware на апдейты + inner на хендлеры: кто обработал апдейт и когда закончил."""
+
+    def __init__(self):
+        self.sent_at: Dict[int, float] = {}
+        self.handler: Dict[int, str] = {}
+        self.done: Dict[int, asyncio.Event] = {}
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+
+    def expect(self, update_id: int) -> asyncio.Event:
+        self.sent_at[update_id] = time.perf_counter()
+        ev = self.done[update_id] = asyncio.Event()
+        return ev
+
+    async def outer(self, handler: Callable, event: Any, data: Dict[str, Any]) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            uid = event.update_id
+            name = self.handler.pop(uid, "<unhandled>")
+            started = self.sent_at.pop(uid, None)
+            if started is not None:
+                self.latency[name].append(time.perf_counter() - started)
+            ev = self.done.pop(uid, None)
+            if ev is not None:
+                ev.set()
+
+    async def inner(self, handler: Callable, event: Any, data: Dict[str, Any]) -> Any:
+        update = data.get("event_update")
+        if update is not None:
+            self.handler[update.update_id] = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+class Driver:
+    def __init__(self, feed: Callable[[Dict[str, Any]], Awaitable[None]], recorder: Recorder, timeout: float):
+        self.feed = feed
+        self.rec = recorder
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self.timeouts = 0
+
+    async def send(self, payload: Dict[str, Any]) -> None:
+        uid = next(self._ids)
+        ev = self.rec.expect(uid)
+        await self.feed({"update_id": uid, **payload})
+        try:
+            await asyncio.wait_for(ev.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+
+    # ── конструкторы апдейтов ──
+    @staticmethod
+    def _user(uid: int) -> Dict[str, Any]:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+    def _msg(self, uid: int, **fields: Any) -> Dict[str, Any]:
+        return {"message": {"message_id": next(self._ids), "date": int(time.time()),
+                            "chat": {"id": uid, "type": "private"}, "from": self._user(uid), **fields}}
+
+    def text(self, uid: int, text: str) -> Dict[str, Any]:
+        return self._msg(uid, text=text)
+
+    def callback(self, uid: int, data: str) -> Dict[str, Any]:
+        return {"callback_query": {
+            "id": str(next(self._ids)), "from": self._user(uid), "chat_instance": "bench", "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "text": "…"},
+        }}
+
+    def pre_checkout(self, uid: int, listing_id: str) -> Dict[str, Any]:
+        return {"pre_checkout_query": {"id": f"pcq{next(self._ids)}", "from": self._user(uid),
+                                       "currency": "CZK", "total_amount": 1900, "invoice_payload": listing_id}}
+
+    def paid(self, uid: int, listing_id: str) -> Dict[str, Any]:
+        charge = f"bench-{uid}-{listing_id}-{next(self._ids)}"
+        return self._msg(uid, successful_payment={
+            "currency": "CZK", "total_amount": 1900, "invoice_payload": listing_id,
+            "telegram_payment_charge_id": charge, "provider_payment_charge_id": charge,
+        })
+
+    # ── сценарии ──
+    async def buyer(self, uid: int, listing_id: str) -> None:
+        await self.send(self.text(uid, listing_id))
+        await self.send(self.callback(uid, f"confirm:{listing_id}"))
+        await self.send(self.callback(uid, f"pay:{listing_id}"))
+        await self.send(self.pre_checkout(uid, listing_id))
+        await self.send(self.paid(uid, listing_id))
+
+    async def admin(self, n: int) -> None:
+        listing_id = f"Z{n}"
+        await self.send(self.text(ADMIN, f"/add {listing_id}"))
+        await self.send(self.text(ADMIN, f"Квартира {n}, 2+kk"))
+        await self.send(self.callback(ADMIN, "chantext:ok"))
+        await self.send(self.callback(ADMIN, "haslink:no"))
+        await self.send(self.text(ADMIN, "Оригинальный текст объявления"))
+        await self.send(self.text(ADMIN, "https://t.me/owner"))
+        await self.send(self.callback(ADMIN, "photos:no"))
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    fake = FakeTelegram(latency=args.api_latency_ms / 1000)
+    api_url = await fake.start()
+
+    workdir = tempfile.mkdtemp(prefix="rentbot-bench-")
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "CHANNEL_ID": "@bench_channel",
+        "ADMIN_ID": str(ADMIN),
+        "PROVIDER_TOKEN": "bench-provider",     # боевой путь с send_invoice
+        "BOT_API_URL": api_url,
+        "DB_FILE": os.path.join(workdir, "listings.db"),
+        "RENDER_EXTERNAL_URL": "http://127.0.0.1",
+        "WEBHOOK_WORKERS": str(args.workers),
+    })
+    if not args.real_limits:
+        # меряем сам бот, а не лимиты Telegram
+        os.environ.setdefault("SEND_GLOBAL_RATE", "1000000")
+        os.environ.setdefault("SEND_PRIVATE_RATE", "1000000")
+        os.environ.setdefault("SEND_CHANNEL_PER_MIN", "100000000")
+        os.environ.setdefault("THROTTLE_LOOKUP", "1000000,1000000,0,0")
+
+    import db
+    import bot as app_bot
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)   # bot.py включает INFO на каждый запрос
+
+    await db.db_init()
+    for i in range(1, args.listings + 1):
+        await db.db_upsert(f"A{i}", f"Квартира {i}", f"https://t.me/owner{i}", "", "TEXT",
+                           f"Оригинал {i}", [], "PUBLISHED")
+
+    rec = Recorder()
+    app_bot.dp.update.outer_middleware(rec.outer)
+    for router in (app_bot.r_admin, app_bot.r_public):
+        for observer in (router.message, router.callback_query, router.pre_checkout_query):
+            observer.middleware(rec.inner)
+
+    stop: Callable[[], Awaitable[None]]
+    if args.mode == "webhook":
+        import httpx
+        import webhook
+        await webhook.app.router.startup()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=webhook.app), base_url="http://bench")
+
+        async def feed(update: Dict[str, Any]) -> None:
+            r = await client.post(webhook.WEBHOOK_PATH, json=update)
+            r.raise_for_status()
+
+        async def stop() -> None:
+            await client.aclose()
+            await webhook.app.router.shutdown()
+    else:
+        polling = asyncio.create_task(app_bot.main())
+        while not app_bot.BOT_USERNAME:
+            await asyncio.sleep(0.01)
+
+        async def feed(update: Dict[str, Any]) -> None:
+            fake.updates.put_nowait(update)
+
+        async def stop() -> None:
+            await app_bot.dp.stop_polling()
+            await polling
+
+    driver = Driver(feed, rec, args.timeout)
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def session(coro: Awaitable[None]) -> None:
+        async with sem:
+            await coro
+
+    async def admins() -> None:
+        # у админа один чат и одно FSM — его сессии идут строго друг за другом
+        for n in range(args.admin_sessions):
+            await driver.admin(n)
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        admins(),
+        *(session(driver.buyer(10_000 + u, f"A{u % args.listings + 1}")) for u in range(args.buyers)),
+    )
+    elapsed = time.perf_counter() - started
+    await stop()
+    await fake.stop()
+
+    total = sum(len(v) for v in rec.latency.values())
+    return {
+        "mode": args.mode,
+        "buyers": args.buyers,
+        "admin_sessions": args.admin_sessions,
+        "concurrency": args.concurrency,
+        "api_latency_ms": args.api_latency_ms,
+        "updates": total,
+        "timeouts": driver.timeouts,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(total / elapsed, 1) if elapsed else 0.0,
+        "handlers": {
+            name: {
+                "count": len(v),
+                "p50_ms": round(percentile(v, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(v, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(v, 0.99) * 1000, 2),
+            }
+            for name, v in sorted(rec.latency.items())
+        },
+        "api_calls": dict(fake.calls),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="End-to-end load test against a fake Bot API")
+    ap.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    ap.add_argument("--buyers", type=int, default=200, help="число сессий покупателей")
+    ap.add_argument("--admin-sessions", type=int, default=5, help="сессий мастера /add (идут подряд)")
+    ap.add_argument("--concurrency", type=int, default=50, help="одновременных покупателей")
+    ap.add_argument("--listings", type=int, default=100, help="объявлений в тестовой базе")
+    ap.add_argument("--workers", type=int, default=8, help="WEBHOOK_WORKERS для режима webhook")
+    ap.add_argument("--api-latency-ms", type=float, default=20, help="задержка ответа фейкового API")
+    ap.add_argument("--timeout", type=float, default=30, help="ожидание обработки одного апдейта, сек")
+    ap.add_argument("--real-limits", action="store_true", help="не отключать лимиты отправок и антифлуд")
+    ap.add_argument("--json", help="записать результат в файл")
+    ap.add_argument("--verbose", action="store_true", help="не глушить INFO-логи бота")
+    args = ap.parse_args()
+
+    result = asyncio.run(run(args))
+    out = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(out)
+    print(out)
+
+if __name__ == "__main__":
+    main()
@@ -2,24 +2,49 @@
 # Клиент платит 19 Kč; админ создаёт/редактирует объявления (ID) с режимом выдачи LINK/TEXT
 
 import os
-import sqlite3
-import json
+import re
+import time
 import asyncio
+import tempfile
+from datetime import datetime, timedelta
 import logging
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, NamedTuple, Tuple
 
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command, StateFilter
 from aiogram.filters.command import CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
-    LabeledPrice, PreCheckoutQuery, InputMediaPhoto
+    LabeledPrice, PreCheckoutQuery, InputMediaPhoto, BufferedInputFile
 )
 from dotenv import load_dotenv
 
+from fsm_storage import SQLiteStorage
+from purchases import record_purchase, user_purchases, has_purchased, InvoiceDedup
+from sender import SendScheduler, priority, PRIORITY_PAID, PRIORITY_PUBLISH, PRIORITY_ADMIN
+from publish_queue import PublishQueue, SkipJob
+from importer import import_file, detect_format
+from metrics import HandlerMetrics, ApiMetrics, funnel
+from cache import LRUCache
+from expiry import ExpirySweeper
+from cache_sync import CacheSync
+from analytics import FunnelStats, EVENTS
+from throttle import Throttle, Limit
+from outbox import DeliveryOutbox, SkipDelivery
+from profiler import Profiler
+from channels import (
+    parse_channels, deeplink_payload, split_payload,
+    pending_targets, mark_targets, reset_targets, set_targets, list_targets,
+)
+from subscriptions import Broadcaster, subscribe, list_subscriptions, unsubscribe, terms
+from db import Listing, on_change, db_archived, db_init, db_upsert, db_get, db_delete, db_set_status, db_page, db_search, cache_stats
+
 # ── LOGGING ─────────────────────────────────────────────────────
 logging.basicConfig(level=logging.INFO)
 
@@ -31,16 +56,50 @@ ADMIN_ID       = int(os.getenv("ADMIN_ID", "0"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "").lstrip("@")
 PRICE_HAL      = int(os.getenv("PRICE_HAL", "1900"))   # 19 Kč = 1900 геллеров
 CHANNEL_RAW    = os.getenv("CHANNEL_ID", "").strip()   # @username или -100...
+CHANNELS_RAW   = os.getenv("CHANNELS", "").strip()     # несколько каналов: "praha=@rent_praha,brno=-100…"
+BOT_API_URL    = os.getenv("BOT_API_URL", "").strip()  # свой Bot API сервер (локальный / фейковый для нагрузки)
+FSM_STORAGE    = os.getenv("FSM_STORAGE", "sqlite")     # sqlite | memory (старое поведение)
+FSM_TTL_HOURS  = float(os.getenv("FSM_TTL_HOURS", "72"))
 
 if not BOT_TOKEN:
     raise SystemExit("❌ BOT_TOKEN не задан в .env")
-if not CHANNEL_RAW:
+if not CHANNEL_RAW and not CHANNELS_RAW:
     raise SystemExit("❌ CHANNEL_ID не задан в .env")
 
-CHANNEL_ID = CHANNEL_RAW if CHANNEL_RAW.startswith("@") else int(CHANNEL_RAW)
+# ключ → канал; без CHANNELS — один CHANNEL_ID с пустым ключом (см. channels.py)
+CHANNELS = parse_channels(CHANNELS_RAW, CHANNEL_RAW)
+
+bot = Bot(
+    BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None,
+)
 
-bot = Bot(BOT_TOKEN)
-dp  = Dispatcher(storage=MemoryStorage())
+# все исходящие отправки проходят через планировщик лимитов (глобальный / личный чат / канал)
+send_scheduler = SendScheduler(
+    global_rate=float(os.getenv("SEND_GLOBAL_RATE", "30")),
+    private_rate=float(os.getenv("SEND_PRIVATE_RATE", "1")),
+    channel_per_minute=float(os.getenv("SEND_CHANNEL_PER_MIN", "20")),
+    max_retries=int(os.getenv("SEND_MAX_RETRIES", "3")),
+)
+bot.session.middleware(send_scheduler)
+# внутренний относительно планировщика: считает каждую реальную попытку, включая 429
+bot.session.middleware(ApiMetrics())
+
+# воронка по объявлениям: счётчики в памяти, в БД — батчем раз в несколько секунд
+funnel_stats = FunnelStats(flush_interval=float(os.getenv("STATS_FLUSH_SECONDS", "5")))
+
+invoice_dedup = InvoiceDedup(window=float(os.getenv("INVOICE_DEDUP_SECONDS", "60")))
+
+# черновики /add храним в SQLite: переживают редеплой и видны всем воркерам;
+# FSM_STORAGE=memory возвращает прежнее поведение (всё в памяти процесса)
+if FSM_STORAGE == "memory":
+    storage = MemoryStorage()
+else:
+    storage = SQLiteStorage(ttl=FSM_TTL_HOURS * 3600)
+dp  = Dispatcher(storage=storage)
+if isinstance(storage, SQLiteStorage):
+    # шаг мастера записан в БД до ответа — следующий апдейт чата увидит его в любом воркере
+    dp.update.outer_middleware(storage.flush_after)
 
 # два раздельных роутера
 r_public = Router(name="public")
@@ -50,6 +109,36 @@ r_admin  = Router(name="admin")
 r_admin.message.filter(F.from_user.id == ADMIN_ID)
 r_admin.callback_query.filter(F.from_user.id == ADMIN_ID)
 
+# антифлуд публичных хендлеров: лимит выбирается флагом хендлера flags={"throttle": ...}
+# env THROTTLE_<ИМЯ>="в_сек,всплеск,общий_в_сек,общий_всплеск" (общий 0 — без общего лимита)
+def _limit(name: str, default: str) -> Limit:
+    return Limit(*(float(x) for x in os.getenv(f"THROTTLE_{name.upper()}", default).split(",")))
+
+throttle = Throttle(
+    limits={
+        "lookup":  _limit("lookup", "0.5,5,30,60"),    # ввод ID, deep-link, поиск — каждый стоит чтения БД
+        "contact": _limit("contact", "1,3,0,0"),       # кнопка «Получить контакт»
+        "pay":     _limit("pay", "0.5,4,0,0"),         # confirm:/pay: — без общего лимита, это деньги
+    },
+    exempt={ADMIN_ID},
+    cooldown=float(os.getenv("THROTTLE_COOLDOWN", "10")),
+)
+r_public.message.middleware(throttle)
+r_public.callback_query.middleware(throttle)
+
+# выборочный cProfile апдейтов: PROFILE=1 включает с запуска, иначе — /profile start
+profiler = Profiler(
+    sample=float(os.getenv("PROFILE_SAMPLE", "0.1")),
+    enabled=os.getenv("PROFILE", "0") == "1",
+)
+dp.update.outer_middleware(profiler)
+
+# латентность и ошибки хендлеров по роутеру (public/admin) → /metrics
+for _router in (r_admin, r_public):
+    for _observer in (_router.message, _router.callback_query, _router.pre_checkout_query):
+        _observer.middleware(HandlerMetrics())
+        _observer.middleware(profiler.tag)
+
 # подключаем роутеры
 dp.include_router(r_admin)
 dp.include_router(r_public)
@@ -66,95 +155,25 @@ class AddListing(StatesGroup):
     photos_choice = State()   # добавить фото?
     photos        = State()   # загрузка фото (до 9)
 
+class ImportListings(StatesGroup):
+    document = State()        # ждём файл JSONL/CSV
+
 # ── Черновики в БД ───────────────────────────────────────────────────────────
 
 # ── База (SQLite) ────────────────────────────────────────────────────────────
-DB_FILE = "listings.db"
-
-# --- DB helpers -------------------------------------------------
-
-def db_init():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS listings (
-            id           TEXT PRIMARY KEY,
-            text         TEXT NOT NULL,
-            link         TEXT NOT NULL,
-            post_url     TEXT DEFAULT '',
-            deliver_mode TEXT DEFAULT 'TEXT',
-            orig_text    TEXT DEFAULT '',
-            photos       TEXT DEFAULT '[]',     -- JSON: [file_id, ...]
-            status       TEXT DEFAULT 'DRAFT'   -- DRAFT | PUBLISHED
-        )
-    """)
-    # авто-миграции для старых БД
-    cur.execute("PRAGMA table_info(listings)")
-    cols = [row[1] for row in cur.fetchall()]
-    if "photos" not in cols:
-        cur.execute("ALTER TABLE listings ADD COLUMN photos TEXT DEFAULT '[]'")
-    if "status" not in cols:
-        cur.execute("ALTER TABLE listings ADD COLUMN status TEXT DEFAULT 'DRAFT'")
-    conn.commit()
-    conn.close()
-
-def db_upsert(listing_id: str, channel_text: str, link: str,
-              post_url: str, deliver_mode: str, orig_text: str,
-              photos: List[str], status: str = "DRAFT") -> None:
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO listings (id, text, link, post_url, deliver_mode, orig_text, photos, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(id) DO UPDATE SET
-            text=excluded.text,
-            link=excluded.link,
-            post_url=excluded.post_url,
-            deliver_mode=excluded.deliver_mode,
-            orig_text=excluded.orig_text,
-            photos=excluded.photos,
-            status=excluded.status
-    """, (
-        listing_id, channel_text, link, post_url, deliver_mode, orig_text,
-        json.dumps(photos, ensure_ascii=False), status
-    ))
-    conn.commit()
-    conn.close()
-
-def db_get(listing_id: str) -> Optional[Tuple]:
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT text, link, post_url, deliver_mode, orig_text, photos, status
-        FROM listings WHERE id = ?
-    """, (listing_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
-
-def db_delete(listing_id: str) -> bool:
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM listings WHERE id = ?", (listing_id,))
-    ok = cur.rowcount > 0
-    conn.commit()
-    conn.close()
-    return ok
-
-def db_set_status(listing_id: str, status: str) -> None:
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("UPDATE listings SET status=? WHERE id=?", (status, listing_id))
-    conn.commit()
-    conn.close()
+# весь доступ к БД — в db.py: async-хелперы db_*, запросы выполняются вне event loop
 
 # ── Клавиатуры (клиент) ──────────────────────────────────────────────────────
+# клавиатуры без параметров собираются один раз при импорте и переиспользуются
 def kb_main() -> InlineKeyboardMarkup:
-    rows = [[InlineKeyboardButton(text="🔎 Получить контакт", callback_data="get_contact")]]
+    rows = [[InlineKeyboardButton(text="🔎 Получить контакт", callback_data="get_contact")],
+            [InlineKeyboardButton(text="🧾 Мои покупки", callback_data="my")]]
     if ADMIN_USERNAME:
         rows.append([InlineKeyboardButton(text="🗣️ Поддержка", url=f"https://t.me/{ADMIN_USERNAME}")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+KB_MAIN = kb_main()
+
 def kb_confirm(listing_id: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="✅ Да, это оно", callback_data=f"confirm:{listing_id}"),
@@ -174,12 +193,14 @@ def kb_support(listing_id: str = "") -> InlineKeyboardMarkup:
         rows.append([InlineKeyboardButton(text="🗣️ Поддержка", url=f"https://t.me/{ADMIN_USERNAME}")])
     return InlineKeyboardMarkup(inline_keyboard=rows or [[]])
 
-def kb_deeplink(listing_id: str) -> InlineKeyboardMarkup:
+KB_SUPPORT = kb_support()
+
+def kb_deeplink(listing_id: str, channel: str = "") -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[[
             InlineKeyboardButton(
                 text="🔓 Получить контакт",
-                url=f"https://t.me/{BOT_USERNAME}?start={listing_id}"
+                url=f"https://t.me/{BOT_USERNAME}?start={deeplink_payload(listing_id, channel)}"
             )
         ]]
     )
@@ -197,6 +218,8 @@ def kb_admin_panel() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🆔 Мой ID",           callback_data="adm:whoami")],
     ])
 
+KB_ADMIN_PANEL = kb_admin_panel()
+
 def kb_yes_no_link() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, есть публичная ссылка", callback_data="haslink:yes")],
@@ -204,6 +227,8 @@ def kb_yes_no_link() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_add")]
     ])
 
+KB_YES_NO_LINK = kb_yes_no_link()
+
 def kb_channel_text_confirm() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👍 Всё верно", callback_data="chantext:ok")],
@@ -211,6 +236,8 @@ def kb_channel_text_confirm() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="❌ Отмена",   callback_data="cancel_add")],
     ])
 
+KB_CHANNEL_TEXT_CONFIRM = kb_channel_text_confirm()
+
 def kb_photos_choice() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🖼 Добавить фото", callback_data="photos:yes")],
@@ -218,12 +245,16 @@ def kb_photos_choice() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_add")]
     ])
 
+KB_PHOTOS_CHOICE = kb_photos_choice()
+
 def kb_finish_preview() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Сформировать предпросмотр", callback_data="finish_add")],
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_add")]
     ])
 
+KB_FINISH_PREVIEW = kb_finish_preview()
+
 def kb_preview(listing_id: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Опубликовать", callback_data=f"publish:{listing_id}"),
@@ -231,8 +262,95 @@ def kb_preview(listing_id: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_add")]
     ])
 
+# ── Рендер-кэш объявлений ────────────────────────────────────────────────────
+# Всё, что зависит от объявления (карточка, выдача после оплаты, клавиатуры),
+# собирается один раз — при db_upsert или первом обращении — и живёт, пока
+# объявление не изменится. Запись кэша привязана к конкретному объекту Listing:
+# если db.listing_cache отдал другой объект, рендер устарел.
+CARD_HINT = "ℹ️ После оплаты получишь оригинальный текст и контакт автора; если есть ссылка на оригинал — пришлю её тоже."
+PAY_TEXT = (
+    "💳 Чтобы получить контакт владельца, необходимо оплатить *19 Kč*.\n\n"
+    "✅ Сразу после успешной оплаты я отправлю\n"
+    "прямой контакт владельца 📲"
+)
+ALERT_TITLE = "🔔 Новое объявление по твоей подписке"
+MESSAGE_LIMIT = 4096
+
+class Rendered(NamedTuple):
+    card: str                          # «Проверь объявление» (ввод ID и deep-link)
+    kb_confirm: InlineKeyboardMarkup
+    kb_pay: InlineKeyboardMarkup
+    kb_support: InlineKeyboardMarkup   # «Повторить оплату» + поддержка
+    delivery: Tuple[str, ...]          # выдача после оплаты; обычно одно сообщение
+    kb_deeplinks: Dict[str, InlineKeyboardMarkup]  # кнопка под постом — своя для каждого канала
+    alert: str                         # рассылка подписчикам (кнопки — kb_confirm)
+
+render_cache = LRUCache(int(os.getenv("RENDER_CACHE_SIZE", "1024")), float("inf"))
+
+def _pack(parts: List[str], limit: int = MESSAGE_LIMIT) -> Tuple[str, ...]:
+    """Склеить части в как можно меньше сообщений не длиннее limit."""
+    messages: List[str] = []
+    for part in parts:
+        if messages and len(messages[-1]) + 2 + len(part) <= limit:
+            messages[-1] += "\n\n" + part
+        else:
+            messages.append(part)
+    return tuple(messages)
+
+def render_listing(listing_id: str, row: Listing) -> Rendered:
+    channel_text, contact_link, post_url, _deliver, orig_text, *_ = row
+    final_text = (orig_text or "").strip() or channel_text
+    parts = [
+        "✅ Оплата получена.\nВот данные по объявлению:",
+        f"📝 Оригинальный текст:\n\n{final_text}",
+        f"📞 Контакт для связи:\n{contact_link}",
+    ]
+    if post_url:
+        parts.append(f"🔗 Ссылка на оригинал:\n{post_url}")
+    card = f"📋 Проверь объявление (ID {listing_id}):\n\n{channel_text}\n\n{CARD_HINT}"
+    return Rendered(
+        card=card,
+        kb_confirm=kb_confirm(listing_id),
+        kb_pay=kb_pay(listing_id),
+        kb_support=kb_support(listing_id),
+        delivery=_pack(parts),
+        kb_deeplinks={key: kb_deeplink(listing_id, key) for key in CHANNELS},
+        alert=f"{ALERT_TITLE}\n\n{card}"[:MESSAGE_LIMIT],
+    )
+
+@on_change
+def _on_listing_change(listing_id: Optional[str], row: Optional[Listing]) -> None:
+    if listing_id is None:
+        render_cache.clear()
+    elif row is None:
+        render_cache.pop(listing_id)
+    elif BOT_USERNAME:
+        # до старта имя бота неизвестно (нужно для deep-link) — тогда отрисуем лениво
+        render_cache.set(listing_id, (row, render_listing(listing_id, row)))
+
+async def get_rendered(listing_id: str, archived: bool = False) -> Optional[Rendered]:
+    """Готовый рендер объявления или None, если его нет. В горячем пути — без БД и сборки строк.
+    archived=True — искать и среди просроченных (выдача уже оплаченного)."""
+    row = await db_get(listing_id)
+    if row is None and archived:
+        row = await db_archived(listing_id)
+    if row is None:
+        return None
+    cached = render_cache.get(listing_id)
+    if cached is not None and cached[0] is row:
+        return cached[1]
+    rendered = render_listing(listing_id, row)
+    render_cache.set(listing_id, (row, rendered))
+    return rendered
+
+EXPIRED_TEXT = "⌛ Объявление {} уже неактуально — его сняли с публикации. Загляни в канал за свежими."
+
+async def not_found_text(listing_id: str, text: str) -> str:
+    """Для просроченного (архивного) ID — «неактуально», иначе переданный текст."""
+    return EXPIRED_TEXT.format(listing_id) if await db_archived(listing_id) else text
+
 # ── Клиент: /start + deeplink ────────────────────────────────────────────────
-@r_public.message(Command("start"))
+@r_public.message(Command("start"), flags={"throttle": "lookup"})
 async def cmd_start(m: Message, command: CommandObject):
     text = (
         "👋 Привет! Я помогу тебе быстро получить прямые контакты владельцев квартир и комнат.\n\n"
@@ -249,112 +367,112 @@ async def cmd_start(m: Message, command: CommandObject):
         "после появления объявления. Чтобы не упустить вариант, лучше как можно раньше получить контакт и написать владельцу.\n\n"
         "➡️ Жми кнопку ниже, чтобы начать."
     )
-    await m.answer(text, reply_markup=kb_main())
+    await m.answer(text, reply_markup=KB_MAIN)
 
     # Автоподхват ID, если человек пришёл по deep-link: t.me/<bot>?start=A123
     if command.args:
-        listing_id = command.args.strip().upper()
-        row = db_get(listing_id)
-        if row:
-            channel_text, _, post_url, deliver, _, *_ = row
-            hint = "ℹ️ После оплаты получишь оригинальный текст и контакт автора; если есть ссылка на оригинал — пришлю её тоже."
-            await m.answer(
-                f"📋 Проверь объявление (ID {listing_id}):\n\n{channel_text}\n\n{hint}",
-                reply_markup=kb_confirm(listing_id)
-            )
+        # A101 или A101_<канал> — кнопка из поста в одном из каналов
+        listing_id, _channel = split_payload(command.args)
+        r = await get_rendered(listing_id)
+        if r:
+            funnel_stats.record(listing_id, "lookup")
+            await m.answer(r.card, reply_markup=r.kb_confirm)
         else:
-            await m.answer("⚠️ Такого ID нет. Проверь пост в канале или напиши администратору.", reply_markup=kb_support())
+            await m.answer(await not_found_text(listing_id, "⚠️ Такого ID нет. Проверь пост в канале или напиши администратору."),
+                           reply_markup=KB_SUPPORT)
 
 # ── Клиент: ввод ID → подтверждение → оплата → выдача ────────────────────────
-@r_public.callback_query(F.data == "get_contact")
+@r_public.callback_query(F.data == "get_contact", flags={"throttle": "contact"})
 async def ask_id(call: CallbackQuery):
     await call.message.answer("✍️ Напиши **ID** объявления (пример: `A101`).")
     await call.answer()
 
-@r_public.message(F.text.regexp(r"^[A-Za-z]\d+$"))
+@r_public.message(F.text.regexp(r"^[A-Za-z]\d+$"), flags={"throttle": "lookup"})
 async def on_id(m: Message):
     listing_id = m.text.strip().upper()
-    row = db_get(listing_id)
-    if not row:
-        return await m.answer("⚠️ Такого ID нет. Проверь в канале или напиши администратору.", reply_markup=kb_support())
-    channel_text, _, post_url, deliver, _, *_ = row
-    hint = (
-    "ℹ️ После оплаты я пришлю текст оригинального объявления и прямой контакт автора. "
-)
-    await m.answer(f"📋 Проверь объявление (ID {listing_id}):\n\n{channel_text}\n\n{hint}", reply_markup=kb_confirm(listing_id))
-
-@r_public.callback_query(F.data.startswith("confirm:"))
+    r = await get_rendered(listing_id)
+    funnel.inc("lookup" if r else "lookup_miss")
+    if not r:
+        return await m.answer(await not_found_text(listing_id, "⚠️ Такого ID нет. Проверь в канале или напиши администратору."),
+                              reply_markup=KB_SUPPORT)
+    funnel_stats.record(listing_id, "lookup")
+    await m.answer(r.card, reply_markup=r.kb_confirm)
+
+@r_public.callback_query(F.data.startswith("confirm:"), flags={"throttle": "pay"})
 async def on_confirm(call: CallbackQuery):
     listing_id = call.data.split(":")[1]
-    if not db_get(listing_id):
-        await call.message.answer("❌ Объявление не найдено.", reply_markup=kb_support())
+    r = await get_rendered(listing_id)
+    if not r:
+        await call.message.answer(await not_found_text(listing_id, "❌ Объявление не найдено."), reply_markup=KB_SUPPORT)
         return await call.answer()
-
-    text = (
-        "💳 Чтобы получить контакт владельца, необходимо оплатить *19 Kč*.\n\n"
-        "✅ Сразу после успешной оплаты я отправлю\n"
-        "прямой контакт владельца 📲"
-    )
-
-    pay_kb = InlineKeyboardMarkup(inline_keyboard=[[
-    InlineKeyboardButton(text="💳 Оплатить 19 Kč", callback_data=f"pay:{listing_id}")
-    ]])
-
-    await call.message.answer(text, reply_markup=pay_kb, parse_mode="Markdown")
+    funnel.inc("confirm")
+    funnel_stats.record(listing_id, "confirm")
+    await call.message.answer(PAY_TEXT, reply_markup=r.kb_pay, parse_mode="Markdown")
     await call.answer()
 
 # ───────Клиент: оплата 
 # ───────Клиент: оплата / выдача доступа
-async def _deliver_access(user_id: int, listing_id: str):
-    row = db_get(listing_id)
-    if not row:
-        await bot.send_message(
-            user_id,
-            "❌ Объявление не найдено. Напиши администратору.",
-            reply_markup=kb_support()
-        )
-        return
+async def _deliver_access(user_id: int, listing_id: str, repeat: bool = False):
+    # оплаченная выдача обгоняет остальные отправки в очереди лимитов
+    with priority(PRIORITY_PAID):
+        # оплачено — выдаём, даже если объявление успело уйти в архив
+        r = await get_rendered(listing_id, archived=True)
+        if not r:
+            await bot.send_message(
+                user_id,
+                "❌ Объявление не найдено. Напиши администратору.",
+                reply_markup=KB_SUPPORT
+            )
+            # оплачено, а выдать нечего — строка outbox уходит в FAILED, админ получает алерт
+            raise SkipDelivery(f"объявления {listing_id} нет ни в базе, ни в архиве")
 
-    channel_text, contact_link, post_url, _deliver, orig_text, *_ = row
-    final_text = (orig_text or "").strip() or channel_text
+        # обычно одно сообщение; кнопки — под последним
+        *head, last = r.delivery
+        for text in head:
+            await bot.send_message(user_id, text)
+        await bot.send_message(user_id, last, reply_markup=r.kb_support)
+        funnel.inc("redelivered" if repeat else "delivered")
 
-    await bot.send_message(user_id, "✅ Оплата получена.\nВот данные по объявлению:")
-    await bot.send_message(user_id, f"📝 Оригинальный текст:\n\n{final_text}")
-    await bot.send_message(user_id, f"📞 Контакт для связи:\n{contact_link}", reply_markup=kb_support(listing_id))
-    if post_url:
-        await bot.send_message(user_id, f"🔗 Ссылка на оригинал:\n{post_url}")
+async def _delivery_failed(user_id: int, listing_id: str, error: str):
+    await _notify_admin(f"⚠️ Не удалось выдать {listing_id} пользователю {user_id} (оплачено): {error}")
 
-@r_public.callback_query(F.data.startswith("pay:"))
+async def _redeliver(user_id: int, listing_id: str):
+    """Повторная выдача купленного прямо из хендлера (не через outbox)."""
+    try:
+        await _deliver_access(user_id, listing_id, repeat=True)
+    except SkipDelivery as e:
+        await _delivery_failed(user_id, listing_id, str(e))
+
+# выдачу оплаченного делает outbox (см. outbox.py): хендлер оплаты только пишет строку в БД
+delivery_outbox = DeliveryOutbox(
+    _deliver_access, on_fail=_delivery_failed,
+    max_attempts=int(os.getenv("DELIVERY_MAX_ATTEMPTS", "10")),
+    poll_interval=float(os.getenv("DELIVERY_POLL_SECONDS", "30")),
+)
+
+@r_public.callback_query(F.data.startswith("pay:"), flags={"throttle": "pay"})
 async def on_pay(call: CallbackQuery):
     _, listing_id = call.data.split(":")
-    if not db_get(listing_id):
-        await call.message.answer("❌ Объявление не найдено.", reply_markup=kb_support())
+    # уже куплено (в том числе ушедшее в архив) — выдаём ещё раз без счёта
+    if await has_purchased(call.from_user.id, listing_id):
+        await call.answer("Ты уже купил это объявление — отправляю данные ещё раз.")
+        return await _redeliver(call.from_user.id, listing_id)
+    if not await db_get(listing_id):
+        await call.message.answer(await not_found_text(listing_id, "❌ Объявление не найдено."), reply_markup=KB_SUPPORT)
         return await call.answer()
+    funnel.inc("pay")
+    funnel_stats.record(listing_id, "pay")
 
     # ДЕМО: без инвойса — сразу выдаём доступ
     if not PROVIDER_TOKEN or PROVIDER_TOKEN.upper() == "TEST":
         await call.message.answer("🧪 Демо-режим: платежи не настроены. Выдаю доступ без списания средств.")
-        await _deliver_access(call.from_user.id, listing_id)
+        await record_purchase(call.from_user.id, listing_id)
+        delivery_outbox.wake()
         return await call.answer()
 
-    # ПРОД: реальный счёт (один раз)
-    try:
-        price = LabeledPrice(label=f"Доступ к объявлению {listing_id}", amount=PRICE_HAL)
-        await bot.send_invoice(
-            call.from_user.id,
-            title="Доступ к объявлению",
-            description=f"Разовый доступ к данным по ID {listing_id}. Стоимость: 19 Kč.",
-            provider_token=PROVIDER_TOKEN,
-            currency="CZK",
-            prices=[price],
-            start_parameter="pay_contact",
-            payload=listing_id
-        )
-    except Exception as e:
-        logging.exception("send_invoice failed")
-        await call.message.answer(f"⚠️ Не удалось создать счёт: {e}", reply_markup=kb_support(listing_id))
-    finally:
-        await call.answer()
+    # двойной тап по «Оплатить» не плодит счета
+    if invoice_dedup.seen(call.from_user.id, listing_id):
+        return await call.answer("Счёт уже отправлен — он чуть выше в чате.")
 
     # === Реальная оплата через Telegram Payments ===
     try:
@@ -369,25 +487,182 @@ async def on_pay(call: CallbackQuery):
             start_parameter="pay_contact",
             payload=listing_id
         )
+        funnel.inc("invoice_sent")
     except Exception as e:
         # покажем причину, чтобы сразу увидеть, что не так с токеном/настройкой
         logging.exception("send_invoice failed")
+        invoice_dedup.forget(call.from_user.id, listing_id)
         await call.message.answer(f"⚠️ Не удалось создать счёт: {e}\n\nПроверь PROVIDER_TOKEN в .env или попроси помощь.", reply_markup=kb_support(listing_id))
     finally:
         await call.answer()
 
 @r_public.pre_checkout_query()
 async def on_pre_checkout(q: PreCheckoutQuery):
-    ok = db_get(q.invoice_payload) is not None
-    await bot.answer_pre_checkout_query(
-        q.id, ok=ok,
-        error_message="Объявление не найдено. Деньги не списаны. Обратитесь к администратору."
-    )
+    ok = await db_get(q.invoice_payload) is not None
+    funnel.inc("pre_checkout_ok" if ok else "pre_checkout_rejected")
+    if ok:
+        funnel_stats.record(q.invoice_payload, "pre_checkout")
+        return await bot.answer_pre_checkout_query(q.id, ok=True)
+    if await db_archived(q.invoice_payload):
+        error = "Объявление уже неактуально. Деньги не списаны."
+    else:
+        error = "Объявление не найдено. Деньги не списаны. Обратитесь к администратору."
+    await bot.answer_pre_checkout_query(q.id, ok=False, error_message=error)
 
 @r_public.message(F.successful_payment)
 async def on_success(m: Message):
-    listing_id = m.successful_payment.invoice_payload
-    await _deliver_access(m.chat.id, listing_id)
+    sp = m.successful_payment
+    listing_id = sp.invoice_payload
+    # повторная доставка того же платежа (ретрай Telegram) не даёт второй выдачи
+    is_new = await record_purchase(
+        m.chat.id, listing_id,
+        charge_id=sp.telegram_payment_charge_id,
+        provider_charge_id=sp.provider_payment_charge_id,
+        amount=sp.total_amount, currency=sp.currency,
+    )
+    if not is_new:
+        logging.warning("duplicate successful_payment %s ignored", sp.telegram_payment_charge_id)
+        return
+    funnel.inc("paid")
+    funnel_stats.record(listing_id, "paid")
+    # покупка и строка на выдачу уже в БД одной транзакцией — выдаст outbox
+    delivery_outbox.wake()
+
+# ── Мои покупки: /my — повторная выдача без нового счёта
+MY_LIMIT = 20
+
+async def render_my(user_id: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    bought = await user_purchases(user_id, MY_LIMIT)
+    if not bought:
+        return "🧾 Покупок пока нет. Введи ID объявления из канала, чтобы получить контакт.", None
+    buttons = []
+    for listing_id, _at in bought:
+        row = await db_get(listing_id) or await db_archived(listing_id)
+        title = row.text.strip().split("\n", 1)[0][:40] if row else ""
+        label = f"📄 {listing_id} — {title}" if title else f"📄 {listing_id}"
+        buttons.append([InlineKeyboardButton(text=label, callback_data=f"my:{listing_id}")])
+    text = "🧾 Твои покупки — нажми, чтобы получить данные ещё раз (бесплатно):"
+    if len(bought) == MY_LIMIT:
+        text += f"\n(показаны последние {MY_LIMIT})"
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@r_public.message(Command("my"), flags={"throttle": "lookup"})
+async def my_cmd(m: Message):
+    text, kb = await render_my(m.from_user.id)
+    await m.answer(text, reply_markup=kb)
+
+@r_public.callback_query(F.data == "my", flags={"throttle": "lookup"})
+async def my_button(call: CallbackQuery):
+    text, kb = await render_my(call.from_user.id)
+    await call.message.answer(text, reply_markup=kb)
+    await call.answer()
+
+@r_public.callback_query(F.data.startswith("my:"), flags={"throttle": "pay"})
+async def my_redeliver(call: CallbackQuery):
+    listing_id = call.data.split(":", 1)[1]
+    # callback_data приходит от клиента — выдаём только то, что действительно куплено
+    if not await has_purchased(call.from_user.id, listing_id):
+        return await call.answer("Это объявление не куплено.", show_alert=True)
+    await call.answer("Отправляю ещё раз.")
+    await _redeliver(call.from_user.id, listing_id)
+
+# ── Поиск по объявлениям: /search <слова>
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))
+
+def _search_cb(offset: int, words: str) -> str:
+    # callback_data ≤ 64 байт: запрос обрезаем по байтам, не разрывая символ
+    prefix = f"srch:{offset}:"
+    return prefix + words.encode()[:64 - len(prefix.encode())].decode("utf-8", "ignore")
+
+async def render_search(words: str, offset: int, is_admin: bool) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    # админ ищет и по черновикам, покупатели — только по опубликованным
+    rows, has_next = await db_search(words, "" if is_admin else "PUBLISHED", SEARCH_PAGE_SIZE, offset)
+    if not rows:
+        return ("🔍 Ничего не нашлось. Попробуй другие слова или введи ID из канала." if offset == 0
+                else "🔍 Больше результатов нет."), None
+
+    lines = [f"🔍 Результаты по «{words}»:\n"]
+    buttons = []
+    for lid, txt, st in rows:
+        short = (txt[:80] + "…") if len(txt) > 80 else txt
+        lines.append(f"🔹 {lid}{(' — ' + st) if is_admin else ''} — {short}")
+        buttons.append([InlineKeyboardButton(text=f"✅ {lid}", callback_data=f"confirm:{lid}")])
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton(text="◀", callback_data=_search_cb(max(0, offset - SEARCH_PAGE_SIZE), words)))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶", callback_data=_search_cb(offset + SEARCH_PAGE_SIZE, words)))
+    if nav:
+        buttons.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@r_public.message(Command("search"), flags={"throttle": "lookup"})
+async def search_cmd(m: Message, command: CommandObject):
+    words = (command.args or "").strip()
+    if not words:
+        return await m.answer("🔍 Напиши, что искать: /search 2+kk Жижков")
+    text, kb = await render_search(words, 0, m.from_user.id == ADMIN_ID)
+    await m.answer(text, reply_markup=kb)
+
+@r_public.callback_query(F.data.startswith("srch:"), flags={"throttle": "lookup"})
+async def search_page(call: CallbackQuery):
+    _, offset, words = call.data.split(":", 2)
+    text, kb = await render_search(words, int(offset), call.from_user.id == ADMIN_ID)
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await call.answer()
+
+# ── Подписки на новые объявления: /subscribe, /unsubscribe
+MAX_SUBSCRIPTIONS = int(os.getenv("MAX_SUBSCRIPTIONS", "10"))
+MAX_SUBSCRIPTION_WORDS = 5
+SUBSCRIBE_HELP = (
+    "🔔 Подписка на новые объявления\n\n"
+    "/subscribe <слова> — присылать новые объявления, где есть все эти слова\n"
+    "   например: /subscribe 2+kk Praha 5\n"
+    "/subscribe * — присылать все новые объявления\n"
+    "/unsubscribe <номер> — отменить подписку, /unsubscribe all — все"
+)
+
+async def _subscriptions_text(user_id: int) -> Tuple[str, List[Tuple[int, str]]]:
+    subs = await list_subscriptions(user_id)
+    if not subs:
+        return "У тебя пока нет подписок.", subs
+    lines = ["Твои подписки:"]
+    lines += [f"{n}. {query or 'все объявления'}" for n, (_id, query) in enumerate(subs, 1)]
+    return "\n".join(lines), subs
+
+@r_public.message(Command("subscribe"), flags={"throttle": "contact"})
+async def subscribe_cmd(m: Message, command: CommandObject):
+    arg = (command.args or "").strip()
+    if not arg:
+        text, _ = await _subscriptions_text(m.from_user.id)
+        return await m.answer(f"{SUBSCRIBE_HELP}\n\n{text}")
+    words = [] if arg == "*" else terms(arg)
+    if arg != "*" and not words:
+        return await m.answer("⚠️ Не нашёл слов для поиска. Пример: /subscribe 2+kk Praha 5")
+    if len(words) > MAX_SUBSCRIPTION_WORDS:
+        return await m.answer(f"⚠️ Не больше {MAX_SUBSCRIPTION_WORDS} слов в одной подписке.")
+    added = await subscribe(m.from_user.id, words, MAX_SUBSCRIPTIONS)
+    if added is None:
+        return await m.answer(f"⚠️ Можно не больше {MAX_SUBSCRIPTIONS} подписок. Удали лишние: /unsubscribe <номер>")
+    what = " ".join(words) or "все объявления"
+    await m.answer(f"✅ Подписка «{what}» оформлена. Пришлю новые объявления, как только они выйдут в канале."
+                   if added else f"Подписка «{what}» у тебя уже есть.")
+
+@r_public.message(Command("unsubscribe"), flags={"throttle": "contact"})
+async def unsubscribe_cmd(m: Message, command: CommandObject):
+    arg = (command.args or "").strip().lower()
+    if arg == "all":
+        n = await unsubscribe(m.from_user.id)
+        return await m.answer("🔕 Все подписки отменены." if n else "У тебя нет подписок.")
+    text, subs = await _subscriptions_text(m.from_user.id)
+    if not arg.isdigit() or not 1 <= int(arg) <= len(subs):
+        return await m.answer(f"Укажи номер подписки: /unsubscribe 1 (или all)\n\n{text}")
+    sub_id, query = subs[int(arg) - 1]
+    await unsubscribe(m.from_user.id, sub_id)
+    await m.answer(f"🔕 Подписка «{query or 'все объявления'}» отменена.")
 
 # ── Пользовательская помощь
 @r_public.message(Command("help"))
@@ -398,6 +673,9 @@ async def help_cmd(m: Message):
         "• После оплаты я отправлю контакт автора оригинального объявления. Все посты в канале актуальны и опубликованы у нас не позднее 8-и часов после публикации оригинального объявления.\n\n"
         "Команды:\n"
         "/start — начать\n"
+        "/search <слова> — поиск объявлений\n"
+        "/subscribe <слова> — уведомления о новых объявлениях\n"
+        "/my — мои покупки: получить контакт ещё раз бесплатно\n"
         "/help — помощь\n"
     )
     if m.from_user.id == ADMIN_ID:
@@ -406,9 +684,18 @@ async def help_cmd(m: Message):
             "👑 Админ-команды:\n"
             "/admin — панель админа (кнопки)\n"
             "/add <ID> — создать/редактировать объявление\n"
-            "/listings — список всех ID в базе\n"
+            "/listings — список ID в базе (по страницам, с фильтром статуса)\n"
             "/delete <ID> — удалить объявление из базы\n"
+            "/import — загрузить объявления из файла JSONL/CSV\n"
+            "/publish <ID> [+30m|18:30] — поставить в очередь публикации\n"
+            "/queue — очередь публикаций, /unqueue <ID> — убрать из неё\n"
+            "/targets <ID> [каналы|all] — в какие каналы публиковать\n"
             "/whoami — показать твой numeric ID\n"
+            "/cache — счётчики кэша объявлений\n"
+            "/limits — счётчики лимитов отправки\n"
+            "/stats [ID|today|7d] — воронка: просмотры → оплаты\n"
+            "/broadcasts — рассылки подписчикам и их прогресс\n"
+            "/profile start [доля]|stop|dump|reset — профилирование апдейтов\n"
         )
         await m.answer(user_help + admin_help)
     else:
@@ -424,24 +711,12 @@ async def whoami(message: Message):
 # ── Админ-панель (/admin) и её кнопки
 @r_admin.message(Command("admin"))
 async def admin_panel_cmd(m: Message):
-    await m.answer("🔧 Панель администратора:", reply_markup=kb_admin_panel())
+    await m.answer("🔧 Панель администратора:", reply_markup=KB_ADMIN_PANEL)
 
 @r_admin.callback_query(F.data == "adm:list")
 async def adm_list(call: CallbackQuery):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT id, text, status FROM listings ORDER BY id COLLATE NOCASE")
-    rows = cur.fetchall()
-    conn.close()
-
-    if not rows:
-        await call.message.answer("📭 База объявлений пуста.")
-    else:
-        lines = ["📋 Список объявлений:\n"]
-        for lid, txt, st in rows:
-            short = (txt[:60] + "…") if len(txt) > 60 else txt
-            lines.append(f"🔹 {lid} — {st} — {short}")
-        await call.message.answer("\n".join(lines))
+    text, kb = await render_listings_page()
+    await call.message.answer(text, reply_markup=kb)
     await call.answer()
 
 @r_admin.callback_query(F.data == "adm:add_hint")
@@ -470,21 +745,103 @@ async def adm_whoami(call: CallbackQuery):
     await call.message.answer(f"🆔 Твой ID: `{call.from_user.id}`", parse_mode="Markdown")
     await call.answer()
 
-# ── /listings — список всех ID (текстом)
+# ── /listings — постраничный список ID (◀/▶ редактируют то же сообщение)
+LISTINGS_PAGE_SIZE = int(os.getenv("LISTINGS_PAGE_SIZE", "20"))
+LISTING_FILTERS = {"A": "", "D": "DRAFT", "P": "PUBLISHED"}   # код в callback_data → статус
+
+async def render_listings_page(flt: str = "A", after: str = "",
+                               before: Optional[str] = None) -> Tuple[str, InlineKeyboardMarkup]:
+    status = LISTING_FILTERS.get(flt, "")
+    rows, has_prev, has_next = await db_page(status, after, before, LISTINGS_PAGE_SIZE)
+
+    if not rows:
+        text = "📭 База объявлений пуста." if not status else f"📭 Нет объявлений со статусом {status}."
+    else:
+        lines = [f"📋 Список объявлений{(' — ' + status) if status else ''}:\n"]
+        for lid, txt, st in rows:
+            short = (txt[:60] + "…") if len(txt) > 60 else txt
+            lines.append(f"🔹 {lid} — {st} — {short}")
+        text = "\n".join(lines)
+
+    filters = [
+        InlineKeyboardButton(text=("• " if code == flt else "") + title, callback_data=f"lst:{code}:n:")
+        for code, title in (("A", "Все"), ("D", "DRAFT"), ("P", "PUBLISHED"))
+    ]
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton(text="◀", callback_data=f"lst:{flt}:p:{rows[0][0]}"))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton(text="▶", callback_data=f"lst:{flt}:n:{rows[-1][0]}"))
+    return text, InlineKeyboardMarkup(inline_keyboard=[filters, nav] if nav else [filters])
+
 @r_admin.message(Command("listings"))
 async def list_listings(message: Message):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT id, text FROM listings ORDER BY id COLLATE NOCASE")
-    rows = cur.fetchall()
-    conn.close()
-    if not rows:
-        return await message.answer("📭 База объявлений пуста.")
-    lines = ["📋 Список объявлений:\n"]
-    for lid, txt in rows:
-        short = (txt[:60] + "…") if len(txt) > 60 else txt
-        lines.append(f"🔹 {lid} — {short}")
-    await message.answer("\n".join(lines))
+    text, kb = await render_listings_page()
+    await message.answer(text, reply_markup=kb)
+
+@r_admin.callback_query(F.data.startswith("lst:"))
+async def listings_page(call: CallbackQuery):
+    _, flt, direction, cursor = call.data.split(":", 3)
+    if direction == "p":
+        text, kb = await render_listings_page(flt, before=cursor)
+    else:
+        text, kb = await render_listings_page(flt, after=cursor)
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass   # «message is not modified» — та же страница
+    await call.answer()
+
+# ── /import — массовая загрузка объявлений из файла JSONL/CSV
+IMPORT_MAX_BYTES = 20 * 1024 * 1024   # больше бот скачать не может
+IMPORT_HELP = (
+    "📥 Пришли файл .jsonl или .csv — одна строка = одно объявление.\n"
+    "Поля: id, text, link (обязательные), post_url, deliver_mode (TEXT/LINK), "
+    "orig_text, photos (JSON-список file_id), status (DRAFT/PUBLISHED).\n"
+    "Существующие ID обновляются."
+)
+
+@r_admin.message(Command("import"), F.document)
+async def import_cmd_with_file(message: Message, state: FSMContext):
+    await run_import(message, state)
+
+@r_admin.message(Command("import"))
+async def import_cmd(message: Message, state: FSMContext):
+    await state.set_state(ImportListings.document)
+    await message.answer(IMPORT_HELP, reply_markup=CANCEL_KB)
+
+@r_admin.message(StateFilter(ImportListings.document), F.document)
+async def import_document(message: Message, state: FSMContext):
+    await run_import(message, state)
+
+async def run_import(message: Message, state: FSMContext):
+    await state.clear()
+    doc = message.document
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        return await message.answer("⚠️ Файл больше 20 МБ — раздели его на части.")
+
+    fd, path = tempfile.mkstemp(suffix=".import")
+    os.close(fd)
+    try:
+        await bot.download(doc, destination=path)
+        result = await import_file(path, detect_format(doc.file_name or ""))
+    except Exception as e:
+        logging.exception("import failed")
+        return await message.answer(f"⚠️ Импорт не удался, база не изменена: {e}")
+    finally:
+        os.remove(path)
+
+    lines = [
+        "📥 Импорт завершён:",
+        f"• добавлено: {result.inserted}",
+        f"• обновлено: {result.updated}",
+        f"• ошибок: {len(result.errors)}",
+    ]
+    for lineno, err in result.errors[:20]:
+        lines.append(f"  строка {lineno}: {err}")
+    if len(result.errors) > 20:
+        lines.append(f"  … и ещё {len(result.errors) - 20}")
+    await message.answer("\n".join(lines)[:4000])
 
 # ── /add <ID> — старт создания/редактирования
 @r_admin.message(Command("add"))
@@ -519,13 +876,13 @@ async def add_channel_text(message: Message, state: FSMContext):
     listing_id = data.get("listing_id", "—")
     await message.answer(
         f"🔎 Предпросмотр текста для канала по ID {listing_id}:\n\n{channel}",
-        reply_markup=kb_channel_text_confirm()
+        reply_markup=KB_CHANNEL_TEXT_CONFIRM
     )
     # остаёмся в AddListing.channel_text до нажатия кнопки
 
 @r_admin.callback_query(F.data == "chantext:ok", StateFilter(AddListing.channel_text))
 async def chantext_ok(call: CallbackQuery, state: FSMContext):
-    await call.message.answer("❓ Есть **публичная ссылка на оригинальный пост**?", reply_markup=kb_yes_no_link())
+    await call.message.answer("❓ Есть **публичная ссылка на оригинальный пост**?", reply_markup=KB_YES_NO_LINK)
     await state.set_state(AddListing.decide_link)
     await call.answer()
 
@@ -566,7 +923,7 @@ async def set_orig_text(message: Message, state: FSMContext):
 async def set_contact_link(message: Message, state: FSMContext):
     await state.update_data(link=message.text.strip())
     await state.update_data(deliver_mode="TEXT")  # фиксируем всегда TEXT
-    await message.answer("📸 Добавить фото к посту?", reply_markup=kb_photos_choice())
+    await message.answer("📸 Добавить фото к посту?", reply_markup=KB_PHOTOS_CHOICE)
     await state.set_state(AddListing.photos_choice)
 
 # ── 5) Фото: да/нет
@@ -575,7 +932,7 @@ async def photos_yes(call: CallbackQuery, state: FSMContext):
     await call.message.answer(
         "Ок! Пришли до **9** фото (несколькими сообщениями).\n"
         "Когда закончишь — нажми «Сформировать предпросмотр» или отправь /done.",
-        reply_markup=kb_finish_preview()
+        reply_markup=KB_FINISH_PREVIEW
     )
     await state.set_state(AddListing.photos)
     await call.answer()
@@ -590,10 +947,10 @@ async def add_photo(message: Message, state: FSMContext):
     data = await state.get_data()
     photos: List[str] = data.get("photos", [])
     if len(photos) >= 9:
-        return await message.answer("⚠️ Лимит 9 фото. Жми «Сформировать предпросмотр».", reply_markup=kb_finish_preview())
+        return await message.answer("⚠️ Лимит 9 фото. Жми «Сформировать предпросмотр».", reply_markup=KB_FINISH_PREVIEW)
     photos.append(message.photo[-1].file_id)
     await state.update_data(photos=photos)
-    await message.answer(f"✅ Фото сохранено ({len(photos)}/9). Ещё? Или «Сформировать предпросмотр».", reply_markup=kb_finish_preview())
+    await message.answer(f"✅ Фото сохранено ({len(photos)}/9). Ещё? Или «Сформировать предпросмотр».", reply_markup=KB_FINISH_PREVIEW)
 
 @r_admin.callback_query(F.data == "finish_add", StateFilter(AddListing.photos))
 async def finish_add_cb(call: CallbackQuery, state: FSMContext):
@@ -627,7 +984,7 @@ async def build_preview(message: Message, state: FSMContext):
         return await message.answer("⚠️ Не хватает данных (ID/текст/контакт/режим). Начни заново: /add A101")
 
     # сохраняем/обновляем как DRAFT
-    db_upsert(
+    await db_upsert(
         listing_id=listing_id,
         channel_text=channel_text,
         link=link,
@@ -638,100 +995,247 @@ async def build_preview(message: Message, state: FSMContext):
         status="DRAFT"
     )
 
-    # показываем предпросмотр медиа + текста
-    if photos:
-        media = []
-        for i, p in enumerate(photos):
-            if i == 0 and len(channel_text) <= 900:
-                media.append(InputMediaPhoto(media=p, caption=channel_text))
-            else:
-                media.append(InputMediaPhoto(media=p))
-        await bot.send_media_group(chat_id=message.chat.id, media=media)
-        if len(channel_text) > 900:
+    with priority(PRIORITY_ADMIN):
+        # показываем предпросмотр медиа + текста
+        if photos:
+            media = []
+            for i, p in enumerate(photos):
+                if i == 0 and len(channel_text) <= 900:
+                    media.append(InputMediaPhoto(media=p, caption=channel_text))
+                else:
+                    media.append(InputMediaPhoto(media=p))
+            await bot.send_media_group(chat_id=message.chat.id, media=media)
+            if len(channel_text) > 900:
+                await message.answer(channel_text)
+        else:
             await message.answer(channel_text)
-    else:
-        await message.answer(channel_text)
 
-    # сводка перед публикацией
-    await message.answer(
-        f"ID: {listing_id}\n"
-        f"Что получит покупатель: текст оригинала + контакт{(' + ссылка на оригинал' if post_url else '')}\n"
-        f"Контакт: {link}\n"
-        f"{'Оригинал: ' + post_url if post_url else 'Оригинал: —'}",
-        reply_markup=kb_preview(listing_id)
-    )
+        # сводка перед публикацией
+        await message.answer(
+            f"ID: {listing_id}\n"
+            f"Что получит покупатель: текст оригинала + контакт{(' + ссылка на оригинал' if post_url else '')}\n"
+            f"Контакт: {link}\n"
+            f"{'Оригинал: ' + post_url if post_url else 'Оригинал: —'}",
+            reply_markup=kb_preview(listing_id)
+        )
 
     await state.clear()
 
-# ── Публикация в канал
-@r_admin.callback_query(F.data.startswith("publish:"))
-async def publish_listing(call: CallbackQuery):
-    listing_id = call.data.split(":", 1)[1]
-    row = db_get(listing_id)
+# ── Публикация в канал (через очередь: см. publish_queue.py)
+async def _post(chat_id, channel_text: str, photos: List[str], btn: InlineKeyboardMarkup):
+    """Один пост (текст/фото/альбом + кнопка) в один канал."""
+    caption_text = channel_text or ""
+    if photos:
+        if len(photos) == 1:
+            # Одно фото → кнопка и текст прямо в фото (если влезает)
+            if len(caption_text) <= 1024:
+                await bot.send_photo(
+                    chat_id=chat_id,
+                    photo=photos[0],
+                    caption=caption_text,
+                    reply_markup=btn
+                )
+            else:
+                # слишком длинный текст
+                await bot.send_message(chat_id=chat_id, text=caption_text)
+                await bot.send_photo(chat_id=chat_id, photo=photos[0], reply_markup=btn)
+
+        else:
+            # Альбом: отправляем все фото
+            media = []
+            first_caption = caption_text if len(caption_text) <= 1024 else ""
+            media.append(InputMediaPhoto(media=photos[0], caption=first_caption))
+            media += [InputMediaPhoto(media=p) for p in photos[1:]]
+            await bot.send_media_group(chat_id=chat_id, media=media)
+
+            # после альбома — только кнопка, без текста-дубля
+            await bot.send_message(chat_id=chat_id, text=" ", reply_markup=btn)
+
+    else:
+        # Без фото → текст + кнопка
+        await bot.send_message(chat_id=chat_id, text=caption_text, reply_markup=btn)
+
+def _channel_label(key: str) -> str:
+    channel = CHANNELS.get(key)
+    return f"{key} ({channel.chat_id})" if key and channel else str(channel.chat_id if channel else key)
+
+async def post_to_channel(listing_id: str):
+    """Разослать пост во все каналы-цели и пометить PUBLISHED.
+    Исключение — хотя бы в один канал пост не ушёл; повтор пойдёт только в такие каналы."""
+    row = await db_get(listing_id)
     if not row:
-        await call.message.answer("⚠️ Объявление не найдено в БД.")
-        return await call.answer()
+        raise SkipJob("объявление не найдено в БД")
+
+    channel_text, _link, _post_url, _deliver, _orig_text, photos, _status = row
+    buttons = (await get_rendered(listing_id)).kb_deeplinks
+    keys = await pending_targets(listing_id, list(CHANNELS))
 
-    channel_text, _link, _post_url, _deliver, _orig_text, photos_json, _status = row
+    # каналы параллельно: у каждого свой bucket в SendScheduler, время ≈ самый медленный канал
+    with priority(PRIORITY_PUBLISH):
+        results = await asyncio.gather(
+            *(_post(CHANNELS[key].chat_id, channel_text, photos, buttons[key]) for key in keys),
+            return_exceptions=True,
+        )
+    errors = {key: f"{type(r).__name__}: {r}" for key, r in zip(keys, results) if isinstance(r, BaseException)}
+    await mark_targets(listing_id, [(key, errors.get(key)) for key in keys])
+    if errors:
+        for key, error in errors.items():
+            logging.warning("publish %s to %s failed: %s", listing_id, _channel_label(key), error)
+        posted = len(keys) - len(errors)
+        raise RuntimeError(f"опубликовано в {posted} из {len(keys)}; ошибки: "
+                           + "; ".join(f"{_channel_label(k)}: {e}" for k, e in errors.items()))
+
+    await db_set_status(listing_id, "PUBLISHED")
+    # пост уже в канале: ошибка рассылки не должна вызвать повтор публикации
     try:
-        photos: List[str] = json.loads(photos_json) if photos_json else []
+        total = await broadcaster.create(listing_id, (channel_text, _orig_text))
     except Exception:
-        photos = []
+        logging.exception("broadcast for %s not created", listing_id)
+        total = None
+    subs = f" Подписчиков получат уведомление: {total}." if total else ""
+    where = f" в каналы: {', '.join(_channel_label(k) for k in keys)}" if len(CHANNELS) > 1 else ""
+    await _notify_admin(f"✅ Объявление {listing_id} опубликовано{where}.{subs}")
 
-    btn = kb_deeplink(listing_id)
-    caption_text = channel_text or ""
+async def _publish_failed(listing_id: str, error: str):
+    await _notify_admin(f"⚠️ Не удалось опубликовать {listing_id}: {error}")
 
+async def _notify_admin(text: str):
+    if not ADMIN_ID:
+        return
     try:
-        if photos:
-            if len(photos) == 1:
-                # Одно фото → кнопка и текст прямо в фото (если влезает)
-                if len(caption_text) <= 1024:
-                    await bot.send_photo(
-                        chat_id=CHANNEL_ID,
-                        photo=photos[0],
-                        caption=caption_text,
-                        reply_markup=btn
-                    )
-                else:
-                    # слишком длинный текст
-                    await bot.send_message(chat_id=CHANNEL_ID, text=caption_text)
-                    await bot.send_photo(chat_id=CHANNEL_ID, photo=photos[0], reply_markup=btn)
-
-            else:
-                # Альбом: отправляем все фото
-                media = []
-                first_caption = caption_text if len(caption_text) <= 1024 else ""
-                media.append(InputMediaPhoto(media=photos[0], caption=first_caption))
-                media += [InputMediaPhoto(media=p) for p in photos[1:]]
-                await bot.send_media_group(chat_id=CHANNEL_ID, media=media)
-
-                # после альбома — только кнопка, без текста-дубля
-                await bot.send_message(chat_id=CHANNEL_ID, text=" ", reply_markup=btn)
+        with priority(PRIORITY_ADMIN):
+            await bot.send_message(ADMIN_ID, text)
+    except Exception:
+        logging.exception("admin notify failed")
+
+publish_queue = PublishQueue(
+    post_to_channel, on_fail=_publish_failed,
+    per_minute=float(os.getenv("PUBLISH_PER_MINUTE", "10")),
+    max_attempts=int(os.getenv("PUBLISH_MAX_ATTEMPTS", "5")),
+    # очередь крутит только лидер: поставленное на другом воркере он увидит при опросе
+    poll_interval=float(os.getenv("PUBLISH_POLL_SECONDS", "30")),
+)
 
-        else:
-            # Без фото → текст + кнопка
-            await bot.send_message(chat_id=CHANNEL_ID, text=caption_text, reply_markup=btn)
+# рассылка новых объявлений подписчикам (см. subscriptions.py); крутит тоже лидер
+async def _send_alert(user_id: int, r: Rendered):
+    await bot.send_message(user_id, r.alert, reply_markup=r.kb_confirm)
 
-        db_set_status(listing_id, "PUBLISHED")
-        await call.message.answer(f"✅ Объявление {listing_id} опубликовано.")
+broadcaster = Broadcaster(
+    get_rendered, _send_alert,
+    per_second=float(os.getenv("BROADCAST_PER_SECOND", "20")),   # запас до общего лимита 30/с — для ответов
+    concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "8")),
+    batch=int(os.getenv("BROADCAST_BATCH", "100")),
+    poll_interval=float(os.getenv("PUBLISH_POLL_SECONDS", "30")),
+)
 
-    except Exception as e:
-        logging.exception("publish_listing failed")
-        await call.message.answer(f"⚠️ Не удалось опубликовать: {e}")
+def parse_publish_at(arg: str) -> Optional[float]:
+    """«+30m» / «+2h» / «18:30» (сегодня или завтра) / «2025-10-18 09:00» → unix time."""
+    arg = arg.strip()
+    if arg.startswith("+") and arg[-1:] in ("m", "h") and arg[1:-1].isdigit():
+        return time.time() + int(arg[1:-1]) * (60 if arg[-1] == "m" else 3600)
+    now = datetime.now()
+    for fmt in ("%H:%M", "%Y-%m-%d %H:%M"):
+        try:
+            dt = datetime.strptime(arg, fmt)
+        except ValueError:
+            continue
+        if fmt == "%H:%M":
+            dt = now.replace(hour=dt.hour, minute=dt.minute, second=0, microsecond=0)
+            if dt <= now:
+                dt += timedelta(days=1)
+        return dt.timestamp()
+    return None
 
+@r_admin.callback_query(F.data.startswith("publish:"))
+async def publish_listing(call: CallbackQuery):
+    listing_id = call.data.split(":", 1)[1]
+    if not await db_get(listing_id):
+        await call.message.answer("⚠️ Объявление не найдено в БД.")
+        return await call.answer()
+    # новая публикация — снова во все каналы-цели, даже куда уже постили
+    await reset_targets(listing_id)
+    await publish_queue.enqueue(listing_id)
+    await call.message.answer(f"🕒 Объявление {listing_id} поставлено в очередь публикации.")
     await call.answer()
+
 @r_admin.callback_query(F.data == "restart")
 async def restart_add(call: CallbackQuery):
     await call.message.answer("🔄 Начнём сначала. Укажи новый ID: /add A102")
     await call.answer()
 
 @r_admin.message(Command("publish"))
-async def publish_cmd(message: Message):
-    parts = message.text.split(maxsplit=1)
-    if len(parts) < 2:
-        return await message.answer("Укажи ID: /publish A101")
-    fake_call = type("C", (), {"data": f"publish:{parts[1].strip().upper()}", "message": message})
-    await publish_listing(fake_call)  # type: ignore
+async def publish_cmd(message: Message, command: CommandObject):
+    parts = (command.args or "").split(maxsplit=1)
+    if not parts:
+        return await message.answer("Укажи ID: /publish A101 [+30m | 18:30 | 2025-10-18 09:00]")
+    listing_id = parts[0].strip().upper()
+    if not await db_get(listing_id):
+        return await message.answer(f"⚠️ Объявление {listing_id} не найдено.")
+
+    publish_at = None
+    if len(parts) > 1:
+        publish_at = parse_publish_at(parts[1])
+        if publish_at is None:
+            return await message.answer("⚠️ Не понял время. Примеры: +30m, +2h, 18:30, 2025-10-18 09:00")
+    await reset_targets(listing_id)
+    await publish_queue.enqueue(listing_id, publish_at)
+    when = datetime.fromtimestamp(publish_at).strftime("%d.%m %H:%M") if publish_at else "сразу"
+    await message.answer(f"🕒 {listing_id} в очереди публикации ({when}).")
+
+@r_admin.message(Command("queue"))
+async def queue_cmd(message: Message):
+    rows = await publish_queue.pending()
+    if not rows:
+        return await message.answer("📭 Очередь публикаций пуста.")
+    lines = ["🕒 Очередь публикаций:"]
+    for lid, at, attempts, err in rows:
+        line = f"• {lid} — {datetime.fromtimestamp(at).strftime('%d.%m %H:%M')}"
+        if attempts:
+            line += f" (попыток: {attempts}, {err[:60]})"
+        lines.append(line)
+    await message.answer("\n".join(lines))
+
+@r_admin.message(Command("unqueue"))
+async def unqueue_cmd(message: Message, command: CommandObject):
+    listing_id = (command.args or "").strip().upper()
+    if not listing_id:
+        return await message.answer("Укажи ID: /unqueue A101")
+    if await publish_queue.cancel(listing_id):
+        await message.answer(f"🗑 {listing_id} убран из очереди публикаций.")
+    else:
+        await message.answer(f"⚠️ {listing_id} не ждёт публикации.")
+
+# ── Каналы публикации: /targets <ID> [ключ,ключ|all]
+TARGET_STATUS = {"PENDING": "⏳", "POSTED": "✅", "FAILED": "⚠️"}
+
+@r_admin.message(Command("targets"))
+async def targets_cmd(message: Message, command: CommandObject):
+    parts = (command.args or "").split(maxsplit=1)
+    channels = ", ".join(_channel_label(k) for k in CHANNELS)
+    if not parts:
+        return await message.answer(f"📡 Каналы: {channels}\n\n"
+                                    "/targets <ID> — куда публикуется объявление\n"
+                                    "/targets <ID> praha,brno | all — задать каналы")
+    listing_id = parts[0].strip().upper()
+    if not await db_get(listing_id):
+        return await message.answer(f"⚠️ Объявление {listing_id} не найдено.")
+    if len(parts) > 1:
+        arg = parts[1].strip()
+        keys = list(CHANNELS) if arg.lower() == "all" else [k.strip() for k in arg.split(",") if k.strip()]
+        unknown = [k for k in keys if k not in CHANNELS]
+        if unknown or not keys:
+            return await message.answer(f"⚠️ Неизвестные каналы: {', '.join(unknown) or '—'}. Есть: {channels}")
+        await set_targets(listing_id, keys)
+    rows = await list_targets(listing_id)
+    if not rows:
+        return await message.answer(f"📡 {listing_id}: целей не задано — опубликуется во все каналы ({channels}).")
+    lines = [f"📡 {listing_id}:"]
+    for key, status, attempts, error in rows:
+        line = f"{TARGET_STATUS.get(status, status)} {_channel_label(key)}"
+        if status == "FAILED":
+            line += f" (попыток: {attempts}, {error[:60]})"
+        lines.append(line)
+    await message.answer("\n".join(lines))
 
 # ── Удаление с подтверждением
 async def _ask_delete_confirmation(chat_id: int, listing_id: str, preview_text: str):
@@ -748,7 +1252,7 @@ async def delete_cmd(message: Message):
     if len(parts) < 2:
         return await message.answer("⚠️ Укажи ID после команды: `/delete A101`", parse_mode="Markdown")
     listing_id = parts[1].strip().upper()
-    row = db_get(listing_id)
+    row = await db_get(listing_id)
     if not row:
         return await message.answer(f"⚠️ Объявление {listing_id} не найдено.")
     channel_text, *_ = row
@@ -761,7 +1265,7 @@ async def del_alias(message: Message):
 @r_admin.callback_query(F.data.startswith("confirm_del:"))
 async def confirm_delete(call: CallbackQuery):
     listing_id = call.data.split(":", 1)[1]
-    ok = db_delete(listing_id)
+    ok = await db_delete(listing_id)
     if ok:
         try:
             await call.message.edit_text(f"🗑 Объявление {listing_id} удалено.")
@@ -789,12 +1293,194 @@ async def dbg_state(m: Message, state: FSMContext):
     data = await state.get_data()
     await m.answer(f"🧪 state = {st}\n\ndata = {data}")
 
+# ── Счётчики кэша объявлений
+@r_admin.message(Command("cache"))
+async def cache_cmd(m: Message):
+    lines = ["🗄 Кэш объявлений:"]
+    for name, st in cache_stats().items():
+        lines.append(
+            f"• {name}: size={st['size']} hits={st['hits']} misses={st['misses']} "
+            f"evictions={st['evictions']} hit_rate={st['hit_rate']}"
+        )
+    await m.answer("\n".join(lines))
+
+# ── Счётчики планировщика отправок
+@r_admin.message(Command("limits"))
+async def limits_cmd(m: Message):
+    st = send_scheduler.stats()
+    await m.answer(
+        "🚦 Лимиты отправки:\n"
+        f"• отправлено: {st['sent']}\n"
+        f"• ждали лимит: {st['throttled']} ({st['throttled_wait_s']} с)\n"
+        f"• повторов после 429: {st['retried']}\n"
+        f"• не доставлено после повторов: {st['failed']}\n"
+        f"• в очереди: {st['waiting']}"
+    )
+    th = throttle.stats()
+    dropped = ", ".join(f"{k}={v}+{th['dropped_global'][k]}" for k, v in th["dropped"].items())
+    await m.answer(
+        "🛡 Антифлуд:\n"
+        f"• пропущено: {th['passed']}\n"
+        f"• отброшено (личный+общий лимит): {dropped}\n"
+        f"• предупреждений: {th['warnings']}"
+    )
+
+# ── Воронка: /stats [ID|today|7d]
+EVENT_TITLES = {
+    "lookup": "запросили ID",
+    "confirm": "подтвердили",
+    "pay": "нажали «Оплатить»",
+    "pre_checkout": "дошли до оплаты",
+    "paid": "оплатили",
+}
+
+def _funnel_lines(counts: Dict[str, int]) -> List[str]:
+    base = counts.get("lookup", 0)
+    lines = []
+    for event in EVENTS:
+        n = counts.get(event, 0)
+        share = f" ({n * 100 // base}%)" if base and event != "lookup" else ""
+        lines.append(f"• {EVENT_TITLES[event]}: {n}{share}")
+    return lines
+
+@r_admin.message(Command("stats"))
+async def stats_cmd(m: Message, command: CommandObject):
+    arg = (command.args or "today").strip()
+    # свои несброшенные счётчики — в БД; у других воркеров отстают максимум на интервал сброса
+    await funnel_stats.flush()
+
+    if re.fullmatch(r"[A-Za-z]\d+", arg):
+        listing_id = arg.upper()
+        days = await funnel_stats.listing(listing_id, 30)
+        if not days:
+            return await m.answer(f"📊 По {listing_id} за 30 дней событий нет.")
+        totals: Dict[str, int] = {}
+        for counts in days.values():
+            for event, n in counts.items():
+                totals[event] = totals.get(event, 0) + n
+        lines = [f"📊 {listing_id} за 30 дней:", *_funnel_lines(totals), "", "По дням (ID → подтв. → оплатить → оплата):"]
+        for day, c in list(days.items())[:7]:
+            lines.append(f"{day}: {c.get('lookup', 0)} → {c.get('confirm', 0)} → {c.get('pay', 0)} → {c.get('paid', 0)}")
+        return await m.answer("\n".join(lines))
+
+    period = re.fullmatch(r"(\d+)d", arg)
+    if arg != "today" and not period:
+        return await m.answer("Формат: /stats, /stats today, /stats 7d или /stats <ID>")
+    n_days = min(max(int(period.group(1)), 1), 365) if period else 1
+    totals = await funnel_stats.totals(n_days)
+    top = await funnel_stats.top(n_days)
+    title = "сегодня" if n_days == 1 else f"{n_days} дн. (с {funnel_stats.since(n_days)})"
+    lines = [f"📊 Воронка за {title}:", *_funnel_lines(totals)]
+    if top:
+        lines += ["", "Топ объявлений (оплаты / запросы ID):"]
+        lines += [f"{listing_id} — {paid} / {lookups}" for listing_id, lookups, paid in top]
+    await m.answer("\n".join(lines))
+
+# ── Рассылки подписчикам: прогресс
+BROADCAST_STATUS = {"PENDING": "⏳", "DONE": "✅", "CANCELLED": "🚫"}
+
+@r_admin.message(Command("broadcasts"))
+async def broadcasts_cmd(m: Message):
+    rows = await broadcaster.recent()
+    if not rows:
+        return await m.answer("📭 Рассылок ещё не было.")
+    st = broadcaster.stats()
+    lines = ["🔔 Последние рассылки (доставлено / всего, ошибок):"]
+    for listing_id, status, total, sent, failed in rows:
+        lines.append(f"{BROADCAST_STATUS.get(status, status)} {listing_id}: {sent} / {total}, ошибок {failed}")
+    lines += ["", f"С запуска: доставлено {st['sent']}, ошибок {st['failed']}, заблокировали бота {st['blocked']}"]
+    await m.answer("\n".join(lines))
+
+# ── Профилирование: /profile start [0.1] | stop | dump | reset
+# профиль у каждого воркера свой — команда управляет тем, что принял чат админа
+@r_admin.message(Command("profile"))
+async def profile_cmd(m: Message, command: CommandObject):
+    action, *rest = (command.args or "status").split()
+    if action == "start":
+        try:
+            sample = float(rest[0]) if rest else None
+        except ValueError:
+            sample = -1.0
+        if sample is not None and not 0 < sample <= 1:
+            return await m.answer("⚠️ Доля апдейтов — число от 0 до 1, например /profile start 0.05")
+        profiler.start(sample)
+        return await m.answer(f"🔬 Профилирование включено: каждый ~{round(1 / profiler.sample)}-й апдейт.")
+    if action == "stop":
+        profiler.stop()
+        return await m.answer(f"⏹ Профилирование выключено. Собрано профилей: {profiler.profiled}. /profile dump — выгрузить.")
+    if action == "reset":
+        profiler.reset()
+        return await m.answer("🧹 Накопленные профили сброшены.")
+    if action == "dump":
+        dumped = profiler.dump()
+        if dumped is None:
+            return await m.answer("📭 Профилей пока нет: /profile start и подожди немного.")
+        data, report = dumped
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        with priority(PRIORITY_ADMIN):
+            await m.answer_document(BufferedInputFile(data, f"rentbot-{stamp}.pstats"),
+                                    caption="python -m pstats <файл> или snakeviz <файл>")
+            await m.answer_document(BufferedInputFile(report.encode(), f"rentbot-{stamp}.txt"),
+                                    caption="Топ функций по хендлерам (cumulative)")
+        return
+    st = profiler.stats()
+    await m.answer(
+        f"🔬 Профилирование: {'включено' if st['enabled'] else 'выключено'}, доля {st['sample']}\n"
+        f"• профилей: {st['profiled']} (хендлеров: {st['handlers']})\n"
+        f"• пропущено, пока шёл другой профиль: {st['skipped_busy']}\n\n"
+        "/profile start [доля] | stop | dump | reset"
+    )
+
+async def load_identity():
+    """Один getMe на процесс: имя бота нужно для deep-link кнопок."""
+    global BOT_USERNAME
+    if not BOT_USERNAME:
+        me = await bot.me()
+        BOT_USERNAME = me.username
+
+expiry_sweeper = ExpirySweeper(
+    interval=float(os.getenv("EXPIRY_SWEEP_SECONDS", "300")),
+    batch=int(os.getenv("EXPIRY_SWEEP_BATCH", "500")),
+)
+
+# записи в listings из других воркеров сбрасывают кэши и здесь (см. cache_sync.py)
+cache_sync = CacheSync(poll_interval=float(os.getenv("LISTING_SYNC_SECONDS", "1")))
+
+# фоновые задачи крутит только один процесс (лидер, см. leader.py), иначе
+# при нескольких воркерах каждый пост ушёл бы в канал несколько раз
+async def start_background_jobs():
+    await publish_queue.start()
+    await expiry_sweeper.start()
+    await broadcaster.start()
+
+async def stop_background_jobs():
+    await broadcaster.stop()
+    await expiry_sweeper.stop()
+    await publish_queue.stop()
+
+@dp.startup()
+async def on_startup(leader: bool = True):
+    await load_identity()
+    # кэши объявлений свои у каждого воркера — и следит за ними каждый
+    await cache_sync.start()
+    # outbox разбирают все воркеры: выдача идёт из того процесса, что принял оплату
+    await delivery_outbox.start()
+    if leader:
+        await start_background_jobs()
+
+@dp.shutdown()
+async def on_shutdown():
+    await stop_background_jobs()
+    await delivery_outbox.stop()
+    await cache_sync.stop()
+    # дописываем отложенные изменения FSM и счётчики воронки
+    await dp.storage.close()
+    await funnel_stats.close()
+
 # ── main: запуск поллинга
 async def main():
-    global BOT_USERNAME
-    db_init()
-    me = await bot.get_me()
-    BOT_USERNAME = me.username
+    await db_init()
+    await load_identity()
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
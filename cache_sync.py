@@ -0,0 +1,101 @@
+# cache_sync.py — сброс кэшей объявлений после записей из других процессов
+# У каждого воркера (cluster.py, uvicorn --workers) свои listing/missing/archived
+# кэши в db.py и кэш отрисовки в bot.py; db_upsert и db_set_status сбрасывают их
+# только в процессе, который писал. Триггеры на listings ведут журнал
+# listing_changes (миграция v9), каждый процесс раз в poll_interval секунд
+# читает из него новые ID и сбрасывает их у себя — устаревшая карточка или
+# «не найдено» живёт не дольше poll_interval, а не LISTING_CACHE_TTL.
+# Свои записи процесс пропускает (db.own_changes): db_upsert уже положил в кэш
+# свежую версию и её рендер, сбрасывать их было бы лишним промахом.
+# Журнал обрезается до последних keep записей; процесс, отставший сильнее,
+# сбрасывает кэш целиком.
+
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import List, Optional, Tuple
+
+import db
+
+
+def _last_seq(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM listing_changes").fetchone()[0]
+
+def _changes(conn: sqlite3.Connection, after: int, limit: int) -> List[Tuple[int, str]]:
+    return conn.execute("SELECT seq, listing_id FROM listing_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                        (after, limit)).fetchall()
+
+def _trim(conn: sqlite3.Connection, keep: int) -> int:
+    return conn.execute("DELETE FROM listing_changes WHERE seq <= (SELECT MAX(seq) FROM listing_changes) - ?",
+                        (keep,)).rowcount
+
+
+class CacheSync:
+    def __init__(self, poll_interval: float = 1.0, batch: int = 1000,
+                 keep: int = 10000, trim_interval: float = 600):
+        self.poll_interval = poll_interval
+        self.batch = batch
+        self.keep = keep
+        self.trim_interval = trim_interval
+        self._last = 0
+        self._last_trim = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+        self.invalidated = 0
+        self.skipped_own = 0  # свои записи — кэш уже свежий
+        self.resets = 0       # отстали от обрезанного журнала — сброшено всё
+
+    async def start(self) -> None:
+        if self._task is None:
+            # кэш только что создан и пуст — прошлые изменения нам не нужны
+            self._last = await db.read(_last_seq)
+            await db.write(db.track_changes)
+            self._task = asyncio.create_task(self._run(), name="cache-sync")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def poll(self) -> int:
+        """Сбросить в кэше объявления, изменённые с прошлого опроса. Возвращает их число."""
+        total = 0
+        while True:
+            rows = await db.read(_changes, self._last, self.batch)
+            if not rows:
+                return total
+            own = db.own_changes
+            if rows[0][0] > self._last + 1:
+                # часть журнала уже обрезана — какие ID менялись, не узнать
+                self.resets += 1
+                db.cache_invalidate_all()
+            else:
+                foreign = [listing_id for seq, listing_id in rows if seq not in own]
+                for listing_id in set(foreign):
+                    db.cache_invalidate(listing_id)
+                self.invalidated += len(foreign)
+                self.skipped_own += len(rows) - len(foreign)
+            self._last = rows[-1][0]
+            # свои seq до _last больше не встретятся; own пополняет поток писателя — берём снимок
+            own.difference_update([seq for seq in list(own) if seq <= self._last])
+            total += len(rows)
+            if len(rows) < self.batch:
+                return total
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll()
+                now = time.time()
+                if now - self._last_trim >= self.trim_interval:
+                    self._last_trim = now
+                    await db.write(_trim, self.keep)
+            except Exception:
+                logging.exception("cache sync: poll failed")
+
+    def stats(self) -> dict:
+        return {"seq": self._last, "invalidated": self.invalidated, "skipped_own": self.skipped_own,
+                "resets": self.resets}
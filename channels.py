@@ -0,0 +1,103 @@
+# channels.py — каналы публикации и статус поста объявления в каждом из них
+# Каналы задаёт CHANNELS="praha=@rent_praha,brno=-100123" (ключ=чат); без него —
+# один канал CHANNEL_ID с пустым ключом, как раньше. Ключ попадает в deep-link
+# кнопки под постом (start=A101_praha), чтобы было видно, из какого канала пришли.
+# У объявления — список целей (listing_targets): по умолчанию все каналы.
+# Статус каждой цели свой, поэтому повтор публикации идёт только в каналы,
+# где пост не получился.
+
+import re
+import time
+import sqlite3
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import db
+
+PENDING, POSTED, FAILED = "PENDING", "POSTED", "FAILED"
+
+_KEY = re.compile(r"[A-Za-z0-9]{1,20}")
+
+
+class Channel(NamedTuple):
+    key: str                   # '' — единственный канал без суффикса в deep-link
+    chat_id: Union[int, str]   # @username или -100...
+
+def _chat(raw: str) -> Union[int, str]:
+    return raw if raw.startswith("@") else int(raw)
+
+def parse_channels(raw: str, default: str) -> Dict[str, Channel]:
+    """CHANNELS → {ключ: канал} в порядке перечисления. Пустой raw — один канал default."""
+    if not raw.strip():
+        return {"": Channel("", _chat(default))}
+    channels: Dict[str, Channel] = {}
+    for n, part in enumerate(p.strip() for p in raw.split(",") if p.strip()):
+        key, sep, chat = part.partition("=")
+        if not sep:
+            key, chat = str(n + 1), part
+        key, chat = key.strip(), chat.strip()
+        if not _KEY.fullmatch(key) or key in channels:
+            raise ValueError(f"CHANNELS: плохой или повторный ключ канала {key!r}")
+        channels[key] = Channel(key, _chat(chat))
+    return channels
+
+def deeplink_payload(listing_id: str, key: str) -> str:
+    return f"{listing_id}_{key}" if key else listing_id
+
+def split_payload(payload: str) -> Tuple[str, str]:
+    """start-параметр deep-link → (ID, ключ канала)."""
+    listing_id, _, key = payload.strip().partition("_")
+    return listing_id.upper(), key
+
+
+# ── Цели публикации ──────────────────────────────────────────────────────────
+def _pending(conn: sqlite3.Connection, listing_id: str, keys: List[str]) -> List[str]:
+    if conn.execute("SELECT 1 FROM listing_targets WHERE listing_id=?", (listing_id,)).fetchone() is None:
+        # цели не задавали — публикуем во все настроенные каналы
+        conn.executemany("INSERT INTO listing_targets (listing_id, channel) VALUES (?, ?)",
+                         [(listing_id, k) for k in keys])
+    rows = conn.execute("SELECT channel FROM listing_targets WHERE listing_id=? AND status<>?",
+                        (listing_id, POSTED)).fetchall()
+    return [r[0] for r in rows if r[0] in keys]
+
+def _mark(conn: sqlite3.Connection, listing_id: str, results: List[Tuple[str, Optional[str]]], now: float) -> None:
+    conn.executemany(
+        "UPDATE listing_targets SET status=?, posted_at=?, last_error='' WHERE listing_id=? AND channel=?",
+        [(POSTED, now, listing_id, key) for key, error in results if error is None],
+    )
+    conn.executemany(
+        "UPDATE listing_targets SET status=?, attempts=attempts+1, last_error=? WHERE listing_id=? AND channel=?",
+        [(FAILED, error, listing_id, key) for key, error in results if error is not None],
+    )
+
+def _reset(conn: sqlite3.Connection, listing_id: str) -> None:
+    conn.execute("UPDATE listing_targets SET status=?, attempts=0, last_error='', posted_at=NULL WHERE listing_id=?",
+                 (PENDING, listing_id))
+
+def _set(conn: sqlite3.Connection, listing_id: str, keys: List[str]) -> None:
+    conn.execute("DELETE FROM listing_targets WHERE listing_id=?", (listing_id,))
+    conn.executemany("INSERT INTO listing_targets (listing_id, channel) VALUES (?, ?)",
+                     [(listing_id, k) for k in keys])
+
+def _list(conn: sqlite3.Connection, listing_id: str) -> List[Tuple[str, str, int, str]]:
+    return conn.execute(
+        "SELECT channel, status, attempts, last_error FROM listing_targets WHERE listing_id=? ORDER BY channel",
+        (listing_id,),
+    ).fetchall()
+
+async def pending_targets(listing_id: str, keys: List[str]) -> List[str]:
+    """Ключи каналов, куда пост ещё не ушёл (из keys — настроенных сейчас)."""
+    return await db.write(_pending, listing_id, keys)
+
+async def mark_targets(listing_id: str, results: List[Tuple[str, Optional[str]]]) -> None:
+    """results: (ключ, None — опубликовано | текст ошибки)."""
+    await db.write(_mark, listing_id, results, time.time())
+
+async def reset_targets(listing_id: str) -> None:
+    """Новая публикация: все цели снова ждут поста."""
+    await db.write(_reset, listing_id)
+
+async def set_targets(listing_id: str, keys: List[str]) -> None:
+    await db.write(_set, listing_id, keys)
+
+async def list_targets(listing_id: str) -> List[Tuple[str, str, int, str]]:
+    return await db.read(_list, listing_id)
@@ -0,0 +1,155 @@
+# cluster.py — несколько процессов webhook.py за одним портом
+# Front-процесс принимает вебхук Telegram, по JSON находит чат и пересылает апдейт
+# всегда одному и тому же воркеру (chat_id % WORKER_COUNT): шаги FSM одного
+# пользователя не разъезжаются по процессам и идут по порядку.
+# Воркеры — обычные `uvicorn webhook:app` на 127.0.0.1:WORKER_BASE_PORT+i;
+# упавший воркер перезапускается. Лидер среди них выбирается в webhook.py.
+#
+#   WORKER_COUNT=4 python cluster.py
+#
+# Режим включается явно: Procfile запускает cluster.py только при CLUSTER=1,
+# иначе — один `uvicorn webhook:app`. Число воркеров по умолчанию 1 и не
+# берётся из числа CPU: на PaaS их бывают десятки, а база — один файл SQLite.
+#
+# Метрики и статистика воркера i: GET /workers/<i>/metrics, /workers/<i>/stats
+
+import os
+import sys
+import json
+import signal
+import asyncio
+import logging
+import subprocess
+from typing import List, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+from dotenv import load_dotenv
+
+from update_queue import chat_key_raw
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+PORT             = int(os.getenv("PORT", "10000"))
+WORKER_COUNT     = int(os.getenv("WORKER_COUNT", "1"))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "10100"))
+WEBHOOK_PATH     = f"/webhook/{os.getenv('BOT_TOKEN')}"
+FORWARD_TIMEOUT  = float(os.getenv("CLUSTER_FORWARD_TIMEOUT", "30"))
+
+
+class Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.port = WORKER_BASE_PORT + index
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.proc: Optional[subprocess.Popen] = None
+        self.restarts = 0
+
+    def spawn(self) -> None:
+        env = dict(os.environ, WORKER_INDEX=str(self.index), WORKER_COUNT=str(WORKER_COUNT))
+        # отложенные публикации крутит только лидер — пусть он замечает чужие чаще
+        env.setdefault("PUBLISH_POLL_SECONDS", "5")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "webhook:app", "--host", "127.0.0.1", "--port", str(self.port)],
+            env=env,
+        )
+
+
+class Cluster:
+    def __init__(self, count: int = WORKER_COUNT):
+        self.workers: List[Worker] = [Worker(i) for i in range(max(1, count))]
+        self.session: Optional[ClientSession] = None
+        self._supervisor: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        self.forwarded = 0
+        self.unavailable = 0
+
+    def route(self, update: dict) -> Worker:
+        return self.workers[chat_key_raw(update) % len(self.workers)]
+
+    async def start(self, app: web.Application) -> None:
+        for w in self.workers:
+            w.spawn()
+        self.session = ClientSession(connector=TCPConnector(limit_per_host=100),
+                                     timeout=ClientTimeout(total=FORWARD_TIMEOUT))
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def stop(self, app: web.Application) -> None:
+        self._stopping = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            await asyncio.gather(self._supervisor, return_exceptions=True)
+        for w in self.workers:
+            if w.proc is not None and w.proc.poll() is None:
+                w.proc.send_signal(signal.SIGTERM)   # uvicorn дообработает очередь и выйдет
+        for w in self.workers:
+            if w.proc is not None:
+                try:
+                    await asyncio.to_thread(w.proc.wait, 30)
+                except subprocess.TimeoutExpired:
+                    w.proc.kill()
+        if self.session is not None:
+            await self.session.close()
+
+    async def _supervise(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(1)
+            for w in self.workers:
+                if w.proc is not None and w.proc.poll() is not None and not self._stopping:
+                    logging.warning("worker %s exited with %s, restarting", w.index, w.proc.returncode)
+                    w.restarts += 1
+                    w.spawn()
+
+    # ── HTTP ──
+    async def handle_update(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.json_response({"status": "ignored"})
+        worker = self.route(update) if isinstance(update, dict) else self.workers[0]
+        try:
+            async with self.session.post(worker.url + WEBHOOK_PATH, data=body,
+                                         headers={"Content-Type": "application/json"}) as r:
+                self.forwarded += 1
+                return web.Response(status=r.status, body=await r.read(), content_type="application/json")
+        except Exception:
+            # воркер перезапускается — 503, Telegram повторит доставку ему же
+            self.unavailable += 1
+            logging.warning("worker %s unavailable", worker.index, exc_info=True)
+            return web.Response(status=503)
+
+    async def handle_worker(self, request: web.Request) -> web.Response:
+        try:
+            worker = self.workers[int(request.match_info["index"])]
+        except (ValueError, IndexError):
+            raise web.HTTPNotFound()
+        try:
+            async with self.session.get(f"{worker.url}/{request.match_info['path']}") as r:
+                return web.Response(status=r.status, body=await r.read(),
+                                    headers={"Content-Type": r.headers.get("Content-Type", "text/plain")})
+        except Exception:
+            return web.Response(status=503)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "workers": [{"index": w.index, "port": w.port, "pid": w.proc.pid if w.proc else None,
+                         "restarts": w.restarts} for w in self.workers],
+            "forwarded": self.forwarded,
+            "unavailable": self.unavailable,
+        })
+
+
+def make_app(cluster: Cluster) -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, cluster.handle_update)
+    app.router.add_get("/stats", cluster.handle_stats)
+    app.router.add_get("/workers/{index}/{path:(stats|metrics)}", cluster.handle_worker)
+    app.on_startup.append(cluster.start)
+    app.on_cleanup.append(cluster.stop)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(make_app(Cluster()), host="0.0.0.0", port=PORT, access_log=None)
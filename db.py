@@ -0,0 +1,390 @@
+# db.py — слой доступа к SQLite
+# Долгоживущие соединения в режиме WAL, запросы выполняются вне event loop:
+# чтения — небольшим пулом потоков, запись — одним выделенным потоком.
+
+import os
+import re
+import time
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Set, Tuple, Callable, Any, NamedTuple
+
+import migrations
+from cache import LRUCache
+from metrics import db_latency
+
+DB_FILE         = os.getenv("DB_FILE", "listings.db")
+DB_READERS      = int(os.getenv("DB_READERS", "4"))
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL").upper()
+
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", "1024"))
+LISTING_CACHE_TTL  = float(os.getenv("LISTING_CACHE_TTL", "300"))
+LISTING_NEG_TTL    = float(os.getenv("LISTING_NEG_TTL", "30"))    # кэш «нет такого ID»
+LISTING_TTL_HOURS  = float(os.getenv("LISTING_TTL_HOURS", "336"))  # срок жизни после публикации; 0 — бессрочно
+
+# у каждого потока пула — своё соединение (sqlite3 не любит делить одно между потоками)
+_local = threading.local()
+
+# WAL позволяет читать параллельно с записью; писатель в SQLite всё равно один,
+# поэтому все записи идут через единственный поток и не дерутся за блокировку
+_readers = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-read")
+_writer  = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+
+def connect(path: Optional[str] = None) -> sqlite3.Connection:
+    # cached_statements — кэш скомпилированных (prepared) запросов на соединение,
+    # поэтому все SQL ниже — константы модуля
+    conn = sqlite3.connect(path or DB_FILE, timeout=30, check_same_thread=False, cached_statements=256)
+    conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+def _conn() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect()
+    return conn
+
+def _read(fn: Callable, args: tuple) -> Any:
+    return fn(_conn(), *args)
+
+# seq строк журнала listing_changes, записанных этим процессом: cache_sync.py их
+# пропускает — свои записи уже сбросили (и заново наполнили) кэш здесь же
+own_changes: Set[int] = set()
+_txn_changes: List[int] = []   # seq текущей транзакции писателя; попадают в own_changes после commit
+
+def track_changes(conn: sqlite3.Connection) -> None:
+    """Для соединения писателя: TEMP-триггер (виден только этому соединению) отмечает свои seq."""
+    conn.create_function("rentbot_own_change", 1, _txn_changes.append)
+    conn.execute("""
+        CREATE TEMP TRIGGER IF NOT EXISTS own_listing_changes AFTER INSERT ON main.listing_changes
+        BEGIN SELECT rentbot_own_change(new.seq); END
+    """)
+
+def _write(fn: Callable, args: tuple) -> Any:
+    conn = _conn()
+    try:
+        with conn:  # одна транзакция на вызов: commit или rollback
+            result = fn(conn, *args)
+    except BaseException:
+        # откат: seq освобождаются и могут достаться чужой записи — не запоминаем
+        _txn_changes.clear()
+        raise
+    if _txn_changes:
+        own_changes.update(_txn_changes)
+        _txn_changes.clear()
+    return result
+
+def _query_name(fn: Callable) -> str:
+    # метка для метрик: db.get, fsm_storage.flush, publish_queue.next, ...
+    return f"{fn.__module__}.{fn.__name__.lstrip('_')}"
+
+async def read(fn: Callable, *args) -> Any:
+    """Выполнить fn(conn, *args) в пуле читателей."""
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_readers, _read, fn, args)
+    finally:
+        db_latency.observe(time.perf_counter() - started, _query_name(fn))
+
+async def write(fn: Callable, *args) -> Any:
+    """Выполнить fn(conn, *args) в потоке-писателе внутри транзакции."""
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_writer, _write, fn, args)
+    finally:
+        db_latency.observe(time.perf_counter() - started, _query_name(fn))
+
+
+# ── Схема ────────────────────────────────────────────────────────────────────
+# таблицы и индексы описаны в migrations.py; здесь только запуск недостающих шагов
+async def db_init() -> None:
+    await write(migrations.migrate)
+
+
+# ── Объявления ───────────────────────────────────────────────────────────────
+class Listing(NamedTuple):
+    # порядок полей совпадает со старым кортежем строки — распаковка в хендлерах не меняется
+    text: str
+    link: str
+    post_url: str
+    deliver_mode: str
+    orig_text: str
+    photos: List[str]     # file_id по порядку (таблица listing_photos)
+    status: str
+
+# read-through кэш: ID -> Listing; отдельно — короткий кэш несуществующих ID,
+# чтобы перебор случайных «A123» не доходил до БД
+listing_cache = LRUCache(LISTING_CACHE_SIZE, LISTING_CACHE_TTL)
+missing_cache = LRUCache(LISTING_CACHE_SIZE * 4, LISTING_NEG_TTL)
+# ID → Listing из архива (или False — «в архиве нет»): просроченный ID отвечает
+# «неактуально» без запроса к рабочей таблице
+archived_cache = LRUCache(LISTING_CACHE_SIZE, LISTING_CACHE_TTL)
+_cache_gen = 0   # растёт при каждой инвалидации; не даём гонке положить в кэш устаревшую строку
+
+# подписчики на изменения объявлений (кэш отрисовки в bot.py):
+# fn(id, listing) — записана новая версия; fn(id, None) — запись изменилась/удалена;
+# fn(None, None) — сброшено всё
+_listeners: List[Callable[[Optional[str], Optional["Listing"]], None]] = []
+
+def on_change(fn: Callable[[Optional[str], Optional["Listing"]], None]) -> Callable:
+    _listeners.append(fn)
+    return fn
+
+def _notify(listing_id: Optional[str], listing: Optional["Listing"] = None) -> None:
+    for fn in _listeners:
+        fn(listing_id, listing)
+
+def cache_invalidate(listing_id: str) -> None:
+    global _cache_gen
+    _cache_gen += 1
+    listing_cache.pop(listing_id)
+    missing_cache.pop(listing_id)
+    archived_cache.pop(listing_id)
+    _notify(listing_id)
+
+def cache_invalidate_all() -> None:
+    global _cache_gen
+    _cache_gen += 1
+    listing_cache.clear()
+    missing_cache.clear()
+    archived_cache.clear()
+    _notify(None)
+
+SQL_UPSERT = """
+    INSERT INTO listings (id, text, link, post_url, deliver_mode, orig_text, status,
+                          created_at, published_at, expires_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        text=excluded.text,
+        link=excluded.link,
+        post_url=excluded.post_url,
+        deliver_mode=excluded.deliver_mode,
+        orig_text=excluded.orig_text,
+        status=excluded.status,
+        published_at=COALESCE(listings.published_at, excluded.published_at),
+        expires_at=COALESCE(listings.expires_at, excluded.expires_at)
+"""
+SQL_GET = """
+    SELECT text, link, post_url, deliver_mode, orig_text, status
+    FROM listings WHERE id = ?
+"""
+SQL_DELETE     = "DELETE FROM listings WHERE id = ?"
+SQL_PHOTOS        = "SELECT file_id FROM listing_photos WHERE listing_id = ? ORDER BY position"
+SQL_PHOTOS_CLEAR  = "DELETE FROM listing_photos WHERE listing_id = ?"
+SQL_PHOTOS_INSERT = "INSERT INTO listing_photos (listing_id, position, file_id) VALUES (?, ?, ?)"
+SQL_TARGETS_CLEAR = "DELETE FROM listing_targets WHERE listing_id = ?"
+# первая публикация запускает срок жизни; повторная его не продлевает
+SQL_SET_STATUS = """
+    UPDATE listings SET status=?,
+        published_at=CASE WHEN ?='PUBLISHED' THEN COALESCE(published_at, ?) ELSE published_at END,
+        expires_at=CASE WHEN ?='PUBLISHED' THEN COALESCE(expires_at, ?) ELSE expires_at END
+    WHERE id=?
+"""
+ARCHIVE_COLS = "id, text, link, post_url, deliver_mode, orig_text, status, created_at, published_at, expires_at"
+SQL_GET_ARCHIVED = """
+    SELECT text, link, post_url, deliver_mode, orig_text, status
+    FROM listings_archive WHERE id = ?
+"""
+SQL_ARCHIVE = f"""
+    INSERT OR REPLACE INTO listings_archive ({ARCHIVE_COLS}, archived_at)
+    SELECT {ARCHIVE_COLS}, ? FROM listings WHERE id = ?
+"""
+SQL_EXPIRED = """
+    SELECT id, text, link, post_url, deliver_mode, orig_text, status
+    FROM listings WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+"""
+
+# keyset-пагинация: курсор — ID крайней строки страницы, каждая страница — один запрос по индексу
+SQL_PAGE_NEXT = """
+    SELECT id, text, status FROM listings WHERE id COLLATE NOCASE > ?
+    ORDER BY id COLLATE NOCASE LIMIT ?
+"""
+SQL_PAGE_PREV = """
+    SELECT id, text, status FROM listings WHERE id COLLATE NOCASE < ?
+    ORDER BY id COLLATE NOCASE DESC LIMIT ?
+"""
+SQL_PAGE_NEXT_STATUS = """
+    SELECT id, text, status FROM listings WHERE status = ? AND id COLLATE NOCASE > ?
+    ORDER BY id COLLATE NOCASE LIMIT ?
+"""
+SQL_PAGE_PREV_STATUS = """
+    SELECT id, text, status FROM listings WHERE status = ? AND id COLLATE NOCASE < ?
+    ORDER BY id COLLATE NOCASE DESC LIMIT ?
+"""
+
+def listing_row(listing_id: str, channel_text: str, link: str, post_url: str, deliver_mode: str,
+                orig_text: str, photos: List[str], status: str = "DRAFT") -> tuple:
+    """Строка для upsert_rows: параметры SQL_UPSERT в порядке колонок, последним — список фото."""
+    now = time.time()
+    published_at = now if status == "PUBLISHED" else None
+    return (listing_id, channel_text, link, post_url, deliver_mode, orig_text, status,
+            now, published_at, _expires_at(published_at), list(photos))
+
+def _expires_at(published_at: Optional[float]) -> Optional[float]:
+    if published_at is None or LISTING_TTL_HOURS <= 0:
+        return None
+    return published_at + LISTING_TTL_HOURS * 3600
+
+def upsert_rows(conn: sqlite3.Connection, rows: List[tuple]) -> None:
+    """Записать строки listing_row вместе с фото (фото объявления заменяются целиком)."""
+    conn.executemany(SQL_UPSERT, [row[:-1] for row in rows])
+    conn.executemany(SQL_PHOTOS_CLEAR, [(row[0],) for row in rows])
+    conn.executemany(SQL_PHOTOS_INSERT, [(row[0], pos, file_id)
+                                         for row in rows for pos, file_id in enumerate(row[-1])])
+
+def _upsert(conn: sqlite3.Connection, row: tuple) -> None:
+    upsert_rows(conn, [row])
+
+def _photos(conn: sqlite3.Connection, listing_id: str) -> List[str]:
+    return [r[0] for r in conn.execute(SQL_PHOTOS, (listing_id,))]
+
+def _get(conn: sqlite3.Connection, listing_id: str) -> Optional[Listing]:
+    row = conn.execute(SQL_GET, (listing_id,)).fetchone()
+    if row is None:
+        return None
+    text, link, post_url, deliver_mode, orig_text, status = row
+    return Listing(text, link, post_url, deliver_mode, orig_text, _photos(conn, listing_id), status)
+
+def _delete(conn: sqlite3.Connection, listing_id: str) -> bool:
+    conn.execute(SQL_PHOTOS_CLEAR, (listing_id,))
+    conn.execute(SQL_TARGETS_CLEAR, (listing_id,))
+    return conn.execute(SQL_DELETE, (listing_id,)).rowcount > 0
+
+def _set_status(conn: sqlite3.Connection, listing_id: str, status: str) -> None:
+    now = time.time()
+    conn.execute(SQL_SET_STATUS, (status, status, now, status, _expires_at(now), listing_id))
+
+def _get_archived(conn: sqlite3.Connection, listing_id: str) -> Optional[Listing]:
+    row = conn.execute(SQL_GET_ARCHIVED, (listing_id,)).fetchone()
+    if row is None:
+        return None
+    text, link, post_url, deliver_mode, orig_text, status = row
+    return Listing(text, link, post_url, deliver_mode, orig_text, _photos(conn, listing_id), status)
+
+def _lookup(conn: sqlite3.Connection, listing_id: str) -> Tuple[Optional[Listing], Optional[Listing]]:
+    """(рабочая строка, архивная) за одно обращение к пулу; архив смотрим, только если в рабочей нет."""
+    listing = _get(conn, listing_id)
+    return listing, None if listing is not None else _get_archived(conn, listing_id)
+
+def _sweep(conn: sqlite3.Connection, now: float, limit: int) -> List[Tuple[str, Listing]]:
+    """Перенести до limit просроченных объявлений в архив (одна транзакция)."""
+    rows = conn.execute(SQL_EXPIRED, (now, limit)).fetchall()
+    if not rows:
+        return []
+    ids = [(r[0],) for r in rows]
+    conn.executemany(SQL_ARCHIVE, [(now, r[0]) for r in rows])
+    conn.executemany(SQL_DELETE, ids)
+    # фото остаются в listing_photos — архив ссылается на них по тому же ID
+    return [(r[0], Listing(r[1], r[2], r[3], r[4], r[5], _photos(conn, r[0]), r[6])) for r in rows]
+
+SQL_SEARCH = """
+    SELECT l.id, l.text, l.status FROM listings_fts
+    JOIN listings l ON l.rowid = listings_fts.rowid
+    WHERE listings_fts MATCH ? AND (? = '' OR l.status = ?)
+    ORDER BY bm25(listings_fts) LIMIT ? OFFSET ?
+"""
+
+def fts_query(words: str) -> str:
+    """Слова пользователя → безопасный запрос FTS5: каждое слово как префикс, все обязательны."""
+    terms = re.findall(r"\w+", words.lower())[:10]
+    return " ".join(f'"{t}"*' for t in terms)
+
+def _search(conn: sqlite3.Connection, query: str, status: str, limit: int, offset: int) -> List[Tuple[str, str, str]]:
+    return conn.execute(SQL_SEARCH, (query, status, status, limit, offset)).fetchall()
+
+def _page(conn: sqlite3.Connection, status: str, cursor: str, backward: bool, limit: int) -> List[Tuple[str, str, str]]:
+    if status:
+        sql = SQL_PAGE_PREV_STATUS if backward else SQL_PAGE_NEXT_STATUS
+        return conn.execute(sql, (status, cursor, limit)).fetchall()
+    sql = SQL_PAGE_PREV if backward else SQL_PAGE_NEXT
+    return conn.execute(sql, (cursor, limit)).fetchall()
+
+async def db_upsert(listing_id: str, channel_text: str, link: str,
+                    post_url: str, deliver_mode: str, orig_text: str,
+                    photos: List[str], status: str = "DRAFT") -> None:
+    await write(_upsert, listing_row(
+        listing_id, channel_text, link, post_url, deliver_mode, orig_text, photos, status
+    ))
+    cache_invalidate(listing_id)
+    # write-through: свежая версия сразу в кэше, подписчики рендерят её заранее
+    listing = Listing(channel_text, link, post_url, deliver_mode, orig_text, list(photos), status)
+    listing_cache.set(listing_id, listing)
+    _notify(listing_id, listing)
+
+async def db_get(listing_id: str) -> Optional[Listing]:
+    listing = listing_cache.get(listing_id)
+    if listing is not None:
+        return listing
+    if missing_cache.get(listing_id) or archived_cache.get(listing_id):
+        return None
+    gen = _cache_gen
+    # заодно смотрим архив: следом за «не найдено» обычно спрашивают db_archived
+    listing, archived = await read(_lookup, listing_id)
+    if gen == _cache_gen:
+        if listing is not None:
+            listing_cache.set(listing_id, listing)
+        elif archived is not None:
+            archived_cache.set(listing_id, archived)
+        else:
+            missing_cache.set(listing_id, True)
+            archived_cache.set(listing_id, False, ttl=LISTING_NEG_TTL)
+    return listing
+
+async def db_delete(listing_id: str) -> bool:
+    ok = await write(_delete, listing_id)
+    cache_invalidate(listing_id)
+    return ok
+
+async def db_set_status(listing_id: str, status: str) -> None:
+    await write(_set_status, listing_id, status)
+    cache_invalidate(listing_id)
+
+async def db_archived(listing_id: str) -> Optional[Listing]:
+    """Объявление из архива (просрочено) или None."""
+    cached = archived_cache.get(listing_id)
+    if cached is not None:
+        return cached or None
+    gen = _cache_gen
+    listing = await read(_get_archived, listing_id)
+    if gen == _cache_gen:
+        archived_cache.set(listing_id, listing or False, ttl=None if listing else LISTING_NEG_TTL)
+    return listing
+
+async def db_sweep(batch: int = 500, now: Optional[float] = None) -> List[str]:
+    """Архивировать одну пачку просроченных объявлений. Возвращает их ID."""
+    moved = await write(_sweep, time.time() if now is None else now, batch)
+    for listing_id, listing in moved:
+        cache_invalidate(listing_id)
+        archived_cache.set(listing_id, listing)
+    return [listing_id for listing_id, _ in moved]
+
+def cache_stats() -> dict:
+    return {"listings": listing_cache.stats(), "missing": missing_cache.stats(),
+            "archived": archived_cache.stats()}
+
+async def db_search(words: str, status: str = "PUBLISHED", limit: int = 5,
+                    offset: int = 0) -> Tuple[List[Tuple[str, str, str]], bool]:
+    """Поиск по тексту, лучшие совпадения (BM25) первыми. Возвращает (rows, has_next)."""
+    query = fts_query(words)
+    if not query:
+        return [], False
+    rows = await read(_search, query, status, limit + 1, offset)
+    return rows[:limit], len(rows) > limit
+
+async def db_page(status: str = "", after: str = "", before: Optional[str] = None,
+                  limit: int = 20) -> Tuple[List[Tuple[str, str, str]], bool, bool]:
+    """Страница объявлений (id, text, status) по ID.
+
+    after — ID последней строки предыдущей страницы (вперёд), before — ID первой строки
+    следующей (назад); status — фильтр, '' — все. Возвращает (rows, has_prev, has_next).
+    """
+    if before is not None:
+        rows = await read(_page, status, before, True, limit + 1)
+        has_prev = len(rows) > limit
+        return rows[:limit][::-1], has_prev, True
+    rows = await read(_page, status, after, False, limit + 1)
+    return rows[:limit], bool(after), len(rows) > limit
@@ -0,0 +1,120 @@
+# dedup.py — отсев повторных доставок одного апдейта по update_id
+# Когда вебхук отвечает медленно, Telegram шлёт тот же апдейт ещё раз. Помним
+# последние size принятых update_id: кольцевой буфер задаёт порядок вытеснения,
+# множество — проверку за O(1). С persist=True принятые ID пачками пишутся в
+# seen_updates и подгружаются при старте — повтор после рестарта тоже отсеется.
+
+import time
+import asyncio
+import logging
+import sqlite3
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+import db
+
+
+def _load(conn: sqlite3.Connection, limit: int) -> List[int]:
+    rows = conn.execute("SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?", (limit,))
+    return [r[0] for r in rows][::-1]
+
+def _flush(conn: sqlite3.Connection, rows: List[tuple], forgotten: List[tuple], keep: int) -> None:
+    if rows:
+        conn.executemany("INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?)", rows)
+    if forgotten:
+        conn.executemany("DELETE FROM seen_updates WHERE update_id = ?", forgotten)
+    # храним не больше окна: всё старше keep-го с конца уже не поймать в памяти
+    conn.execute("""
+        DELETE FROM seen_updates WHERE update_id < (
+            SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT 1 OFFSET ?
+        )
+    """, (keep - 1,))
+
+
+class UpdateDedup:
+    def __init__(self, size: int = 10000, persist: bool = False, flush_delay: float = 1.0):
+        self.size = max(1, size)
+        self.persist = persist
+        self.flush_delay = flush_delay
+        self._ring: deque = deque()
+        self._seen: Set[int] = set()
+        self._pending: Dict[int, Optional[float]] = {}   # update_id → время приёма; None — забыть
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self.accepted = 0
+        self.dropped = 0
+
+    async def start(self) -> None:
+        if not self.persist:
+            return
+        for update_id in await db.read(_load, self.size):
+            self._remember(update_id)
+
+    def _remember(self, update_id: int) -> None:
+        if len(self._ring) >= self.size:
+            self._seen.discard(self._ring.popleft())
+        self._ring.append(update_id)
+        self._seen.add(update_id)
+
+    def check(self, update_id: int) -> bool:
+        """True — апдейт новый (и теперь запомнен); False — повтор, обрабатывать не нужно."""
+        if update_id in self._seen:
+            self.dropped += 1
+            return False
+        self._remember(update_id)
+        self.accepted += 1
+        if self.persist:
+            self._pending[update_id] = time.time()
+            if self._flush_task is None and not self._closing:
+                self._flush_task = asyncio.create_task(self._flush_later())
+        return True
+
+    def forget(self, update_id: int) -> None:
+        """Апдейт не обработан (503/ошибка) — повтор от Telegram нужно принять."""
+        if update_id in self._seen:
+            self._seen.discard(update_id)
+            try:
+                self._ring.remove(update_id)   # O(n), но только на пути ошибки
+            except ValueError:
+                pass
+        if self.persist:
+            self._pending[update_id] = None
+            if self._flush_task is None and not self._closing:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+        finally:
+            self._flush_task = None
+            if self._pending and not self._closing:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        rows = [(uid, at) for uid, at in batch.items() if at is not None]
+        forgotten = [(uid,) for uid, at in batch.items() if at is None]
+        try:
+            await db.write(_flush, rows, forgotten, self.size)
+        except BaseException as e:
+            for uid, at in batch.items():
+                self._pending.setdefault(uid, at)
+            if not isinstance(e, Exception):
+                raise
+            logging.exception("update dedup: flush failed, will retry")
+
+    async def close(self) -> None:
+        self._closing = True
+        task = self._flush_task
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"size": len(self._ring), "accepted": self.accepted, "dropped": self.dropped,
+                "pending": len(self._pending)}
@@ -0,0 +1,62 @@
+# expiry.py — фоновый перенос просроченных объявлений в архив
+# Срок жизни задаёт db.LISTING_TTL_HOURS (от первой публикации). Свипер раз в
+# interval секунд забирает просроченные пачками по batch строк — каждая пачка
+# в своей транзакции, чтобы не держать писателя SQLite надолго.
+# Кэши этого процесса сбрасывает db_sweep, других воркеров — cache_sync.py
+# (удаление из listings попадает в журнал listing_changes).
+
+import time
+import asyncio
+import logging
+from typing import Optional
+
+import db
+
+
+class ExpirySweeper:
+    def __init__(self, interval: float = 300, batch: int = 500):
+        self.interval = interval
+        self.batch = batch
+        self._task: Optional[asyncio.Task] = None
+
+        self.archived = 0
+        self.runs = 0
+        self.last_run = 0.0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="expiry-sweeper")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def sweep(self) -> int:
+        """Архивировать всё просроченное на текущий момент. Возвращает число объявлений."""
+        total = 0
+        now = time.time()
+        while True:
+            ids = await db.db_sweep(self.batch, now)
+            total += len(ids)
+            if len(ids) < self.batch:
+                break
+            await asyncio.sleep(0)   # между пачками даём дорогу запросам пользователей
+        self.archived += total
+        self.runs += 1
+        self.last_run = now
+        if total:
+            logging.info("expiry: %s listings archived", total)
+        return total
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                logging.exception("expiry: sweep failed")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {"archived": self.archived, "runs": self.runs, "last_run": self.last_run}
@@ -0,0 +1,156 @@
+# fsm_storage.py — FSM-хранилище aiogram поверх SQLite (тот же файл, что и объявления)
+# Черновики админа переживают рестарт и видны любому воркеру.
+# Все set_state/update_data одного шага копятся в памяти и уходят в БД одним
+# батчем, когда апдейт обработан (outer-middleware flush_after) — следующий шаг
+# того же чата может попасть в другой процесс (uvicorn --workers) и должен
+# увидеть записанное. Поэтому и кэша чтений нет: читаем из БД каждый раз.
+# Изменения вне хендлеров дописываются таймером через flush_delay секунд.
+
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.types import TelegramObject
+
+import db
+
+Record = Tuple[Optional[str], Dict[str, Any]]   # (state, data)
+EMPTY: Record = (None, {})
+
+
+# таблица fsm_state создаётся миграциями (migrations.py) в db_init
+
+def _get(conn: sqlite3.Connection, key: str) -> Optional[Tuple[Optional[str], str, float]]:
+    return conn.execute("SELECT state, data, updated_at FROM fsm_state WHERE key = ?", (key,)).fetchone()
+
+def _flush(conn: sqlite3.Connection, rows: List[tuple], deleted: List[tuple], expired_before: Optional[float]) -> int:
+    if rows:
+        conn.executemany("""
+            INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+        """, rows)
+    if deleted:
+        conn.executemany("DELETE FROM fsm_state WHERE key = ?", deleted)
+    if expired_before is not None:
+        return conn.execute("DELETE FROM fsm_state WHERE updated_at < ?", (expired_before,)).rowcount
+    return 0
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, flush_delay: float = 0.5, ttl: float = 7 * 24 * 3600,
+                 cleanup_interval: float = 3600):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.flush_delay = flush_delay
+        self.ttl = ttl                              # брошенные черновики старше ttl удаляются
+        self.cleanup_interval = cleanup_interval
+        self._pending: Dict[str, Record] = {}       # изменено, но ещё не записано
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._last_cleanup = 0.0
+
+        # статистика: сколько изменений пришло и сколько реальных записей в БД
+        self.changes = 0
+        self.flushes = 0
+        self.expired = 0
+
+    async def _load(self, key: StorageKey) -> Tuple[str, Record]:
+        k = self.key_builder.build(key)
+        rec = self._pending.get(k)
+        if rec is not None:
+            return k, rec
+        row = await db.read(_get, k)
+        if row is None or row[2] < time.time() - self.ttl:
+            rec = EMPTY
+        else:
+            rec = (row[0], json.loads(row[1]) if row[1] else {})
+        # пока читали, запись могла измениться — свежая версия важнее
+        return k, self._pending.get(k, rec)
+
+    def _put(self, k: str, rec: Record) -> None:
+        self._pending[k] = rec
+        self.changes += 1
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+        finally:
+            self._flush_task = None
+            if self._pending and not self._closing:   # новые изменения во время записи или неудачная запись
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush_after(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                          event: TelegramObject, data: Dict[str, Any]) -> Any:
+        """Outer-middleware диспетчера: записать изменения шага до того, как апдейт считается обработанным."""
+        try:
+            return await handler(event, data)
+        finally:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        now = time.time()
+        rows, deleted = [], []
+        for k, (state, data) in batch.items():
+            if state is None and not data:
+                deleted.append((k,))
+            else:
+                rows.append((k, state, json.dumps(data, ensure_ascii=False), now))
+        expired_before = None
+        if now - self._last_cleanup >= self.cleanup_interval:
+            expired_before = now - self.ttl
+        try:
+            self.expired += await db.write(_flush, rows, deleted, expired_before)
+        except BaseException as e:
+            # вернём батч в очередь; более новые изменения того же ключа важнее
+            for k, rec in batch.items():
+                self._pending.setdefault(k, rec)
+            if not isinstance(e, Exception):
+                raise
+            logging.exception("fsm storage: flush failed, will retry")
+            return
+        self.flushes += 1
+        if expired_before is not None:
+            self._last_cleanup = now
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, (_, data) = await self._load(key)
+        self._put(k, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, (state, _) = await self._load(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k, (state, _) = await self._load(key)
+        self._put(k, (state, dict(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, (_, data) = await self._load(key)
+        return data.copy()
+
+    async def close(self) -> None:
+        self._closing = True
+        task = self._flush_task
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "changes": self.changes,
+            "flushes": self.flushes,
+            "expired": self.expired,
+        }
@@ -0,0 +1,126 @@
+# importer.py — массовый импорт объявлений из JSONL/CSV
+# Файл читается построчно (целиком в память не грузится), каждая строка проверяется,
+# всё пишется одной транзакцией пачками через тот же UPSERT, что и db_upsert.
+
+import re
+import csv
+import json
+import sqlite3
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple
+
+import db
+
+BATCH_SIZE = 500
+MAX_PHOTOS = 9
+ID_RE = re.compile(r"^[A-Za-z]\d+$")
+DELIVER_MODES = ("TEXT", "LINK")
+STATUSES = ("DRAFT", "PUBLISHED")
+
+
+class ImportResult(NamedTuple):
+    inserted: int
+    updated: int
+    errors: List[Tuple[int, str]]   # (номер строки, причина)
+
+
+def _iter_rows(path: str, fmt: str) -> Iterator[Tuple[int, Any]]:
+    """(номер строки, dict) — или (номер, ValueError), если строку не удалось разобрать."""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield lineno, json.loads(line)
+            except ValueError as e:
+                yield lineno, ValueError(f"невалидный JSON: {e}")
+
+def _photos(value: Any) -> List[str]:
+    if value in (None, ""):
+        return []
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise ValueError("photos: ожидается JSON-список file_id")
+    if not isinstance(value, list) or not all(isinstance(p, str) and p for p in value):
+        raise ValueError("photos: ожидается список file_id")
+    if len(value) > MAX_PHOTOS:
+        raise ValueError(f"photos: не больше {MAX_PHOTOS}")
+    return value
+
+def validate(raw: Any) -> tuple:
+    """Строка файла → параметры UPSERT; ValueError с понятной причиной, если что-то не так."""
+    if isinstance(raw, Exception):
+        raise raw
+    if not isinstance(raw, dict):
+        raise ValueError("ожидается объект с полями listings")
+    row: Dict[str, Any] = {k.strip(): v for k, v in raw.items() if isinstance(k, str)}
+
+    def text(name: str, default: str = "") -> str:
+        value = row.get(name)
+        return default if value is None else str(value).strip()
+
+    listing_id = text("id").upper()
+    if not ID_RE.match(listing_id):
+        raise ValueError(f"id: неверный формат «{listing_id}» (нужно как A101)")
+    if not text("text"):
+        raise ValueError("text: пусто")
+    if not text("link"):
+        raise ValueError("link: пусто")
+    deliver_mode = text("deliver_mode", "TEXT").upper() or "TEXT"
+    if deliver_mode not in DELIVER_MODES:
+        raise ValueError(f"deliver_mode: {deliver_mode} (допустимо {'/'.join(DELIVER_MODES)})")
+    status = text("status", "DRAFT").upper() or "DRAFT"
+    if status not in STATUSES:
+        raise ValueError(f"status: {status} (допустимо {'/'.join(STATUSES)})")
+
+    return db.listing_row(
+        listing_id, text("text"), text("link"), text("post_url"), deliver_mode,
+        text("orig_text"), _photos(row.get("photos")), status,
+    )
+
+def _existing(conn: sqlite3.Connection, ids: List[str]) -> set:
+    marks = ",".join("?" * len(ids))
+    return {r[0] for r in conn.execute(f"SELECT id FROM listings WHERE id IN ({marks})", ids)}
+
+def _flush(conn: sqlite3.Connection, batch: Dict[str, tuple]) -> Tuple[int, int]:
+    existing = _existing(conn, list(batch))
+    db.upsert_rows(conn, list(batch.values()))
+    return len(batch) - len(existing), len(existing)
+
+def _import(conn: sqlite3.Connection, path: str, fmt: str) -> ImportResult:
+    inserted = updated = 0
+    errors: List[Tuple[int, str]] = []
+    batch: Dict[str, tuple] = {}   # ID → параметры UPSERT
+    for lineno, raw in _iter_rows(path, fmt):
+        try:
+            row = validate(raw)
+        except ValueError as e:
+            errors.append((lineno, str(e)))
+            continue
+        if row[0] in batch:
+            # повтор ID внутри пачки: сначала сбрасываем пачку, чтобы счётчики не врали
+            ins, upd = _flush(conn, batch)
+            inserted, updated, batch = inserted + ins, updated + upd, {}
+        batch[row[0]] = row
+        if len(batch) >= BATCH_SIZE:
+            ins, upd = _flush(conn, batch)
+            inserted, updated, batch = inserted + ins, updated + upd, {}
+    if batch:
+        ins, upd = _flush(conn, batch)
+        inserted, updated = inserted + ins, updated + upd
+    return ImportResult(inserted, updated, errors)
+
+def detect_format(filename: str) -> str:
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+async def import_file(path: str, fmt: str) -> ImportResult:
+    """Импорт одной транзакцией в потоке-писателе; кэш объявлений после него сбрасывается."""
+    result = await db.write(_import, path, fmt)
+    db.cache_invalidate_all()
+    return result
@@ -0,0 +1,86 @@
+# leader.py — выбор лидера среди воркеров одного хоста через flock
+# Лидер один: он регистрирует вебхук, прогоняет миграции и крутит фоновые
+# задачи (очередь публикаций). Блокировку держит, пока жив процесс; ОС снимает
+# её сама при падении — тогда лидерство подхватывает следующий воркер.
+
+import os
+import fcntl
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Tuple
+
+LOCK_DIR = os.getenv("LEADER_LOCK_DIR") or os.path.dirname(os.path.abspath(os.getenv("DB_FILE", "listings.db")))
+
+
+class LeaderLock:
+    def __init__(self, name: str = "rentbot", lock_dir: str = LOCK_DIR):
+        self.path = os.path.join(lock_dir, f".{name}.leader.lock")
+        self.init_path = os.path.join(lock_dir, f".{name}.init.lock")
+        self._fd: Optional[int] = None
+        self._watch: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def _elect(self) -> Tuple[int, bool]:
+        # под init-блокировкой: кто первым её взял, тот и лидер, остальные ждут
+        # его миграций и только потом видят занятую блокировку лидера
+        fd = os.open(self.init_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd, self.try_acquire()
+
+    async def elect(self, init: Callable[[], Awaitable[None]]) -> bool:
+        """Выбрать лидера; лидер выполняет init() до того, как остальные воркеры продолжат старт."""
+        fd, leader = await asyncio.to_thread(self._elect)
+        try:
+            if leader:
+                await init()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        logging.info("worker %s: %s", os.getpid(), "leader" if leader else "follower")
+        return leader
+
+    def watch(self, on_promote: Callable[[], Awaitable[None]], interval: float = 5.0) -> None:
+        """Ведомый периодически пробует забрать лидерство (лидер упал или перезапускается)."""
+        if self.is_leader or self._watch is not None:
+            return
+
+        async def loop() -> None:
+            while not self.try_acquire():
+                await asyncio.sleep(interval)
+            logging.warning("worker %s: promoted to leader", os.getpid())
+            try:
+                await on_promote()
+            except Exception:
+                logging.exception("leader: on_promote failed")
+
+        self._watch = asyncio.create_task(loop(), name="leader-watch")
+
+    async def stop(self) -> None:
+        if self._watch is not None:
+            self._watch.cancel()
+            await asyncio.gather(self._watch, return_exceptions=True)
+            self._watch = None
+        self.release()
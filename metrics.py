@@ -0,0 +1,156 @@
+# metrics.py — метрики в текстовом формате Prometheus (без внешних зависимостей)
+# Счётчики и гистограммы обновляются только из event loop, поэтому без блокировок:
+# горячий путь — это поиск в dict и пара сложений.
+
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _labels(names: Tuple[str, ...], values: Labels) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = ()):
+        self.name, self.doc, self.labelnames = name, doc, labelnames
+        self._values: Dict[Labels, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels: str, value: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self._values.items()]
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.doc, self.labelnames = name, doc, labelnames
+        self.buckets = buckets
+        self._values: Dict[Labels, list] = {}   # labels → [counts по бакетам..., +Inf, sum]
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        row = self._values.get(labels)
+        if row is None:
+            row = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for labels, row in self._values.items():
+            acc = 0
+            for bound, n in zip(self.buckets, row):
+                acc += n
+                out.append(f"{self.name}_bucket{_labels(names, labels + (repr(bound),))} {acc}")
+            acc += row[len(self.buckets)]
+            out.append(f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {row[-1]}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {acc}")
+        return out
+
+
+REGISTRY: List[Any] = []
+_collectors: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+def register_stats(prefix: str, stats: Callable[[], Dict[str, Any]]) -> None:
+    """Отдавать числа из stats() как gauge rentbot_<prefix>_<ключ>; вложенный dict → label kind."""
+    _collectors.append((prefix, stats))
+
+def _render_stats() -> List[str]:
+    series: Dict[str, List[str]] = {}
+    for prefix, stats in _collectors:
+        try:
+            data = stats()
+        except Exception:
+            continue
+        for key, value in data.items():
+            if isinstance(value, dict):
+                for k, v in value.items():
+                    if isinstance(v, (int, float)):
+                        series.setdefault(f"rentbot_{prefix}_{k}", []).append(f'{{kind="{key}"}} {v}')
+            elif isinstance(value, (int, float)):
+                series.setdefault(f"rentbot_{prefix}_{key}", []).append(f" {value}")
+    out = []
+    for name, lines in series.items():
+        out.append(f"# TYPE {name} gauge")
+        out += [name + line for line in lines]
+    return out
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    lines += _render_stats()
+    return "\n".join(lines) + "\n"
+
+
+# ── Метрики приложения ───────────────────────────────────────────────────────
+handler_latency = Histogram("rentbot_handler_seconds", "Handler latency", ("router", "handler"))
+handler_errors  = Counter("rentbot_handler_errors_total", "Handler exceptions", ("router", "handler"))
+api_requests    = Counter("rentbot_bot_api_requests_total", "Bot API calls by method and result", ("method", "result"))
+api_latency     = Histogram("rentbot_bot_api_seconds", "Bot API call latency", ("method",))
+db_latency      = Histogram("rentbot_db_seconds", "DB call latency (including executor wait)", ("query",))
+funnel          = Counter("rentbot_funnel_total", "Payment funnel steps", ("step",))
+
+
+class HandlerMetrics(BaseMiddleware):
+    """Inner-middleware роутера: латентность и ошибки по (роутер, хендлер)."""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        router = data["event_router"].name
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(router, name)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, router, name)
+
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Request-middleware сессии: каждый реальный вызов Bot API (включая 429)."""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        name = method.__api_method__
+        started = time.perf_counter()
+        result = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            result = "429"
+            raise
+        except TelegramBadRequest:
+            result = "400"
+            raise
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            api_requests.inc(name, result)
+            api_latency.observe(time.perf_counter() - started, name)
@@ -0,0 +1,333 @@
+# migrations.py — версионированные миграции схемы SQLite
+# Текущая версия хранится в таблице schema_version. На старте применяются только
+# недостающие шаги, по порядку, каждый в своей транзакции вместе с записью версии:
+# упавший шаг откатывается целиком, и следующий запуск начнёт с него же.
+# Новая миграция — функция step(conn) в конце MIGRATIONS; старые шаги не меняем.
+
+import time
+import logging
+import sqlite3
+from typing import Callable, List, Tuple
+
+
+# ── v1: исходная схема ───────────────────────────────────────────────────────
+# Идемпотентна: базы, созданные до появления версий, проходят её без потерь.
+def _v1_base(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS listings (
+            id           TEXT PRIMARY KEY,
+            text         TEXT NOT NULL,
+            link         TEXT NOT NULL,
+            post_url     TEXT DEFAULT '',
+            deliver_mode TEXT DEFAULT 'TEXT',
+            orig_text    TEXT DEFAULT '',
+            photos       TEXT DEFAULT '[]',     -- JSON: [file_id, ...]
+            status       TEXT DEFAULT 'DRAFT',  -- DRAFT | PUBLISHED
+            created_at   REAL,                  -- unix time; NULL — неизвестно / бессрочно
+            published_at REAL,
+            expires_at   REAL
+        )
+    """)
+    # старые базы: колонки, добавленные после первой версии бота
+    cols = {row[1] for row in conn.execute("PRAGMA table_info(listings)")}
+    for col, ddl in (("photos", "TEXT DEFAULT '[]'"), ("status", "TEXT DEFAULT 'DRAFT'"),
+                     ("created_at", "REAL"), ("published_at", "REAL"), ("expires_at", "REAL")):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE listings ADD COLUMN {col} {ddl}")
+
+    # архив: сюда переезжают просроченные объявления, рабочая таблица остаётся маленькой
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS listings_archive (
+            id           TEXT PRIMARY KEY,
+            text         TEXT NOT NULL,
+            link         TEXT NOT NULL,
+            post_url     TEXT DEFAULT '',
+            deliver_mode TEXT DEFAULT 'TEXT',
+            orig_text    TEXT DEFAULT '',
+            photos       TEXT DEFAULT '[]',
+            status       TEXT DEFAULT 'PUBLISHED',
+            created_at   REAL,
+            published_at REAL,
+            expires_at   REAL,
+            archived_at  REAL NOT NULL
+        )
+    """)
+
+    # журнал покупок: повтор successful_payment ловится уникальным индексом по charge_id
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS purchases (
+            id                         INTEGER PRIMARY KEY,
+            telegram_payment_charge_id TEXT,               -- NULL в демо-режиме
+            provider_payment_charge_id TEXT,
+            user_id                    INTEGER NOT NULL,
+            listing_id                 TEXT NOT NULL,
+            amount                     INTEGER NOT NULL DEFAULT 0,
+            currency                   TEXT NOT NULL DEFAULT '',
+            created_at                 REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_charge ON purchases(telegram_payment_charge_id)")
+
+    # полнотекстовый поиск: FTS5 поверх text/orig_text, синхронизируется триггерами,
+    # так что любые записи в listings (db_upsert, импорт, удаление) попадают в индекс.
+    # rowid listings не закреплён INTEGER PRIMARY KEY — после VACUUM нужен 'rebuild'.
+    fts_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='listings_fts'"
+    ).fetchone()
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+            text, orig_text, content='listings', content_rowid='rowid'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_ai AFTER INSERT ON listings BEGIN
+            INSERT INTO listings_fts(rowid, text, orig_text) VALUES (new.rowid, new.text, new.orig_text);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_ad AFTER DELETE ON listings BEGIN
+            INSERT INTO listings_fts(listings_fts, rowid, text, orig_text)
+            VALUES ('delete', old.rowid, old.text, old.orig_text);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_au AFTER UPDATE OF text, orig_text ON listings BEGIN
+            INSERT INTO listings_fts(listings_fts, rowid, text, orig_text)
+            VALUES ('delete', old.rowid, old.text, old.orig_text);
+            INSERT INTO listings_fts(rowid, text, orig_text) VALUES (new.rowid, new.text, new.orig_text);
+        END
+    """)
+    if not fts_exists:
+        conn.execute("INSERT INTO listings_fts(listings_fts) VALUES ('rebuild')")
+
+    # очередь публикаций в канал
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS publish_queue (
+            id          INTEGER PRIMARY KEY,
+            listing_id  TEXT NOT NULL,
+            publish_at  REAL NOT NULL,                    -- unix time, не раньше которого публикуем
+            status      TEXT NOT NULL DEFAULT 'PENDING',  -- PENDING | DONE | FAILED
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            last_error  TEXT NOT NULL DEFAULT '',
+            created_at  REAL NOT NULL,
+            done_at     REAL
+        )
+    """)
+
+    # состояние FSM (fsm_storage.py)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key        TEXT PRIMARY KEY,
+            state      TEXT,
+            data       TEXT NOT NULL DEFAULT '{}',   -- JSON
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+# ── v2: фото — отдельной таблицей вместо JSON в строке ───────────────────────
+def _v2_listing_photos(conn: sqlite3.Connection) -> None:
+    # строки переживают архивацию объявления: архив ссылается на них по тому же ID
+    conn.execute("""
+        CREATE TABLE listing_photos (
+            listing_id TEXT NOT NULL,
+            position   INTEGER NOT NULL,
+            file_id    TEXT NOT NULL,
+            PRIMARY KEY (listing_id, position)
+        ) WITHOUT ROWID
+    """)
+    for table in ("listings", "listings_archive"):
+        conn.execute(f"""
+            INSERT OR IGNORE INTO listing_photos (listing_id, position, file_id)
+            SELECT t.id, CAST(j.key AS INTEGER), j.value
+            FROM {table} t, json_each(t.photos) j
+            WHERE json_valid(t.photos) AND json_type(t.photos) = 'array' AND j.type = 'text'
+        """)
+        conn.execute(f"ALTER TABLE {table} DROP COLUMN photos")
+
+
+# ── v3: индексы под список, фильтр статуса, срок жизни и покупки ─────────────
+def _v3_indexes(conn: sqlite3.Connection) -> None:
+    # keyset-пагинация по ID без учёта регистра, с фильтром статуса и без
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_listings_id_nocase ON listings(id COLLATE NOCASE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_listings_status_id ON listings(status, id COLLATE NOCASE)")
+    # частичный индекс: в нём только объявления со сроком, свипер читает его с начала
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_listings_expires ON listings(expires_at) WHERE expires_at IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id, listing_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_listing ON purchases(listing_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_publish_queue_due ON publish_queue(status, publish_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_publish_queue_listing ON publish_queue(listing_id, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at)")
+    # статистика для планировщика запросов по свежим индексам
+    conn.execute("ANALYZE")
+
+
+# ── v4: воронка по объявлениям (analytics.py) ────────────────────────────────
+def _v4_listing_stats(conn: sqlite3.Connection) -> None:
+    # уже агрегировано по дням: строк — объявления × дни × события, не события
+    conn.execute("""
+        CREATE TABLE listing_stats (
+            day        TEXT NOT NULL,      -- YYYY-MM-DD
+            listing_id TEXT NOT NULL,
+            event      TEXT NOT NULL,      -- lookup | confirm | pay | pre_checkout | paid
+            count      INTEGER NOT NULL,
+            PRIMARY KEY (day, listing_id, event)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX idx_listing_stats_listing ON listing_stats(listing_id, day)")
+
+
+# ── v5: принятые вебхуком update_id (dedup.py, если включено сохранение) ─────
+def _v5_seen_updates(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE seen_updates (
+            update_id INTEGER PRIMARY KEY,
+            seen_at   REAL NOT NULL
+        )
+    """)
+
+
+# ── v6: подписки на новые объявления и рассылки по ним (subscriptions.py) ────
+def _v6_subscriptions(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE subscriptions (
+            id         INTEGER PRIMARY KEY,
+            user_id    INTEGER NOT NULL,
+            query      TEXT NOT NULL,         -- нормализованные слова через пробел
+            n_terms    INTEGER NOT NULL,      -- 0 — все новые объявления
+            created_at REAL NOT NULL,
+            UNIQUE (user_id, query)
+        )
+    """)
+    # «все объявления» — частичный индекс, в нём только подписки без слов
+    conn.execute("CREATE INDEX idx_subscriptions_all ON subscriptions(user_id) WHERE n_terms = 0")
+    # обратный индекс: слово → подписки, в которых оно есть
+    conn.execute("""
+        CREATE TABLE subscription_terms (
+            term            TEXT NOT NULL,
+            subscription_id INTEGER NOT NULL,
+            PRIMARY KEY (term, subscription_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE broadcasts (
+            id         INTEGER PRIMARY KEY,
+            listing_id TEXT NOT NULL UNIQUE,              -- одна рассылка на объявление
+            status     TEXT NOT NULL DEFAULT 'PENDING',   -- PENDING | DONE | CANCELLED
+            total      INTEGER NOT NULL DEFAULT 0,
+            sent       INTEGER NOT NULL DEFAULT 0,
+            failed     INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            done_at    REAL
+        )
+    """)
+    conn.execute("CREATE INDEX idx_broadcasts_status ON broadcasts(status, id)")
+    # получатели материализуются при создании рассылки: после рестарта продолжаем с места
+    conn.execute("""
+        CREATE TABLE broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            user_id      INTEGER NOT NULL,
+            status       INTEGER NOT NULL DEFAULT 0,   -- 0 ждёт, 1 доставлено, 2 ошибка
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX idx_broadcast_recipients_pending ON broadcast_recipients(broadcast_id) WHERE status = 0")
+
+
+# ── v7: outbox выдачи оплаченного (outbox.py) ────────────────────────────────
+def _v7_delivery_outbox(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE delivery_outbox (
+            id          INTEGER PRIMARY KEY,
+            purchase_id INTEGER,                          -- purchases.id
+            user_id     INTEGER NOT NULL,
+            listing_id  TEXT NOT NULL,
+            status      TEXT NOT NULL DEFAULT 'PENDING',  -- PENDING | DONE | FAILED
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            next_at     REAL NOT NULL,                    -- не раньше; у взятой в работу — конец аренды
+            last_error  TEXT NOT NULL DEFAULT '',
+            created_at  REAL NOT NULL,
+            done_at     REAL
+        )
+    """)
+    # в индексе только невыданное — выборка «что пора отправить» не растёт с историей
+    conn.execute("CREATE INDEX idx_delivery_outbox_due ON delivery_outbox(next_at) WHERE status = 'PENDING'")
+
+
+# ── v8: каналы публикации объявления и статус поста в каждом (channels.py) ───
+def _v8_listing_targets(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE listing_targets (
+            listing_id TEXT NOT NULL,
+            channel    TEXT NOT NULL,                     -- ключ канала из CHANNELS
+            status     TEXT NOT NULL DEFAULT 'PENDING',   -- PENDING | POSTED | FAILED
+            attempts   INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT NOT NULL DEFAULT '',
+            posted_at  REAL,
+            PRIMARY KEY (listing_id, channel)
+        ) WITHOUT ROWID
+    """)
+
+
+# ── v9: журнал изменений объявлений для кэшей других процессов (cache_sync.py) ─
+# Пишется триггерами, поэтому сюда попадает любая запись в listings: правка,
+# смена статуса, удаление, импорт, перенос в архив.
+def _v9_listing_changes(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE listing_changes (
+            seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+            listing_id TEXT NOT NULL
+        )
+    """)
+    for event, ref in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+        conn.execute(f"""
+            CREATE TRIGGER listing_changes_{event.lower()} AFTER {event} ON listings
+            BEGIN INSERT INTO listing_changes (listing_id) VALUES ({ref}.id); END
+        """)
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "base schema", _v1_base),
+    (2, "listing_photos table", _v2_listing_photos),
+    (3, "indexes", _v3_indexes),
+    (4, "listing_stats rollups", _v4_listing_stats),
+    (5, "seen_updates", _v5_seen_updates),
+    (6, "subscriptions and broadcasts", _v6_subscriptions),
+    (7, "delivery_outbox", _v7_delivery_outbox),
+    (8, "listing_targets", _v8_listing_targets),
+    (9, "listing_changes", _v9_listing_changes),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version    INTEGER PRIMARY KEY,
+            name       TEXT NOT NULL,
+            applied_at REAL NOT NULL
+        )
+    """)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применить недостающие миграции. Возвращает число применённых шагов."""
+    if conn.in_transaction:
+        conn.commit()
+    version = current_version(conn)
+    applied = 0
+    for number, name, step in MIGRATIONS:
+        if number <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step(conn)
+            conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                         (number, name, time.time()))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        logging.info("migration %s (%s) applied", number, name)
+        applied += 1
+    return applied
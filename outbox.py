@@ -0,0 +1,193 @@
+# outbox.py — надёжная выдача оплаченного через таблицу delivery_outbox
+# Хендлер оплаты в одной транзакции пишет покупку и строку «выдать ID X
+# пользователю Y» (purchases.record_purchase) и сразу возвращается. Выдачу
+# делает DeliveryOutbox: берёт строки атомарно (UPDATE … RETURNING с арендой
+# на lease секунд), при ошибке повторяет с экспоненциальной паузой, успешные
+# помечает DONE. Строка, взятая процессом, который упал, вернётся в работу,
+# когда истечёт аренда, — после рестарта выдача продолжится сама.
+# Пока выдача идёт, аренда продлевается каждые lease/3 секунд: ожидание лимитов
+# SendScheduler (429 retry_after, пустой bucket чата) может длиться дольше lease,
+# и без продления строку взял бы второй воркер — контакт пришёл бы дважды.
+# Работает в каждом воркере: захват атомарный, одну строку не возьмут двое.
+
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramForbiddenError
+
+import db
+
+PENDING, DONE, FAILED = "PENDING", "DONE", "FAILED"
+
+
+class SkipDelivery(Exception):
+    """Повторять бессмысленно (например, объявления нет и в архиве) — сразу FAILED и on_fail."""
+
+SQL_ENQUEUE = """
+    INSERT INTO delivery_outbox (purchase_id, user_id, listing_id, next_at, created_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_CLAIM = """
+    UPDATE delivery_outbox SET next_at = ?, attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM delivery_outbox WHERE status = 'PENDING' AND next_at <= ?
+        ORDER BY next_at LIMIT ?
+    )
+    RETURNING id, user_id, listing_id, attempts
+"""
+
+
+def enqueue(conn: sqlite3.Connection, purchase_id: Optional[int], user_id: int, listing_id: str, now: float) -> None:
+    """Поставить выдачу в outbox. Вызывается внутри транзакции, записывающей покупку."""
+    conn.execute(SQL_ENQUEUE, (purchase_id, user_id, listing_id, now, now))
+
+def _claim(conn: sqlite3.Connection, now: float, lease: float, limit: int) -> List[Tuple[int, int, str, int]]:
+    return conn.execute(SQL_CLAIM, (now + lease, now, limit)).fetchall()
+
+def _renew(conn: sqlite3.Connection, item_id: int, attempts: int, until: float) -> None:
+    # attempts — метка захвата: чужой (перехваченной после истечения) аренды не касаемся
+    conn.execute("UPDATE delivery_outbox SET next_at=? WHERE id=? AND attempts=? AND status='PENDING'",
+                 (until, item_id, attempts))
+
+def _next_due(conn: sqlite3.Connection) -> Optional[float]:
+    return conn.execute("SELECT MIN(next_at) FROM delivery_outbox WHERE status = 'PENDING'").fetchone()[0]
+
+# итог пишем, только пока строка за нами (та же метка attempts, что и в _renew);
+# False — аренду перехватил другой воркер, итог теперь за ним
+def _done(conn: sqlite3.Connection, item_id: int, attempts: int, now: float) -> bool:
+    return conn.execute(
+        "UPDATE delivery_outbox SET status=?, done_at=? WHERE id=? AND attempts=? AND status='PENDING'",
+        (DONE, now, item_id, attempts),
+    ).rowcount > 0
+
+def _fail(conn: sqlite3.Connection, item_id: int, attempts: int, error: str, retry_at: Optional[float]) -> bool:
+    if retry_at is None:
+        cur = conn.execute(
+            "UPDATE delivery_outbox SET status=?, last_error=? WHERE id=? AND attempts=? AND status='PENDING'",
+            (FAILED, error, item_id, attempts),
+        )
+    else:
+        cur = conn.execute(
+            "UPDATE delivery_outbox SET last_error=?, next_at=? WHERE id=? AND attempts=? AND status='PENDING'",
+            (error, retry_at, item_id, attempts),
+        )
+    return cur.rowcount > 0
+
+
+class DeliveryOutbox:
+    def __init__(self, deliver: Callable[[int, str], Awaitable[None]],
+                 on_fail: Optional[Callable[[int, str, str], Awaitable[None]]] = None,
+                 max_attempts: int = 10, lease: float = 120, batch: int = 20,
+                 poll_interval: float = 30):
+        self.deliver = deliver        # (user_id, listing_id) → выдача; исключение — не получилось
+        self.on_fail = on_fail        # вызывается, когда попытки кончились
+        self.max_attempts = max_attempts
+        self.lease = lease            # на столько строка закреплена за взявшим её процессом
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+        self.lost = 0        # аренду перехватили — итог записал не этот воркер
+
+    def wake(self) -> None:
+        """В outbox появилась строка — разобрать сейчас, не дожидаясь опроса."""
+        self._wake.set()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="delivery-outbox")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            delay = self.poll_interval
+            try:
+                items = await db.write(_claim, time.time(), self.lease, self.batch)
+                if items:
+                    # ошибка записи итога одной строки не должна обрывать остальные выдачи пачки
+                    results = await asyncio.gather(*(self._process(*item) for item in items),
+                                                   return_exceptions=True)
+                    for item, result in zip(items, results):
+                        if isinstance(result, Exception):
+                            logging.error("outbox: item %s not finalized", item[0], exc_info=result)
+                    continue
+                due = await db.read(_next_due)
+                if due is not None:
+                    delay = min(delay, max(0.0, due - time.time()))
+            except Exception:
+                logging.exception("outbox: drain failed")
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _process(self, item_id: int, user_id: int, listing_id: str, attempts: int) -> None:
+        try:
+            await self._deliver_leased(item_id, user_id, listing_id, attempts)
+        except (TelegramForbiddenError, SkipDelivery) as e:
+            # пользователь заблокировал бота или выдавать нечего — повторы не помогут
+            await self._give_up(item_id, user_id, listing_id, attempts, str(e))
+            return
+        except Exception as e:
+            logging.exception("delivery of %s to %s failed (attempt %s)", listing_id, user_id, attempts)
+            if attempts >= self.max_attempts:
+                await self._give_up(item_id, user_id, listing_id, attempts, str(e))
+            else:
+                self.retried += 1
+                backoff = min(5 * 2 ** (attempts - 1), 600)
+                if not await db.write(_fail, item_id, attempts, str(e), time.time() + backoff):
+                    self._lost(item_id)
+            return
+        self.delivered += 1
+        if not await db.write(_done, item_id, attempts, time.time()):
+            self._lost(item_id)
+
+    def _lost(self, item_id: int) -> None:
+        self.lost += 1
+        logging.warning("outbox: lease on %s was taken over, result not written", item_id)
+
+    async def _deliver_leased(self, item_id: int, user_id: int, listing_id: str, attempts: int) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat(item_id, attempts))
+        try:
+            await self.deliver(user_id, listing_id)
+        finally:
+            # итог выдачи пишется уже после остановки продления — его не перезапишет
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _heartbeat(self, item_id: int, attempts: int) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await db.write(_renew, item_id, attempts, time.time() + self.lease)
+            except Exception:
+                logging.exception("outbox: lease renewal for %s failed", item_id)
+
+    async def _give_up(self, item_id: int, user_id: int, listing_id: str, attempts: int, error: str) -> None:
+        if not await db.write(_fail, item_id, attempts, error, None):
+            # строка уже у другого воркера — он и решит, сдаваться ли
+            self._lost(item_id)
+            return
+        self.failed += 1
+        if self.on_fail is not None:
+            try:
+                await self.on_fail(user_id, listing_id, error)
+            except Exception:
+                logging.exception("outbox: on_fail hook failed")
+
+    def stats(self) -> dict:
+        return {"delivered": self.delivered, "retried": self.retried, "failed": self.failed, "lost": self.lost}
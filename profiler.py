@@ -0,0 +1,125 @@
+# profiler.py — выборочное профилирование обработки апдейтов (cProfile)
+# Outer-middleware диспетчера профилирует долю sample апдейтов — не больше одного
+# одновременно: cProfile в потоке может быть только один. Пока профиль включён,
+# в него попадают и другие задачи event loop'а (ответы Bot API, фоновые
+# задачи) — это шум, на большом числе апдейтов он размывается. Запросы SQLite
+# идут в потоках db.py и сюда не попадают: их время — в rentbot_db_seconds.
+# Результаты копятся по хендлерам (inner-middleware tag подписывает профиль
+# именем «роутер:хендлер») и выгружаются файлом pstats и текстовым отчётом.
+# Выключенный профайлер — одна проверка атрибута на апдейт.
+
+import io
+import os
+import time
+import random
+import pstats
+import cProfile
+import tempfile
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# ячейка для имени хендлера профилируемого апдейта; None — апдейт не профилируется
+_slot: ContextVar[Optional[List[str]]] = ContextVar("profile_slot", default=None)
+
+
+class Profiler(BaseMiddleware):
+    def __init__(self, sample: float = 0.1, enabled: bool = False):
+        self.enabled = enabled
+        self.sample = sample
+        self._busy = False
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._counts: Dict[str, int] = {}
+        self.started_at = time.time() if enabled else 0.0
+
+        self.profiled = 0
+        self.skipped_busy = 0   # попал в выборку, но профилировался другой апдейт
+
+    def start(self, sample: Optional[float] = None) -> None:
+        if sample is not None:
+            self.sample = sample
+        if not self.enabled:
+            self.enabled = True
+            self.started_at = time.time()
+
+    def stop(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        self._stats.clear()
+        self._counts.clear()
+        self.profiled = 0
+        self.skipped_busy = 0
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if not self.enabled or random.random() >= self.sample:
+            return await handler(event, data)
+        if self._busy:
+            self.skipped_busy += 1
+            return await handler(event, data)
+
+        self._busy = True
+        slot = ["<unhandled>"]
+        token = _slot.set(slot)
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            return await handler(event, data)
+        finally:
+            prof.disable()
+            _slot.reset(token)
+            self._busy = False
+            self._add(slot[0], prof)
+
+    async def tag(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                  event: TelegramObject, data: Dict[str, Any]) -> Any:
+        """Inner-middleware роутеров: подписать текущий профиль именем хендлера."""
+        if self.enabled:
+            slot = _slot.get()
+            if slot is not None:
+                slot[0] = f"{data['event_router'].name}:{data['handler'].callback.__name__}"
+        return await handler(event, data)
+
+    def _add(self, name: str, prof: cProfile.Profile) -> None:
+        existing = self._stats.get(name)
+        if existing is None:
+            self._stats[name] = pstats.Stats(prof)
+        else:
+            existing.add(prof)
+        self._counts[name] = self._counts.get(name, 0) + 1
+        self.profiled += 1
+
+    # ── выгрузка ──
+    def report(self, limit: int = 25) -> str:
+        """Текстовый отчёт: по каждому хендлеру — топ функций по cumulative."""
+        out = io.StringIO()
+        for name, count in sorted(self._counts.items(), key=lambda kv: -kv[1]):
+            out.write(f"==== {name}: {count} апдейт(ов) ====\n")
+            st = self._stats[name]
+            st.stream = out
+            st.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def dump(self) -> Optional[Tuple[bytes, str]]:
+        """Все хендлеры одним файлом pstats (python -m pstats, snakeviz) и текстовый отчёт.
+        None — профилей ещё нет."""
+        if not self._stats:
+            return None
+        merged = pstats.Stats()
+        merged.add(*self._stats.values())
+        fd, path = tempfile.mkstemp(suffix=".pstats")
+        os.close(fd)
+        try:
+            merged.dump_stats(path)
+            with open(path, "rb") as f:
+                data = f.read()
+        finally:
+            os.unlink(path)
+        return data, self.report()
+
+    def stats(self) -> dict:
+        return {"enabled": int(self.enabled), "sample": self.sample, "profiled": self.profiled,
+                "skipped_busy": self.skipped_busy, "handlers": len(self._stats)}
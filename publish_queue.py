@@ -0,0 +1,158 @@
+# publish_queue.py — персистентная очередь публикаций в канал
+# Админ ставит объявление в очередь (можно на время), фоновый планировщик
+# разбирает её с заданной скоростью, по порядку publish_at, с повторами при ошибках.
+# Очередь лежит в SQLite, поэтому незавершённая работа переживает рестарт.
+
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import db
+from ratelimit import TokenBucket
+
+PENDING, DONE, FAILED = "PENDING", "DONE", "FAILED"
+
+
+class SkipJob(Exception):
+    """Повторять бессмысленно (например, объявление удалили) — сразу FAILED."""
+
+
+def _enqueue(conn: sqlite3.Connection, listing_id: str, publish_at: float, now: float) -> None:
+    # объявление уже ждёт публикации — просто переносим время
+    cur = conn.execute(
+        "UPDATE publish_queue SET publish_at=?, attempts=0, last_error='' WHERE listing_id=? AND status=?",
+        (publish_at, listing_id, PENDING),
+    )
+    if cur.rowcount == 0:
+        conn.execute(
+            "INSERT INTO publish_queue (listing_id, publish_at, status, created_at) VALUES (?, ?, ?, ?)",
+            (listing_id, publish_at, PENDING, now),
+        )
+
+def _cancel(conn: sqlite3.Connection, listing_id: str) -> bool:
+    return conn.execute(
+        "DELETE FROM publish_queue WHERE listing_id=? AND status=?", (listing_id, PENDING)
+    ).rowcount > 0
+
+def _next(conn: sqlite3.Connection) -> Optional[Tuple[int, str, int, float]]:
+    return conn.execute("""
+        SELECT id, listing_id, attempts, publish_at FROM publish_queue
+        WHERE status=? ORDER BY publish_at, id LIMIT 1
+    """, (PENDING,)).fetchone()
+
+def _done(conn: sqlite3.Connection, job_id: int, now: float) -> None:
+    conn.execute("UPDATE publish_queue SET status=?, done_at=? WHERE id=?", (DONE, now, job_id))
+
+def _fail(conn: sqlite3.Connection, job_id: int, attempts: int, error: str, retry_at: Optional[float]) -> None:
+    if retry_at is None:
+        conn.execute("UPDATE publish_queue SET status=?, attempts=?, last_error=? WHERE id=?",
+                     (FAILED, attempts, error, job_id))
+    else:
+        conn.execute("UPDATE publish_queue SET attempts=?, last_error=?, publish_at=? WHERE id=?",
+                     (attempts, error, retry_at, job_id))
+
+def _pending(conn: sqlite3.Connection, limit: int) -> List[Tuple[str, float, int, str]]:
+    return conn.execute("""
+        SELECT listing_id, publish_at, attempts, last_error FROM publish_queue
+        WHERE status=? ORDER BY publish_at, id LIMIT ?
+    """, (PENDING, limit)).fetchall()
+
+
+class PublishQueue:
+    def __init__(self, post: Callable[[str], Awaitable[None]],
+                 on_fail: Optional[Callable[[str, str], Awaitable[None]]] = None,
+                 per_minute: float = 10, max_attempts: int = 5, poll_interval: float = 30):
+        self.post = post              # отправляет пост; исключение — не получилось
+        self.on_fail = on_fail        # вызывается, когда попытки кончились
+        self.bucket = TokenBucket(per_minute / 60, 1)
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.published = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def enqueue(self, listing_id: str, publish_at: Optional[float] = None) -> None:
+        now = time.time()
+        await db.write(_enqueue, listing_id, publish_at or now, now)
+        self._wake.set()
+
+    async def cancel(self, listing_id: str) -> bool:
+        return await db.write(_cancel, listing_id)
+
+    async def pending(self, limit: int = 20) -> List[Tuple[str, float, int, str]]:
+        return await db.read(_pending, limit)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="publish-queue")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            delay = self.poll_interval
+            try:
+                job = await db.read(_next)
+                if job is not None:
+                    delay = min(delay, job[3] - time.time())
+                if delay <= 0:
+                    await self._throttle()
+                    await self._process(*job[:3])
+                    continue
+            except Exception:
+                # например, «database is locked» при записи статуса: задача не должна
+                # умирать — задание осталось PENDING и будет взято на следующем круге
+                logging.exception("publish queue: iteration failed")
+                delay = self.poll_interval
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _throttle(self) -> None:
+        while True:
+            delay = self.bucket.try_take()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    async def _process(self, job_id: int, listing_id: str, attempts: int) -> None:
+        attempts += 1
+        try:
+            await self.post(listing_id)
+        except SkipJob as e:
+            await self._give_up(job_id, listing_id, attempts, str(e))
+            return
+        except Exception as e:
+            logging.exception("publish %s failed (attempt %s)", listing_id, attempts)
+            if attempts >= self.max_attempts:
+                await self._give_up(job_id, listing_id, attempts, str(e))
+            else:
+                self.retried += 1
+                backoff = min(60 * 2 ** (attempts - 1), 3600)
+                await db.write(_fail, job_id, attempts, str(e), time.time() + backoff)
+            return
+        self.published += 1
+        await db.write(_done, job_id, time.time())
+
+    async def _give_up(self, job_id: int, listing_id: str, attempts: int, error: str) -> None:
+        self.failed += 1
+        await db.write(_fail, job_id, attempts, error, None)
+        if self.on_fail is not None:
+            try:
+                await self.on_fail(listing_id, error)
+            except Exception:
+                logging.exception("publish queue: on_fail hook failed")
+
+    def stats(self) -> dict:
+        return {"published": self.published, "retried": self.retried, "failed": self.failed}
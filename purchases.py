@@ -0,0 +1,81 @@
+# purchases.py — журнал покупок и защита от повторной выдачи / повторных счетов
+
+import time
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+import db
+import outbox
+
+SQL_RECORD = """
+    INSERT OR IGNORE INTO purchases (
+        telegram_payment_charge_id, provider_payment_charge_id,
+        user_id, listing_id, amount, currency, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _record(conn: sqlite3.Connection, row: tuple, deliver: bool) -> bool:
+    cur = conn.execute(SQL_RECORD, row)
+    if cur.rowcount == 0:
+        return False
+    if deliver:
+        # та же транзакция: покупка без строки на выдачу не запишется
+        _charge, _provider, user_id, listing_id, _amount, _currency, now = row
+        outbox.enqueue(conn, cur.lastrowid, user_id, listing_id, now)
+    return True
+
+async def record_purchase(user_id: int, listing_id: str, charge_id: Optional[str] = None,
+                          provider_charge_id: Optional[str] = None,
+                          amount: int = 0, currency: str = "", deliver: bool = True) -> bool:
+    """Записать покупку и (deliver=True) поставить выдачу в outbox.
+    False — этот платёж (charge_id) уже записан, выдавать повторно не нужно."""
+    return await db.write(_record, (
+        charge_id, provider_charge_id, user_id, listing_id, amount, currency, time.time()
+    ), deliver)
+
+# оба запроса идут по индексу idx_purchases_user (user_id, listing_id)
+SQL_USER_PURCHASES = """
+    SELECT listing_id, MAX(created_at) AS last FROM purchases WHERE user_id = ?
+    GROUP BY listing_id ORDER BY last DESC LIMIT ?
+"""
+SQL_HAS_PURCHASE = "SELECT 1 FROM purchases WHERE user_id = ? AND listing_id = ? LIMIT 1"
+
+def _user_purchases(conn: sqlite3.Connection, user_id: int, limit: int) -> List[Tuple[str, float]]:
+    return conn.execute(SQL_USER_PURCHASES, (user_id, limit)).fetchall()
+
+def _has_purchase(conn: sqlite3.Connection, user_id: int, listing_id: str) -> bool:
+    return conn.execute(SQL_HAS_PURCHASE, (user_id, listing_id)).fetchone() is not None
+
+async def user_purchases(user_id: int, limit: int = 20) -> List[Tuple[str, float]]:
+    """Купленные пользователем ID (и время последней покупки), свежие первыми."""
+    return await db.read(_user_purchases, user_id, limit)
+
+async def has_purchased(user_id: int, listing_id: str) -> bool:
+    return await db.read(_has_purchase, user_id, listing_id)
+
+
+class InvoiceDedup:
+    """Не выставлять один и тот же счёт (пользователь, ID) чаще, чем раз в window секунд."""
+
+    def __init__(self, window: float = 60, max_size: int = 10000):
+        self.window = window
+        self.max_size = max_size
+        self._sent: Dict[Tuple[int, str], float] = {}
+        self.suppressed = 0
+
+    def seen(self, user_id: int, listing_id: str) -> bool:
+        """True — счёт недавно уже отправлен; иначе запоминаем отправку."""
+        now = time.monotonic()
+        key = (user_id, listing_id)
+        ts = self._sent.get(key)
+        if ts is not None and now - ts < self.window:
+            self.suppressed += 1
+            return True
+        if len(self._sent) >= self.max_size:
+            self._sent = {k: v for k, v in self._sent.items() if now - v < self.window}
+        self._sent[key] = now
+        return False
+
+    def forget(self, user_id: int, listing_id: str) -> None:
+        # счёт не ушёл — разрешаем сразу попробовать ещё раз
+        self._sent.pop((user_id, listing_id), None)
@@ -0,0 +1,43 @@
+# ratelimit.py — token bucket для ограничения частоты (время — time.monotonic)
+
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate              # токенов в секунду
+        self.capacity = capacity      # допустимый всплеск
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0      # пауза по retry_after
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def try_take(self, cost: float = 1.0, now: Optional[float] = None) -> float:
+        """Взять cost токенов. 0 — взяли; иначе сколько секунд подождать до следующей попытки."""
+        now = time.monotonic() if now is None else now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def refund(self, cost: float = 1.0) -> None:
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and time.monotonic() >= self.blocked_until
@@ -0,0 +1,157 @@
+# sender.py — планировщик исходящих сообщений с учётом лимитов Telegram
+# Подключается к сессии бота как request-middleware, поэтому действует на все
+# bot.send_* / message.answer без правок в хендлерах. Лимиты — token bucket'ы:
+# общий на бота, на каждый личный чат и на каждый канал/группу.
+# Очередь на общий bucket — с приоритетами: оплаченная выдача идёт первой,
+# рассылки подписчикам — последними.
+
+import heapq
+import asyncio
+import itertools
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Tuple, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, SendMediaGroup
+from aiogram.methods.base import TelegramType, Response
+
+from ratelimit import TokenBucket
+
+PRIORITY_PAID    = 0   # выдача оплаченного контакта
+PRIORITY_PUBLISH = 1   # посты в канал
+PRIORITY_DEFAULT = 2   # обычные ответы пользователям
+PRIORITY_ADMIN   = 3   # предпросмотры и служебные сообщения админу
+PRIORITY_BULK    = 4   # рассылки подписчикам — только в свободную полосу
+
+_priority: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_DEFAULT)
+
+@contextmanager
+def priority(level: int):
+    """Все отправки внутри блока (в этой задаче) идут с приоритетом level."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def _is_send(method: TelegramMethod) -> bool:
+    return method.__api_method__.startswith(("send", "copy", "forward"))
+
+def _is_private(chat_id: Union[int, str]) -> bool:
+    return isinstance(chat_id, int) and chat_id > 0
+
+
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, private_burst: float = 5,
+                 channel_per_minute: float = 20, max_retries: int = 3, max_buckets: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate, self.private_burst = private_rate, private_burst
+        self.channel_rate, self.channel_burst = channel_per_minute / 60, channel_per_minute
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._waiters: List[Tuple[int, int, asyncio.Future, float]] = []
+        self._seq = itertools.count()
+        self._pump_task = None
+
+        # статистика
+        self.sent = 0
+        self.throttled = 0       # отправки, которым пришлось подождать лимит
+        self.throttled_wait = 0.0
+        self.retried = 0         # повторы после 429
+        self.failed = 0          # сдались после max_retries
+
+    def _bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) >= self.max_buckets:
+                # забываем чаты, у которых bucket уже полон — они ничего не помнят
+                self._chats = {k: v for k, v in self._chats.items() if not v.full}
+            if _is_private(chat_id):
+                b = TokenBucket(self.private_rate, self.private_burst)
+            else:
+                b = TokenBucket(self.channel_rate, self.channel_burst)
+            self._chats[chat_id] = b
+        return b
+
+    async def _acquire_chat(self, bucket: TokenBucket, cost: float) -> float:
+        waited = 0.0
+        while True:
+            delay = bucket.try_take(cost)
+            if not delay:
+                return waited
+            waited += delay
+            await asyncio.sleep(delay)
+
+    async def _acquire_global(self, prio: int, cost: float) -> None:
+        if not self._waiters and not self.global_bucket.try_take(cost):
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (prio, next(self._seq), fut, cost))
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+        await fut
+
+    async def _pump(self) -> None:
+        # раздаёт токены общего bucket'а ожидающим строго по приоритету
+        try:
+            while self._waiters:
+                prio, seq, fut, cost = self._waiters[0]
+                if fut.cancelled():
+                    heapq.heappop(self._waiters)
+                    continue
+                delay = self.global_bucket.try_take(cost)
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                heapq.heappop(self._waiters)
+                fut.set_result(None)
+        finally:
+            self._pump_task = None
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not _is_send(method):
+            return await make_request(bot, method)
+
+        prio = _priority.get()
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        bucket = self._bucket(chat_id)
+        attempt = 0
+        while True:
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            await self._acquire_chat(bucket, cost)
+            await self._acquire_global(prio, cost)
+            waited = loop.time() - started
+            if waited > 0.001:
+                self.throttled += 1
+                self.throttled_wait += waited
+            try:
+                result = await make_request(bot, method)
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retried += 1
+                logging.warning("429 in chat %s, retry %s after %ss", chat_id, attempt, e.retry_after)
+                bucket.pause(e.retry_after)
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "throttled": self.throttled,
+            "throttled_wait_s": round(self.throttled_wait, 2),
+            "retried": self.retried,
+            "failed": self.failed,
+            "waiting": len(self._waiters),
+            "chats": len(self._chats),
+        }
@@ -0,0 +1,262 @@
+# subscriptions.py — подписки на новые объявления и рассылка по ним
+# Подписка — набор слов; объявление подходит, если в его тексте есть все слова
+# (подписка без слов — все новые объявления). Подбор подписчиков идёт по
+# обратному индексу subscription_terms: слово объявления → подписки с этим словом,
+# поэтому стоимость зависит от длины объявления, а не от числа подписок.
+# После публикации создаётся рассылка: получатели сразу записываются в
+# broadcast_recipients, фоновый Broadcaster рассылает их пачками с ограничением
+# скорости и отмечает доставку — после рестарта продолжает с неотправленных.
+
+import re
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError,
+)
+
+import db
+from ratelimit import TokenBucket
+from sender import priority, PRIORITY_BULK
+
+PENDING, DONE, CANCELLED = "PENDING", "DONE", "CANCELLED"
+WAITING, SENT, FAILED = 0, 1, 2   # статус получателя
+
+_WORD = re.compile(r"\w+")
+
+def terms(text: str) -> List[str]:
+    """Нормализованные слова текста: нижний регистр, ё → е, без повторов, по порядку."""
+    return list(dict.fromkeys(_WORD.findall(text.lower().replace("ё", "е"))))
+
+
+# ── Подписки ─────────────────────────────────────────────────────────────────
+def _subscribe(conn: sqlite3.Connection, user_id: int, words: List[str], limit: int, now: float) -> Optional[bool]:
+    query = " ".join(sorted(words))
+    if conn.execute("SELECT 1 FROM subscriptions WHERE user_id=? AND query=?", (user_id, query)).fetchone():
+        return False
+    if conn.execute("SELECT COUNT(*) FROM subscriptions WHERE user_id=?", (user_id,)).fetchone()[0] >= limit:
+        return None
+    sub_id = conn.execute(
+        "INSERT INTO subscriptions (user_id, query, n_terms, created_at) VALUES (?, ?, ?, ?)",
+        (user_id, query, len(words), now),
+    ).lastrowid
+    conn.executemany("INSERT INTO subscription_terms (term, subscription_id) VALUES (?, ?)",
+                     [(w, sub_id) for w in words])
+    return True
+
+def _list(conn: sqlite3.Connection, user_id: int) -> List[Tuple[int, str]]:
+    return conn.execute("SELECT id, query FROM subscriptions WHERE user_id=? ORDER BY id", (user_id,)).fetchall()
+
+def _unsubscribe(conn: sqlite3.Connection, user_id: int, sub_id: Optional[int]) -> int:
+    if sub_id is None:
+        ids = [r[0] for r in conn.execute("SELECT id FROM subscriptions WHERE user_id=?", (user_id,))]
+    else:
+        ids = [r[0] for r in conn.execute("SELECT id FROM subscriptions WHERE user_id=? AND id=?", (user_id, sub_id))]
+    conn.executemany("DELETE FROM subscription_terms WHERE subscription_id=?", [(i,) for i in ids])
+    conn.executemany("DELETE FROM subscriptions WHERE id=?", [(i,) for i in ids])
+    return len(ids)
+
+async def subscribe(user_id: int, words: List[str], limit: int = 10) -> Optional[bool]:
+    """True — подписка добавлена; False — такая уже есть; None — достигнут лимит подписок."""
+    return await db.write(_subscribe, user_id, words, limit, time.time())
+
+async def list_subscriptions(user_id: int) -> List[Tuple[int, str]]:
+    return await db.read(_list, user_id)
+
+async def unsubscribe(user_id: int, sub_id: Optional[int] = None) -> int:
+    """Удалить подписку sub_id (None — все). Возвращает число удалённых."""
+    return await db.write(_unsubscribe, user_id, sub_id)
+
+
+# ── Рассылки ─────────────────────────────────────────────────────────────────
+# подписки, у которых совпали все слова, плюс подписки «на всё»
+SQL_MATERIALIZE = """
+    INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id)
+    SELECT ?, user_id FROM (
+        SELECT s.user_id FROM (
+            SELECT subscription_id, COUNT(*) AS hits FROM subscription_terms
+            WHERE term IN (SELECT value FROM json_each(?))
+            GROUP BY subscription_id
+        ) m JOIN subscriptions s ON s.id = m.subscription_id
+        WHERE m.hits = s.n_terms
+        UNION
+        SELECT user_id FROM subscriptions WHERE n_terms = 0
+    )
+"""
+
+def _create(conn: sqlite3.Connection, listing_id: str, words: List[str], now: float) -> Optional[int]:
+    cur = conn.execute("INSERT OR IGNORE INTO broadcasts (listing_id, created_at) VALUES (?, ?)", (listing_id, now))
+    if cur.rowcount == 0:
+        return None   # по этому объявлению уже рассылали (повторная публикация)
+    job_id = cur.lastrowid
+    total = conn.execute(SQL_MATERIALIZE, (job_id, json.dumps(words))).rowcount
+    if total:
+        conn.execute("UPDATE broadcasts SET total=? WHERE id=?", (total, job_id))
+    else:
+        conn.execute("UPDATE broadcasts SET status=?, done_at=? WHERE id=?", (DONE, now, job_id))
+    return total
+
+def _next(conn: sqlite3.Connection) -> Optional[Tuple[int, str]]:
+    return conn.execute("SELECT id, listing_id FROM broadcasts WHERE status=? ORDER BY id LIMIT 1",
+                        (PENDING,)).fetchone()
+
+def _recipients(conn: sqlite3.Connection, job_id: int, limit: int) -> List[int]:
+    return [r[0] for r in conn.execute(
+        "SELECT user_id FROM broadcast_recipients WHERE broadcast_id=? AND status=? LIMIT ?",
+        (job_id, WAITING, limit),
+    )]
+
+def _mark(conn: sqlite3.Connection, job_id: int, results: List[Tuple[int, int]], blocked: List[int]) -> None:
+    conn.executemany("UPDATE broadcast_recipients SET status=? WHERE broadcast_id=? AND user_id=?",
+                     [(status, job_id, user_id) for user_id, status in results])
+    sent = sum(1 for _, status in results if status == SENT)
+    conn.execute("UPDATE broadcasts SET sent=sent+?, failed=failed+? WHERE id=?",
+                 (sent, len(results) - sent, job_id))
+    # заблокировал бота — подписки ему больше не нужны
+    for user_id in blocked:
+        _unsubscribe(conn, user_id, None)
+
+def _finish(conn: sqlite3.Connection, job_id: int, status: str, now: float) -> None:
+    if status == CANCELLED:
+        conn.execute("DELETE FROM broadcast_recipients WHERE broadcast_id=? AND status=?", (job_id, WAITING))
+    conn.execute("UPDATE broadcasts SET status=?, done_at=? WHERE id=?", (status, now, job_id))
+
+def _recent(conn: sqlite3.Connection, limit: int) -> List[Tuple[str, str, int, int, int]]:
+    return conn.execute(
+        "SELECT listing_id, status, total, sent, failed FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)
+    ).fetchall()
+
+
+class Broadcaster:
+    def __init__(self, render: Callable[[str], Awaitable[Optional[object]]],
+                 send: Callable[[int, object], Awaitable[None]],
+                 per_second: float = 20, concurrency: int = 8, batch: int = 100,
+                 poll_interval: float = 30):
+        self.render = render        # listing_id → что рассылать; None — объявления больше нет
+        self.send = send            # (user_id, результат render) → отправка одному подписчику
+        self.bucket = TokenBucket(per_second, max(1.0, per_second))
+        self.concurrency = concurrency
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.jobs = 0
+        self.current: Optional[str] = None
+
+    async def create(self, listing_id: str, text: Iterable[str]) -> Optional[int]:
+        """Завести рассылку по объявлению. Возвращает число получателей (None — уже была)."""
+        words = terms(" ".join(t for t in text if t))
+        total = await db.write(_create, listing_id, words, time.time())
+        if total:
+            self._wake.set()
+        return total
+
+    async def recent(self, limit: int = 10) -> List[Tuple[str, str, int, int, int]]:
+        return await db.read(_recent, limit)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="broadcaster")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        # массовые отправки уступают в планировщике лимитов всем остальным
+        with priority(PRIORITY_BULK):
+            while True:
+                self._wake.clear()
+                try:
+                    job = await db.read(_next)
+                    if job is not None and await self._process(*job):
+                        continue
+                except Exception:
+                    logging.exception("broadcast: job failed")
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _process(self, job_id: int, listing_id: str) -> bool:
+        """Разослать одну рассылку до конца. False — временная ошибка, продолжим позже."""
+        payload = await self.render(listing_id)
+        if payload is None:
+            # объявление удалили или оно истекло, пока рассылка ждала
+            await db.write(_finish, job_id, CANCELLED, time.time())
+            return True
+        self.current = listing_id
+        try:
+            while True:
+                users = await db.read(_recipients, job_id, self.batch)
+                if not users:
+                    await db.write(_finish, job_id, DONE, time.time())
+                    self.jobs += 1
+                    logging.info("broadcast %s finished", listing_id)
+                    return True
+                results, blocked, retry_later = await self._send_batch(users, payload)
+                # отметки пишем пачкой; упади процесс до записи — пачку отправим ещё раз
+                await db.write(_mark, job_id, results, blocked)
+                if retry_later:
+                    return False
+        finally:
+            self.current = None
+
+    async def _send_batch(self, users: List[int], payload: object) -> Tuple[List[Tuple[int, int]], List[int], bool]:
+        sem = asyncio.Semaphore(self.concurrency)
+        results: List[Tuple[int, int]] = []
+        blocked: List[int] = []
+        retry_later = False
+
+        async def one(user_id: int) -> None:
+            nonlocal retry_later
+            async with sem:
+                if retry_later:
+                    return
+                await self._throttle()
+                try:
+                    await self.send(user_id, payload)
+                except TelegramForbiddenError:
+                    blocked.append(user_id)
+                    self.blocked += 1
+                    results.append((user_id, FAILED))
+                except TelegramBadRequest as e:
+                    logging.warning("broadcast to %s failed: %s", user_id, e)
+                    self.failed += 1
+                    results.append((user_id, FAILED))
+                except (TelegramNetworkError, TelegramServerError, TelegramRetryAfter):
+                    # Telegram недоступен — получатель остаётся в очереди
+                    logging.warning("broadcast paused: Telegram unavailable", exc_info=True)
+                    retry_later = True
+                except Exception:
+                    logging.exception("broadcast to %s failed", user_id)
+                    self.failed += 1
+                    results.append((user_id, FAILED))
+                else:
+                    self.sent += 1
+                    results.append((user_id, SENT))
+
+        await asyncio.gather(*(one(u) for u in users))
+        return results, blocked, retry_later
+
+    async def _throttle(self) -> None:
+        while True:
+            delay = self.bucket.try_take()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "failed": self.failed, "blocked": self.blocked,
+                "jobs": self.jobs, "active": int(self.current is not None)}
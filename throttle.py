@@ -0,0 +1,104 @@
+# throttle.py — антифлуд для публичных хендлеров
+# Inner-middleware роутера: лимит берётся из флага хендлера
+#   @r_public.message(..., flags={"throttle": "lookup"})
+# и проверяется двумя token bucket: личным (пользователь × лимит) и общим на лимит.
+# Сверх лимита апдейт отбрасывается; пользователь получает одно сообщение
+# «слишком часто» на период остывания, а не ответ на каждое сообщение.
+
+import time
+from typing import Any, Awaitable, Callable, Collection, Dict, NamedTuple, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from ratelimit import TokenBucket
+
+COOLDOWN_TEXT = "⏳ Слишком много запросов. Подожди немного и попробуй снова."
+
+
+class Limit(NamedTuple):
+    user_rate: float      # запросов в секунду на пользователя
+    user_burst: float     # допустимый всплеск на пользователя
+    global_rate: float    # запросов в секунду на всех (0 — без общего лимита)
+    global_burst: float
+
+
+class Throttle(BaseMiddleware):
+    def __init__(self, limits: Dict[str, Limit], exempt: Collection[int] = (),
+                 cooldown: float = 10.0, max_buckets: int = 10000):
+        self.limits = limits
+        self.exempt = set(exempt)            # админ и прочие доверенные ID
+        self.cooldown = cooldown             # не чаще одного предупреждения за период
+        self.max_buckets = max_buckets
+        self._users: Dict[Tuple[str, int], TokenBucket] = {}
+        self._global = {name: TokenBucket(l.global_rate, l.global_burst)
+                        for name, l in limits.items() if l.global_rate > 0}
+        self._warned: Dict[int, float] = {}  # user_id → до какого момента молчим
+
+        # статистика
+        self.passed = 0
+        self.dropped: Dict[str, int] = {name: 0 for name in limits}
+        self.dropped_global: Dict[str, int] = {name: 0 for name in limits}
+        self.warnings = 0
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        name = get_flag(data, "throttle")
+        user = getattr(event, "from_user", None)
+        if name is None or user is None or user.id in self.exempt:
+            return await handler(event, data)
+        limit = self.limits.get(name)
+        if limit is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        bucket = self._bucket(name, user.id, limit)
+        if bucket.try_take(now=now):
+            self.dropped[name] += 1
+            return await self._warn(event, user.id, now)
+        shared = self._global.get(name)
+        if shared is not None and shared.try_take(now=now):
+            # общий лимит исчерпан — личный токен возвращаем, пользователь не виноват
+            bucket.refund()
+            self.dropped_global[name] += 1
+            return await self._warn(event, user.id, now)
+        self.passed += 1
+        return await handler(event, data)
+
+    def _bucket(self, name: str, user_id: int, limit: Limit) -> TokenBucket:
+        key = (name, user_id)
+        bucket = self._users.get(key)
+        if bucket is None:
+            if len(self._users) >= self.max_buckets:
+                # забываем пользователей, у которых bucket уже полон — они ничего не помнят
+                self._users = {k: v for k, v in self._users.items() if not v.full}
+                now = time.monotonic()
+                self._warned = {k: v for k, v in self._warned.items() if v > now}
+            bucket = self._users[key] = TokenBucket(limit.user_rate, limit.user_burst)
+        return bucket
+
+    async def _warn(self, event: TelegramObject, user_id: int, now: float) -> None:
+        if isinstance(event, CallbackQuery):
+            # callback всё равно нужно подтвердить, иначе у кнопки крутятся «часики»
+            warn = self._warned.get(user_id, 0) <= now
+            await event.answer(COOLDOWN_TEXT if warn else None)
+        elif isinstance(event, Message):
+            warn = self._warned.get(user_id, 0) <= now
+            if warn:
+                await event.answer(COOLDOWN_TEXT)
+        else:
+            return None
+        if warn:
+            self._warned[user_id] = now + self.cooldown
+            self.warnings += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "passed": self.passed,
+            "dropped": dict(self.dropped),
+            "dropped_global": dict(self.dropped_global),
+            "warnings": self.warnings,
+            "users": len(self._users),
+        }
@@ -0,0 +1,138 @@
+# update_queue.py — быстрый ответ вебхуку: апдейты кладём в ограниченную очередь,
+# разбирают их воркеры. Очередь шардирована по чату: один чат — всегда один воркер,
+# поэтому шаги FSM одного пользователя обрабатываются строго по порядку.
+
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import List, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+OVERFLOW_WAIT   = "wait"     # ждать место в очереди до put_timeout, потом отказ
+OVERFLOW_REJECT = "reject"   # сразу отказ → вебхук отвечает 503, Telegram повторит позже
+
+
+def chat_key(update: Update) -> int:
+    """Ключ шардирования: id чата, иначе id пользователя, иначе update_id."""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+
+def chat_key_raw(update: dict) -> int:
+    """То же, что chat_key, но по сырому JSON — без разбора в модель (для роутера cluster.py)."""
+    for field, event in update.items():
+        if field == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        user = event.get("from")
+        if user and "id" in user:
+            return user["id"]
+        break
+    return update.get("update_id", 0)
+
+
+class UpdateQueue:
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int = 8, maxsize: int = 1000,
+                 overflow: str = OVERFLOW_WAIT, put_timeout: float = 5.0):
+        self.dp = dispatcher
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.overflow = overflow
+        self.put_timeout = put_timeout
+        per_shard = max(1, maxsize // self.workers)
+        self._shards: List[asyncio.Queue] = [asyncio.Queue(maxsize=per_shard) for _ in range(self.workers)]
+        self._tasks: List[asyncio.Task] = []
+
+        # статистика
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._waits: deque = deque(maxlen=1024)   # последние ожидания — для p95
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._shards)
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(q), name=f"update-worker-{i}")
+                       for i, q in enumerate(self._shards)]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        # даём дообработать то, что уже принято (Telegram получил на это 200)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._shards)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("update queue: %s updates dropped on shutdown", self.depth)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def put(self, update: Update) -> bool:
+        """Поставить апдейт в очередь. False — очередь переполнена, апдейт не принят."""
+        q = self._shards[chat_key(update) % self.workers]
+        item: Tuple[Update, float] = (update, time.monotonic())
+        try:
+            if self.overflow == OVERFLOW_REJECT:
+                q.put_nowait(item)
+            else:
+                await asyncio.wait_for(q.put(item), self.put_timeout)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    async def _worker(self, q: asyncio.Queue) -> None:
+        while True:
+            update, enqueued_at = await q.get()
+            waited = time.monotonic() - enqueued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self._waits.append(waited)
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logging.exception("update %s failed", update.update_id)
+            finally:
+                q.task_done()
+
+    def stats(self) -> dict:
+        done = self.processed + self.failed
+        waits = sorted(self._waits)
+        p95: Optional[float] = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else None
+        return {
+            "workers": self.workers,
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_avg_ms": round(self.wait_total / done * 1000, 2) if done else 0.0,
+            "wait_p95_ms": round(p95 * 1000, 2) if p95 is not None else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+        }
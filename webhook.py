@@ -1,27 +1,134 @@
 import os
 import asyncio
+import logging
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
-from fastapi import FastAPI, Request
+from aiogram.types import Update
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import PlainTextResponse
 import uvicorn
 
-from bot import dp, bot   # импортируем бота и диспетчер из bot.py
+import bot as bot_app
+from bot import dp, bot, send_scheduler, publish_queue, expiry_sweeper, funnel_stats, throttle, broadcaster, delivery_outbox, profiler, cache_sync   # импортируем бота и диспетчер из bot.py
+from db import db_init, cache_stats
+from leader import LeaderLock
+from update_queue import UpdateQueue
+from dedup import UpdateDedup
+import metrics
 
 WEBHOOK_PATH = f"/webhook/{os.getenv('BOT_TOKEN')}"
 WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL") + WEBHOOK_PATH
 
+# queue — отвечаем Telegram сразу, апдейт обрабатывают воркеры; inline — как раньше, в запросе
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "queue")
+
+updates = UpdateQueue(
+    dp, bot,
+    workers=int(os.getenv("WEBHOOK_WORKERS", "8")),
+    maxsize=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+    overflow=os.getenv("WEBHOOK_OVERFLOW", "wait"),          # wait | reject
+    put_timeout=float(os.getenv("WEBHOOK_PUT_TIMEOUT", "5")),
+)
+
+# повторные доставки одного апдейта (Telegram ретраит медленный вебхук) отсекаем по update_id;
+# WEBHOOK_DEDUP_PERSIST=1 — помнить принятые ID и через рестарт
+dedup = UpdateDedup(
+    size=int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000")),
+    persist=os.getenv("WEBHOOK_DEDUP_PERSIST", "0") == "1",
+)
+
+# очереди и кэши отдаются в /metrics как gauge (снимок на момент запроса)
+metrics.register_stats("queue", updates.stats)
+metrics.register_stats("dedup", dedup.stats)
+metrics.register_stats("sender", send_scheduler.stats)
+metrics.register_stats("publish", publish_queue.stats)
+metrics.register_stats("expiry", expiry_sweeper.stats)
+metrics.register_stats("broadcast", broadcaster.stats)
+metrics.register_stats("outbox", delivery_outbox.stats)
+metrics.register_stats("profile", profiler.stats)
+metrics.register_stats("funnel", funnel_stats.stats)
+metrics.register_stats("throttle", throttle.stats)
+metrics.register_stats("cache", cache_stats)
+metrics.register_stats("cache_sync", cache_sync.stats)
+if hasattr(dp.storage, "stats"):
+    metrics.register_stats("fsm", dp.storage.stats)
+
+# несколько воркеров (uvicorn --workers или cluster.py): миграции, регистрацию
+# вебхука и фоновые задачи выполняет только лидер
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+leader = LeaderLock()
+
+async def _leader_init():
+    await db_init()
+    # Устанавливаем вебхук при запуске
+    await bot.set_webhook(WEBHOOK_URL)
+
 app = FastAPI()
 
 @app.on_event("startup")
 async def on_startup():
-    # Устанавливаем вебхук при запуске
-    await bot.set_webhook(WEBHOOK_URL)
+    is_leader = await leader.elect(_leader_init)
+    await dedup.start()
+    if WEBHOOK_MODE == "queue":
+        await updates.start()
+    await dp.emit_startup(bot=bot, leader=is_leader)
+    if not is_leader:
+        leader.watch(bot_app.start_background_jobs)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if WEBHOOK_MODE == "queue":
+        await updates.stop()
+    await dp.emit_shutdown(bot=bot)
+    await dedup.close()
+    await leader.stop()
 
 @app.post(WEBHOOK_PATH)
 async def webhook_handler(request: Request):
-    update = await request.json()
-    await dp.feed_webhook_update(bot, update)
+    raw = await request.json()
+    update_id = raw.get("update_id") if isinstance(raw, dict) else None
+    if isinstance(update_id, int) and not dedup.check(update_id):
+        # эту копию уже приняли — подтверждаем, чтобы Telegram перестал повторять
+        return {"status": "duplicate"}
+
+    if WEBHOOK_MODE != "queue":
+        try:
+            await dp.feed_webhook_update(bot, raw)
+        except BaseException:
+            # ошибка → Telegram повторит, и повтор должен пройти
+            if isinstance(update_id, int):
+                dedup.forget(update_id)
+            raise
+        return {"status": "ok"}
+
+    try:
+        update = Update.model_validate(raw, context={"bot": bot})
+    except Exception:
+        # битый апдейт повторять бессмысленно — подтверждаем и забываем
+        logging.warning("webhook: invalid update skipped", exc_info=True)
+        return {"status": "ignored"}
+
+    if not await updates.put(update):
+        # очередь полна: 503 → Telegram повторит доставку позже, её нельзя считать дублем
+        dedup.forget(update.update_id)
+        return Response(status_code=503)
     return {"status": "ok"}
 
+@app.get("/stats")
+async def stats():
+    result = {"mode": WEBHOOK_MODE, "worker": WORKER_INDEX, "leader": leader.is_leader, "queue": updates.stats(),
+              "dedup": dedup.stats(), "sender": send_scheduler.stats(),
+              "publish": publish_queue.stats(), "expiry": expiry_sweeper.stats(),
+              "broadcast": broadcaster.stats(), "outbox": delivery_outbox.stats(),
+              "funnel": funnel_stats.stats(), "throttle": throttle.stats(),
+              "cache_sync": cache_sync.stats()}
+    if hasattr(dp.storage, "stats"):
+        result["fsm"] = dp.storage.stats()
+    return result
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
-    uvicorn.run("webhook:app", host="0.0.0.0", port=int(os.getenv("PORT", 10000)))
\ No newline at end of file
+    uvicorn.run("webhook:app", host="0.0.0.0", port=int(os.getenv("PORT", 10000)))